@@ -136,11 +136,20 @@ install_receiver()
     cp -r $RECEIVER/changed/queue.py lib/python3.$version/site-packages/salmon/
     cp -r $RECEIVER/changed/server.py lib/python3.$version/site-packages/salmon/
     cp -r $RECEIVER/changed/smtpd.py lib/python3.$version/site-packages/salmon/
+    cp -r $RECEIVER/changed/smtpd_asyncore.py lib/python3.$version/site-packages/salmon/
+    cp -r $RECEIVER/changed/server_asyncore.py lib/python3.$version/site-packages/salmon/
     cp -r $RECEIVER/changed/handlers/queue.py lib/python3.$version/site-packages/salmon/handlers/
+    cp -r $RELAY/new/salmonheaders.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonwatcher.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonqueueindex.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonsqlqueue.py lib/python3.$version/site-packages/salmon/
     cp -r $RECEIVER/changed/boot.py myproject/config/
     cp -r $RECEIVER/changed/settings.py myproject/config/
     cp -r $RECEIVER/changed/sample.py myproject/app/handlers/
     cp -r $RECEIVER/new/new_email_inotify.py $WORK_PATH/salmon-receiver/myproject/run/
+    cp -r $RECEIVER/new/benchmark_receiver.py myproject/
+    cp -r $RECEIVER/new/benchmark_queue.py myproject/
+    cp -r $RECEIVER/new/migrate_queue.py myproject/
     cp -r $CONFIGURATION/salmon.yaml $WORK_PATH/configuration/
     cp -r $CONFIGURATION/rules.json $WORK_PATH/configuration/
     mkdir -p myproject/run/queue/cur
@@ -165,12 +174,14 @@ install_relay()
     pip install spacy
     pip install apscheduler==2.1.2
     pip install ssdeep
+    pip install numpy
     pip install SQLAlchemy
     pip install psutil
     pip install pytest
     pip install essential_generators
     pip install scp
     pip install PrettyTable
+    pip install inotify
     salmon gen myproject
     cp -r $RELAY/changed/queue.py lib/python3.$version/site-packages/salmon/
     cp -r $RELAY/changed/routing.py lib/python3.$version/site-packages/salmon/
@@ -186,9 +197,30 @@ install_relay()
     cp -r $RELAY/new/salmonscheduler.py lib/python3.$version/site-packages/salmon/
     cp -r $RELAY/new/salmonspam.py lib/python3.$version/site-packages/salmon/
     cp -r $RELAY/new/base.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonheaders.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonwatcher.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonqueueindex.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonsqlqueue.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonpipeline.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonoverload.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmondelivery.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonfastpath.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonurls.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonhtml.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonminhash.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonvectors.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonnlp.py lib/python3.$version/site-packages/salmon/
+    cp -r $RELAY/new/salmonstartup.py lib/python3.$version/site-packages/salmon/
+    # the SMTP server of the receiver, used by the fast path
+    cp -r $RECEIVER/changed/smtpd.py lib/python3.$version/site-packages/salmon/
+    cp -r $RECEIVER/changed/smtpd_asyncore.py lib/python3.$version/site-packages/salmon/
     cp -r $RELAY/new/tests/* myproject/tests/
     cp -r $RELAY/new/salmonerrornotifier.py $WORK_PATH/configuration/
     cp -r $RELAY/new/salmondeleteold.py myproject/
+    cp -r $RELAY/new/benchmark_fastpath.py myproject/
+    cp -r $RELAY/new/benchmark_parse.py myproject/
+    cp -r $RELAY/new/benchmark_similarity.py myproject/
+    cp -r $RELAY/new/benchmark_nlp.py myproject/
     cp -r $RELAY/new/salmondeleteold.sh myproject/
     cp -r $CONFIGURATION/../print_statistics.py myproject/
     cp -r $CONFIGURATION/../statistics.sh myproject/
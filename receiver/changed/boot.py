@@ -2,7 +2,7 @@ import logging.config
 
 from salmon import queue
 from salmon.routing import Router
-from salmon.server import SMTPReceiver, Relay
+from salmon.server import AsyncSMTPReceiver, ReceiverWorkers, Relay
 import yaml
 import os
 
@@ -19,8 +19,18 @@ settings.relay = Relay(host=data['relay']['relayhost'],
                        port=data['relay']['relayport'], debug=1)
 
 # where to listen for incoming messages
-settings.receiver = SMTPReceiver(data['receiver']['listenhost'],
-                                 data['receiver']['listenport'])
+if data['receiver'].get('workers', 1) > 1:
+    settings.receiver = ReceiverWorkers(data['receiver']['listenhost'],
+                                        data['receiver']['listenport'],
+                                        data['receiver']['workers'])
+elif data['receiver'].get('frontend', 'asyncore') == 'asyncio':
+    settings.receiver = AsyncSMTPReceiver(data['receiver']['listenhost'],
+                                          data['receiver']['listenport'])
+else:
+    # asyncore is imported only for this frontend, it is gone from Python 3.12
+    from salmon.server import SMTPReceiver
+    settings.receiver = SMTPReceiver(data['receiver']['listenhost'],
+                                     data['receiver']['listenport'])
 
 Router.defaults(**data['global']['router_defaults'])
 Router.load(data['global']['handlers'])
@@ -3,22 +3,36 @@ Implements a handler that puts every message it receives into
 the run/queue directory.  It is intended as a debug tool so you
 can inspect messages the server is receiving using mutt or
 the salmon queue command.
+
+A message for many recipients is stored once with the recipients in its
+metadata sidecar, unless store_once is turned off in the receiver section
+of salmon.yaml (see queue.Queue.push_for_recipients).
 """
 
 import logging
 
 from salmon import handlers, queue
-from salmon.routing import route_like, stateless, nolocking
-import re
-
-def queue_handler():
-    @route("(to)@(host)", to=".+", host=".+")
-    @stateless
-    @nolocking
-    def START(message, to=None, host=None):
-        logging.debug("MESSAGE to %s@%s added to queue.", to, host)
-        q = queue.Queue('run/queue')
-        email = "%s@%s" % (to, host)
-        message = str(message).replace("%", "%%")
-        new_msg = re.sub(r'(?m)^\To:.*\n?', 'To: %s\n', message, 1) % (email,)
-        q.push(new_msg)
+from salmon.routing import route, stateless, nolocking
+
+QUEUE_DIR = 'run/queue'
+try:
+    _queue
+except NameError:
+    # survives the reload of this module by the Router (Router.RELOAD)
+    _queue = None
+
+
+def get_queue():
+    """The queue is created once, not for every message."""
+    global _queue
+    if _queue is None:
+        _queue = queue.open_queue(QUEUE_DIR)
+    return _queue
+
+
+@route("(to)@(host)", to=".+", host=".+")
+@stateless
+@nolocking
+def START(message, to=None, host=None):
+    keys = get_queue().push_for_recipients(message)
+    logging.debug("MESSAGE to %s@%s added to queue as %s.", to, host, ", ".join(keys))
@@ -8,6 +8,7 @@ from __future__ import print_function, unicode_literals
 
 import errno
 import hashlib
+import json
 import logging
 import mailbox
 import os
@@ -17,37 +18,55 @@ import configparser
 import yaml
 import six
 
-from salmon import mail
+from salmon import mail, smtpd, salmonqueueindex, salmonsqlqueue
+from salmon.salmonheaders import HeaderIndex
 
-# we calculate this once, since the hostname shouldn't change for every
-# email we put in a queue
-
-PEER = ''
-USER = ''
+# subdirectory of the Maildir with the metadata sidecars (<key>.json)
+META_DIR = salmonqueueindex.META_DIR
 
 try:
     confpath = os.path.dirname(os.path.realpath(__file__)) + "/../../../../../configuration/salmon.yaml"
     with open(confpath) as f:
         data = yaml.load(f, Loader=yaml.FullLoader)
     sensorName = data['receiver']['sensorname']
+    # a message for many recipients is stored once, see Queue.push_for_recipients
+    storeOnce = data['receiver'].get('store_once', True)
+    # subdirectories of new/ of run/queue, see salmonqueueindex
+    queueShards = data['global'].get('queue_shards', 0)
+    # maildir or sqlite, see open_queue
+    queueBackend = data['global'].get('queue_backend', 'maildir')
+    queueCommitInterval = data['global'].get('queue_commit_interval', 0)
 except FileNotFoundError as err:
-    pass
+    storeOnce = True
+    queueShards = 0
+    queueBackend = 'maildir'
+    queueCommitInterval = 0
+
+
+def new_key(metadata=None):
+    """
+    Returns a new queue key.  It starts with the arrival time like every
+    Maildir key and carries the peer, sensor and user of the SMTP session.
+    """
+    metadata = metadata or {}
+    now = time.time()
+    return "%s.M%sP%sQ%s-%s-%s-%s" % (
+        int(now),
+        int(now % 1 * 1e6),
+        os.getpid(),
+        mailbox.Maildir._count,
+        metadata.get('peer', 'none'),
+        metadata.get('sensor', sensorName),
+        metadata.get('user', 'none'),
+    )
 
 
 class SafeMaildir(mailbox.Maildir):
-    def _create_tmp(self):
-        global PEER
-        logging.critical("PEER in queue: %s", PEER)
-        now = time.time()
-        uniq = "%s.M%sP%sQ%s-%s-%s-%s" % (
-            int(now),
-            int(now % 1 * 1e6),
-            os.getpid(),
-            mailbox.Maildir._count,
-            PEER[0],
-            sensorName,
-            USER,
-        )
+    # set by Queue, new messages go into new/<shard>/ when it is not 0
+    shards = 0
+
+    def _create_tmp(self, metadata=None):
+        uniq = new_key(metadata)
         path = os.path.join(self._path, 'tmp', uniq)
         try:
             os.stat(path)
@@ -65,6 +84,54 @@ class SafeMaildir(mailbox.Maildir):
         # Fall through to here if stat succeeded or open raised EEXIST.
         raise mailbox.ExternalClashError('Name clash prevented file creation: %s' % path)
 
+    def add(self, message, metadata=None):
+        """
+        Adds the message into new/ like mailbox.Maildir.add.  The metadata
+        of the SMTP session (peer, auth user, sensor, ...) is written into
+        the meta/<key>.json sidecar before the message appears in new/, so
+        the relay never sees a message without it.
+        """
+        tmp_file = self._create_tmp(metadata)
+        try:
+            self._dump_message(message, tmp_file)
+        except BaseException:
+            tmp_file.close()
+            os.remove(tmp_file.name)
+            raise
+        mailbox._sync_close(tmp_file)
+        return self._deliver(tmp_file.name, metadata)
+
+    def add_spooled(self, data, metadata=None):
+        """
+        Same as add, but for smtpd.SpooledData. The spool file already is in
+        tmp/ of this Maildir, so it is only moved into new/ instead of writing
+        the whole message again.
+        """
+        tmp_file = self._create_tmp(metadata)
+        tmp_file.close()
+        try:
+            data.save(tmp_file.name)
+        except BaseException:
+            os.remove(tmp_file.name)
+            raise
+        return self._deliver(tmp_file.name, metadata)
+
+    def _deliver(self, tmp_path, metadata):
+        uniq = os.path.basename(tmp_path).split(self.colon)[0]
+        if metadata is not None:
+            self.write_metadata(uniq, metadata)
+        os.rename(tmp_path, salmonqueueindex.message_path(self._path, uniq, self.shards))
+        return uniq
+
+    def write_metadata(self, key, metadata):
+        path = salmonqueueindex.metadata_path(self._path, key, self.shards)
+        meta_dir = os.path.dirname(path)
+        if not os.path.isdir(meta_dir):
+            os.makedirs(meta_dir, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(metadata, f)
+        os.rename(path + '.tmp', path)
+
 
 class QueueError(Exception):
 
@@ -81,7 +148,7 @@ class Queue(object):
     most robust, but could implement others later.
     """
 
-    def __init__(self, queue_dir, safe=True, pop_limit=0, oversize_dir=None):
+    def __init__(self, queue_dir, safe=True, pop_limit=0, oversize_dir=None, shards=None):
         """
         This gives the Maildir queue directory to use, and whether you want
         this Queue to use the SafeMaildir variant which hashes the hostname
@@ -97,6 +164,12 @@ class Queue(object):
         The oversize protection only works on pop messages off, not
         putting them in, get, or any other call.  If you use get you can
         use self.oversize to also check if it's oversize manually.
+
+        With shards (queue_shards in the global section of salmon.yaml by
+        default) new/ is split into that many subdirectories and keys(),
+        len() and pop() use an index of the pending messages instead of
+        listing the Maildir, see salmonqueueindex.  A queue keeps the
+        layout it was created with.
         """
         self.dir = queue_dir
 
@@ -105,8 +178,15 @@ class Queue(object):
         else:
             self.mbox = mailbox.Maildir(queue_dir)
 
+        self.shards = salmonqueueindex.setup_layout(
+            queue_dir, queueShards if shards is None else shards)
+        self.mbox.shards = self.shards
+        self._index = None
+
         self.pop_limit = pop_limit
+        self._setup_oversize(oversize_dir)
 
+    def _setup_oversize(self, oversize_dir):
         if oversize_dir:
             if not os.path.exists(oversize_dir):
                 mailbox.Maildir(oversize_dir)
@@ -121,13 +201,73 @@ class Queue(object):
     def push(self, message):
         """
         Pushes the message onto the queue.  Remember the order is probably
-        not maintained.  It returns the key that gets created.
+        not maintained.  It returns the key that gets created.  The
+        message.metadata dict set by the receiver goes into the sidecar.
         """
-        if not isinstance(message.Data, (bytes, str)):
+        data = getattr(message, 'Data', message)
+        metadata = getattr(message, 'metadata', None)
+        if isinstance(data, smtpd.SpooledData):
+            if isinstance(self.mbox, SafeMaildir):
+                key = self.mbox.add_spooled(data, metadata)
+                if self._index is not None:
+                    self._index.add(key)
+                return key
+            message = data.read()
+            data.discard()
+        elif not isinstance(data, (bytes, str)):
             message = str(message)
         else:
-            message = message.Data
-        return self.mbox.add(message)
+            message = data
+        return self._add(message, metadata)
+
+    def _add(self, message, metadata=None):
+        if isinstance(self.mbox, SafeMaildir):
+            key = self.mbox.add(message, metadata)
+        else:
+            key = self.mbox.add(message)
+            if self.shards:
+                os.rename(os.path.join(self.dir, 'new', key), self.new_path(key))
+        if self._index is not None:
+            self._index.add(key)
+        return key
+
+    def push_for_recipients(self, message, store_once=None):
+        """
+        Pushes a message received for one or more envelope recipients and
+        returns the list of created keys.
+
+        With store_once (the store_once key of the receiver section, on by
+        default) the message is written a single time.  Its envelope
+        recipients are the recipient manifest in the metadata sidecar, the
+        relay parses and scores the message once and then delivers it to
+        each of them.  Otherwise every recipient gets its own copy with its
+        address in the To header.
+        """
+        if store_once is None:
+            store_once = storeOnce
+        metadata = getattr(message, 'metadata', None)
+        if metadata is None:
+            metadata = message.metadata = {}
+        recipients = metadata.get('recipients') or [message.To]
+        if store_once or len(recipients) < 2:
+            metadata['recipients'] = recipients
+            return [self.push(message)]
+
+        data = getattr(message, 'Data', message)
+        if isinstance(data, smtpd.SpooledData):
+            raw = data.read()
+            data.discard()
+        elif isinstance(data, (bytes, str)):
+            raw = data
+        else:
+            raw = str(message)
+        # the Bcc header the receiver added lists all the blind recipients
+        index = HeaderIndex(HeaderIndex(raw).remove_header('Bcc'))
+        keys = []
+        for recipient in recipients:
+            copy = index.set_header('To', recipient)
+            keys.append(self._add(copy, dict(metadata, recipients=[recipient])))
+        return keys
 
     def pop(self):
         """
@@ -136,18 +276,15 @@ class Queue(object):
 
         It returns a (key, message) tuple for that item.
         """
+        if self.shards:
+            batch = self.pop_batch(1)
+            return batch[0] if batch else (None, None)
+
         for key in self.mbox.iterkeys():
             over, over_name = self.oversize(key)
 
             if over:
-                if self.oversize_dir:
-                    logging.info("Message key %s over size limit %d, moving to %s.",
-                                 key, self.pop_limit, self.oversize_dir)
-                    os.rename(over_name, os.path.join(self.oversize_dir, key))
-                else:
-                    logging.info("Message key %s over size limit %d, DELETING (set oversize_dir).",
-                                 key, self.pop_limit)
-                    os.unlink(over_name)
+                self._drop_oversize(key, over_name)
             else:
                 try:
                     msg = self.get(key)
@@ -159,18 +296,107 @@ class Queue(object):
 
         return None, None
 
+    def pop_batch(self, n):
+        """
+        Pops up to n messages off the queue, the oldest ones first, and
+        returns a list of (key, message) tuples.  The keys come from the
+        index, the queue is listed again only when it runs empty.  Oversize
+        messages are moved away and not returned.
+        """
+        index = self.index()
+        if not len(index):
+            index = self.index(refresh=True)
+        batch = []
+        while len(batch) < n:
+            keys = index.pop(n - len(batch))
+            if not keys:
+                break
+            for key in keys:
+                try:
+                    msg = self.pop_key(key)
+                except KeyError:
+                    # popped by another process
+                    continue
+                if msg is not None:
+                    batch.append((key, msg))
+        return batch
+
+    def index(self, refresh=False):
+        """
+        Returns the salmonqueueindex.QueueIndex of the pending messages.  It
+        is built by listing the queue the first time and with refresh,
+        after that it knows about what this Queue pushes and removes.
+        """
+        if self._index is None or refresh:
+            self._index = salmonqueueindex.QueueIndex(salmonqueueindex.scan(self.new_dirs()))
+        return self._index
+
+    def new_dirs(self):
+        """Returns the directories with the new messages."""
+        return salmonqueueindex.new_dirs(self.dir, self.shards)
+
+    def new_path(self, key):
+        """Returns the path of the new message with the given key."""
+        return salmonqueueindex.message_path(self.dir, key, self.shards)
+
+    def backlog(self):
+        """
+        Returns the number of messages waiting in the queue and how many
+        seconds the oldest of them waits, the queue is listed every time.
+        """
+        return salmonqueueindex.backlog(self.new_dirs())
+
+    def pop_key(self, key):
+        """
+        Pops the message with the given key off the queue, e.g. one reported
+        by salmonwatcher.QueueWatcher.  Oversize messages are moved away like
+        in pop() and None is returned for them.  Raises KeyError when there
+        is no such message (any more).
+        """
+        try:
+            over, over_name = self.oversize(key)
+        except FileNotFoundError:
+            raise KeyError(key)
+        if over:
+            self._drop_oversize(key, over_name)
+            return None
+        try:
+            msg = self.get(key)
+        finally:
+            self.remove(key)
+        return msg
+
+    def _drop_oversize(self, key, over_name):
+        if self.oversize_dir:
+            logging.info("Message key %s over size limit %d, moving to %s.",
+                         key, self.pop_limit, self.oversize_dir)
+            os.rename(over_name, os.path.join(self.oversize_dir, key))
+        else:
+            logging.info("Message key %s over size limit %d, DELETING (set oversize_dir).",
+                         key, self.pop_limit)
+            os.unlink(over_name)
+
     def get(self, key):
         """
         Get the specific message referenced by the key.  The message is NOT
         removed from the queue.
         """
-        msg_file = self.mbox.get_file(key)
+        try:
+            # new/<key> is opened directly, mailbox lists the whole
+            # queue whenever it looks up a key it has not seen yet
+            msg_file = open(self.new_path(key), 'rb')
+        except FileNotFoundError:
+            msg_file = self.mbox.get_file(key)
 
         if not msg_file:
             return None
 
-        msg_data = msg_file.read()
+        with msg_file:
+            msg_data = msg_file.read()
+
+        return self._request(msg_data)
 
+    def _request(self, msg_data):
         try:
             return mail.MailRequest(self.dir, None, None, msg_data)
         except Exception as exc:
@@ -179,10 +405,27 @@ class Queue(object):
 
     def remove(self, key):
         """Removes the queue, but not returned."""
-        self.mbox.remove(key)
+        if self._index is not None:
+            self._index.discard(key)
+        try:
+            os.unlink(self.new_path(key))
+        except FileNotFoundError:
+            if self.shards:
+                raise KeyError(key)
+            self.mbox.remove(key)
+        try:
+            os.unlink(salmonqueueindex.metadata_path(self.dir, key, self.shards))
+        except OSError:
+            pass
 
     def __len__(self):
-        """Returns the number of messages in the queue."""
+        """
+        Returns the number of messages in the queue.  In the sharded layout
+        it is the number of indexed messages, messages pushed by other
+        processes are counted after the next keys().
+        """
+        if self.shards:
+            return len(self.index())
         return len(self.mbox)
 
     # synonym of __len__ for backwards compatibility
@@ -203,13 +446,132 @@ class Queue(object):
 
     def keys(self):
         """
-        Returns the keys in the queue.
+        Returns the keys in the queue.  In the sharded layout the queue is
+        listed into a fresh index and the keys are the oldest first.
         """
+        if self.shards:
+            return self.index(refresh=True).keys()
         return self.mbox.keys()
 
     def oversize(self, key):
         if self.pop_limit:
-            file_name = os.path.join(self.dir, "new", key)
+            file_name = self.new_path(key)
             return os.path.getsize(file_name) > self.pop_limit, file_name
         else:
             return False, None
+
+
+class SQLiteQueue(Queue):
+    """
+    Queue with the messages in an SQLite database in the queue directory
+    instead of a Maildir, see salmonsqlqueue.  It has the same API and the
+    same keys, pop() and pop_batch() return the oldest messages first.
+    """
+
+    def __init__(self, queue_dir, pop_limit=0, oversize_dir=None, commit_interval=None):
+        """
+        The pushed messages are committed together after commit_interval
+        seconds (queue_commit_interval in the global section of salmon.yaml
+        by default), 0 commits every message before push returns.  The
+        pop_limit and oversize_dir work like in Queue.
+        """
+        self.dir = queue_dir
+        self.mbox = None
+        self.shards = 0
+        self.store = salmonsqlqueue.MessageStore(
+            queue_dir, queueCommitInterval if commit_interval is None else commit_interval)
+        self.pop_limit = pop_limit
+        self._setup_oversize(oversize_dir)
+
+    def _add(self, message, metadata=None):
+        key = new_key(metadata)
+        mailbox.Maildir._count += 1
+        self.store.add(key, message, metadata)
+        return key
+
+    def pop(self):
+        batch = self.pop_batch(1)
+        return batch[0] if batch else (None, None)
+
+    def pop_batch(self, n):
+        """Pops up to n messages off the queue in one transaction."""
+        batch = []
+        while len(batch) < n:
+            rows = self.store.pop(n - len(batch))
+            if not rows:
+                break
+            for key, msg_data, metadata in rows:
+                msg = self._popped(key, msg_data)
+                if msg is not None:
+                    batch.append((key, msg))
+        return batch
+
+    def pop_key(self, key):
+        rows = self.store.pop(key=key)
+        if not rows:
+            raise KeyError(key)
+        return self._popped(key, rows[0][1])
+
+    def _popped(self, key, msg_data):
+        if self.pop_limit and len(msg_data) > self.pop_limit:
+            self._drop_oversize(key, msg_data)
+            return None
+        return self._request(msg_data)
+
+    def _drop_oversize(self, key, msg_data):
+        if self.oversize_dir:
+            logging.info("Message key %s over size limit %d, moving to %s.",
+                         key, self.pop_limit, self.oversize_dir)
+            with open(os.path.join(self.oversize_dir, key), 'wb') as f:
+                f.write(msg_data)
+        else:
+            logging.info("Message key %s over size limit %d, DELETING (set oversize_dir).",
+                         key, self.pop_limit)
+
+    def get(self, key):
+        row = self.store.get(key)
+        if row is None:
+            return None
+        return self._request(row[0])
+
+    def remove(self, key):
+        if not self.store.remove(key):
+            raise KeyError(key)
+
+    def __len__(self):
+        return len(self.store)
+
+    count = __len__
+
+    def backlog(self):
+        depth, oldest = self.store.backlog()
+        return depth, salmonqueueindex.age(oldest) if oldest else 0
+
+    def clear(self):
+        self.store.clear()
+
+    def keys(self):
+        return self.store.keys()
+
+    def oversize(self, key):
+        size = self.store.size(key)
+        if size is None:
+            raise KeyError(key)
+        return bool(self.pop_limit) and size > self.pop_limit, None
+
+
+def open_queue(queue_dir, backend=None, **kwargs):
+    """
+    Returns the queue in queue_dir, a Queue (Maildir) or an SQLiteQueue
+    depending on backend (queue_backend in the global section of
+    salmon.yaml by default).  Messages left in a Maildir queue switched
+    to sqlite are moved over by migrate_queue.py.
+    """
+    if backend is None:
+        backend = queueBackend
+    if backend == 'sqlite':
+        kwargs.pop('shards', None)
+        return SQLiteQueue(queue_dir, **kwargs)
+    if backend != 'maildir':
+        raise ValueError("unknown queue backend %r" % backend)
+    return Queue(queue_dir, **kwargs)
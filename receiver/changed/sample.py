@@ -3,6 +3,20 @@ from salmon import handlers, queue
 import logging
 import re
 
+try:
+    _queue
+except NameError:
+    # survives the reload of this module by the Router (Router.RELOAD)
+    _queue = None
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        _queue = queue.open_queue('run/queue')
+    return _queue
+
+
 @route("(to)@(host)", to=".+", host=".+")
 @stateless
 def LOG(message, to=None, host=None):
@@ -18,5 +32,5 @@ def START(message, to=None, host=None):
     Has @nolocking, but that's alright since it's just writing to a maildir.
     """
     logging.debug("MESSAGE to %s@%s added to queue.", to, host)
-    q = queue.Queue('run/queue')
-    q.push(message)
+    # stored once for all envelope recipients, see queue.Queue.push_for_recipients
+    get_queue().push_for_recipients(message)
@@ -5,25 +5,24 @@ relays, and queue processors.
 from __future__ import print_function, unicode_literals
 
 from multiprocessing.dummy import Pool
-import asyncore
 import logging
+import signal
+import socket
 from salmon import smtpd
 import smtplib
 import threading
 import time
 import yaml
-import traceback
-import re
 
 from dns import resolver
-import lmtpd
 import six
 import os
 
-from salmon import __version__, mail, queue, routing
+from salmon import __version__, mail, queue, routing, salmonheaders, salmonwatcher
 from salmon.bounce import COMBINED_STATUS_CODES, PRIMARY_STATUS_CODES, SECONDARY_STATUS_CODES
 
-lmtpd.__version__ = "Salmon Mail router LMTPD, version %s" % __version__
+QUEUE_DIR = "run/queue"
+
 smtpd.__version__ = "Salmon Mail router SMTPD, version %s" % __version__
 
 if six.PY2:
@@ -31,6 +30,18 @@ if six.PY2:
     smtpd.__version__ = smtpd.__version__.encode()
 
 
+# the asyncore based receivers, in server_asyncore (see __getattr__)
+ASYNCORE_CLASSES = ("SMTPChannel", "SMTPReceiver", "LMTPReceiver")
+
+
+def __getattr__(name):
+    # asyncore is gone from Python 3.12, the asyncio receivers don't import it
+    if name in ASYNCORE_CLASSES:
+        from salmon import server_asyncore
+        return getattr(server_asyncore, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
 def undeliverable_message(raw_message, failure_type):
     """
     Used universally in this file to shove totally screwed messages
@@ -43,6 +54,68 @@ def undeliverable_message(raw_message, failure_type):
                       "undeliverable queue with key %r", failure_type, key)
 
 
+def load_receiver_config():
+    """Reads the receiver section of salmon.yaml for the SMTP receivers."""
+    confpath = os.path.dirname(os.path.realpath(__file__)) + "/../../../../../configuration/salmon.yaml"
+    with open(confpath) as f:
+        data = yaml.load(f, Loader=yaml.FullLoader)
+    return data['receiver']
+
+
+def configure_receiver(receiver):
+    """
+    Sets up what the SMTP receivers take from the receiver section of
+    salmon.yaml: what the fast path receiver takes too (see
+    smtpd.apply_receiver_config), the DATA spool and backpressure of the
+    relay queue.  Limits missing in the file are off.
+    """
+    config = load_receiver_config()
+    smtpd.apply_receiver_config(receiver, config)
+
+    # big messages are spooled into tmp/ of the queue used by
+    # app.handlers.sample, so they can be just renamed into it
+    queue.Queue(QUEUE_DIR)
+    receiver.spool_dir = os.path.join(QUEUE_DIR, "tmp")
+    receiver.spool_threshold = config.get('spool_threshold', smtpd.SPOOL_THRESHOLD_DEFAULT)
+
+    if any(config.get(limit) for limit in ('backlog_defer_depth', 'backlog_defer_age',
+                                            'backlog_refuse_depth', 'backlog_refuse_age')):
+        # the relay drains the queue app.handlers.sample pushes into
+        receiver.backpressure = smtpd.QueueBackpressure(
+            queue.open_queue(QUEUE_DIR).backlog,
+            defer_depth=config.get('backlog_defer_depth', 0),
+            defer_age=config.get('backlog_defer_age', 0),
+            refuse_depth=config.get('backlog_refuse_depth', 0),
+            refuse_age=config.get('backlog_refuse_age', 0),
+            interval=config.get('backlog_interval', 10),
+        )
+
+
+def log_throttle_table(receiver):
+    """
+    Logs the per peer table of the receiver's throttle and the state of its
+    queue backpressure, `kill -USR1 <pid>` triggers it.
+    """
+    if receiver.backpressure is None:
+        logging.info("Queue backpressure is off.")
+    else:
+        state = receiver.backpressure.snapshot()
+        logging.info("Queue backpressure %s for %ds: %d messages queued, the oldest waits %ds, "
+                     "%d transactions deferred, %d connections refused in total.",
+                     state["state"], state["since"], state["depth"], state["age"],
+                     state["deferred"], state["refused"])
+    if receiver.throttle is None:
+        logging.info("Peer throttling is off.")
+        return
+    table = receiver.throttle.snapshot()
+    logging.info("Peer throttle: %d peers, %d connections refused, %d tarpitted in total.",
+                 len(table), receiver.throttle.refused, receiver.throttle.tarpitted)
+    for ip, peer in sorted(table.items(), key=lambda item: -item[1]["sessions"]):
+        logging.info("Peer %s: sessions %d, accepted %d, refused %d, tarpitted %d, tokens %.1f, idle %ds.",
+                     ip, peer["sessions"], peer["accepted"], peer["refused"], peer["tarpitted"],
+                     peer["tokens"], peer["idle"])
+
+
 class SMTPError(Exception):
     """
     You can raise this error when you want to abort with a SMTP error code to
@@ -163,90 +236,37 @@ class Relay(object):
         self.deliver(msg)
 
 
-class SMTPChannel(smtpd.SMTPChannel):
-    """Replaces the standard SMTPChannel with one that rejects more than one recipient"""
-
-    def smtp_RCPT(self, arg):
-        if self.__rcpttos:
-            # We can't properly handle multiple RCPT TOs in SMTPReceiver
-            #
-            # SMTP can only return one reply at the end of DATA, making it an
-            # all or nothing reply. As we can't roll back a previously
-            # successful delivery and the delivery happens without there being
-            # a queue, we can end up in a state where one recipient has
-            # received their mail and another has not (due to a 550 response
-            # raised by the handler). At that point there's no reasonable
-            # response to give the client - we haven't delivered everything,
-            # but we haven't delivered *nothing* either.
-            #
-            # So we bug out early and hope for the best. At worst mail will
-            # bounce, but nothing will be lost.
-            #
-            # Of course, if smtpd.SMTPServer or SMTPReceiver implemented a
-            # queue and bounces like you're meant too...
-            logging.warning("Client attempted to deliver mail with multiple RCPT TOs. This is not supported.")
-            self.push("451 Will not accept multiple recipients in one transaction")
-        else:
-            smtpd.SMTPChannel.smtp_RCPT(self, arg)
-
-
-class SMTPReceiver(smtpd.SMTPServer):
-    """Receives emails and hands it to the Router for further processing."""
-
-    def __init__(self, host='127.0.0.1', port=8825):
-        """
-        Initializes to bind on the given port and host/IP address.  Typically
-        in deployment you'd give 0.0.0.0 for "all internet devices" but consult
-        your operating system.
-
-        This uses smtpd.SMTPServer in the __init__, which means that you have to
-        call this far after you use python-daemonize or else daemonize will
-        close the socket.
-        """
-        self.host = host
-        self.port = port
-
-        self.credentials = None
-        self.authenabled = False
-
-        confpath = os.path.dirname(os.path.realpath(__file__)) + "/../../../../../configuration/salmon.yaml"
-        with open(confpath) as f:
-            data = yaml.load(f, Loader=yaml.FullLoader)
-        
-        self.authenabled = data['receiver']['authenabled']
-
-        if self.authenabled:
-            self.credentials = data['receiver']['credentials']
-
-        smtpd.SMTPServer.__init__(
-            self,
-            (self.host, self.port),
-            None,
-            require_authentication=self.authenabled,
-            credentials=self.credentials
-        )
-
-    def start(self):
-        """
-        Kicks everything into gear and starts listening on the port.  This
-        fires off threads and waits until they are done.
-        """
-        logging.info("SMTPReceiver started on %s:%d.", self.host, self.port)
-        self.poller = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1, 'use_poll': True})
-        self.poller.start()
-
+class MessageReceiver(object):
+    """process_message of the SMTP receivers, it hands the emails to the Router."""
 
     def process_message(self, Peer, From, To, Data, User):
         """
         Called by smtpd.SMTPServer when there's a message received.
+        Everything known about the SMTP session travels with the message
+        as message.metadata and is stored next to it by the queue.
         """
-        queue.PEER = Peer
-        queue.USER = User or "none"
+        metadata = {
+            "peer": Peer[0],
+            "port": Peer[1],
+            "user": User or "none",
+            "sensor": self.config["sensorname"],
+            "mail_from": From,
+            "recipients": To,
+            "received": time.time(),
+        }
 
         try:
-            Data = self.investigate_bcc(To, Data)
             logging.debug("Message received from Peer: %r, From: %r, to To %r.", Peer, From, To)
-            routing.Router.deliver(mail.MailRequest(Peer, From, To, Data))
+            if isinstance(Data, smtpd.SpooledData):
+                # only the header block is parsed, the body stays in the spool file
+                Data.headers = salmonheaders.investigate_bcc(To, Data.headers)
+                message = mail.MailRequest(Peer, From, To, Data.headers)
+                message.Data = Data
+            else:
+                Data = salmonheaders.investigate_bcc(To, Data)
+                message = mail.MailRequest(Peer, From, To, Data)
+            message.metadata = metadata
+            routing.Router.deliver(message)
         except SMTPError as err:
             # looks like they want to return an error, so send it out
             return str(err)
@@ -254,85 +274,151 @@ class SMTPReceiver(smtpd.SMTPServer):
             logging.exception("Exception while processing message from Peer: %r, From: %r, to To %r.",
                               Peer, From, To)
             undeliverable_message(Data, "Error in message %r:%r:%r, look in logs." % (Peer, From, To))
-
-    def investigate_bcc(self, To, Data):
-        bcc = False
-        to_address = []
-        for address in To:
-            result = re.search(bytes(address, encoding="utf-8"), Data)
-            if result is None:
-                bcc = True
-            else:
-                to_address.append(address)
-        if bcc:
-            bcc_list = [x for x in To if x not in to_address]
-            bcc_str = ','.join(bcc_list)
-            Data = Data.replace(b"\nDate:", b"\nBcc: " + bytes(bcc_str, encoding="utf-8") + b"\nDate:")
-        return Data
-
-    def close(self):
-        """Doesn't do anything except log who called this, since nobody should.  Ever."""
-        if six.PY3:
-            trace = traceback.format_exc(chain=False)
-        else:
-            trace = traceback.format_exc()
-        logging.error(trace)
+        finally:
+            if isinstance(Data, smtpd.SpooledData):
+                # nobody queued it
+                Data.discard()
 
 
-class LMTPReceiver(lmtpd.LMTPServer):
-    """Receives emails and hands it to the Router for further processing."""
+class AsyncSMTPReceiver(MessageReceiver, smtpd.AsyncSMTPServer):
+    """
+    Same as SMTPReceiver, but the SMTP sessions are served from an asyncio
+    event loop (smtpd.AsyncSMTPServer) instead of asyncore, which copes much
+    better with many concurrent and slow clients.
+    """
 
-    def __init__(self, host='127.0.0.1', port=8824, socket=None):
+    def __init__(self, host='127.0.0.1', port=8825, reuse_port=False):
         """
-        Initializes to bind on the given port and host/IP address. Remember that
-        LMTP isn't for use over a WAN, so bind it to either a LAN address or
-        localhost. If socket is not None, it will be assumed to be a path name
-        and a UNIX socket will be set up instead.
-
-        This uses lmtpd.LMTPServer in the __init__, which means that you have to
-        call this far after you use python-daemonize or else daemonize will
-        close the socket.
+        Binds the listening socket right away, so the same daemonize caveat
+        as for SMTPReceiver applies.  reuse_port is used by ReceiverWorkers.
         """
-        if socket is None:
-            self.socket = "%s:%d" % (host, port)
-            lmtpd.LMTPServer.__init__(self, (host, port))
-        else:
-            self.socket = socket
-            lmtpd.LMTPServer.__init__(self, socket)
+        self.host = host
+        self.port = port
+
+        configure_receiver(self)
+
+        smtpd.AsyncSMTPServer.__init__(
+            self,
+            (self.host, self.port),
+            None,
+            require_authentication=self.authenabled,
+            credentials=self.credentials,
+            data_size_limit=self.data_size_limit,
+            reuse_port=reuse_port
+        )
 
     def start(self):
         """
-        Kicks everything into gear and starts listening on the port.  This
-        fires off threads and waits until they are done.
+        Kicks everything into gear and starts listening on the port.  The
+        event loop runs in its own thread, like the asyncore loop does.
         """
-        logging.info("LMTPReceiver started on %s.", self.socket)
-        self.poller = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1, 'use_poll': True})
+        logging.info("AsyncSMTPReceiver started on %s:%d.", self.host, self.port)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: log_throttle_table(self))
+        self.poller = threading.Thread(target=self.serve_forever)
         self.poller.start()
 
-    def process_message(self, Peer, From, To, Data, **kwargs):
+
+
+class ReceiverWorkers(object):
+    """
+    Runs several AsyncSMTPReceiver processes which all bind the same host and
+    port with SO_REUSEPORT.  The kernel spreads incoming connections between
+    them, so SMTP parsing and queue writes use all cores of the sensor.  All
+    workers push into the same Maildir queue (the queue file names contain
+    the pid, so they never clash).
+
+    The parent process (the one in the salmon pid file) only supervises: it
+    starts a new worker when one dies and passes SIGHUP/SIGTERM from
+    `salmon stop` on to the workers.
+    """
+    respawn_delay = 1
+
+    def __init__(self, host='127.0.0.1', port=8825, workers=2):
         """
-        Called by lmtpd.LMTPServer when there's a message received.
+        Checks that the address can be bound, but doesn't keep the socket,
+        every worker binds its own after the fork.
         """
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.children = {}
+        self.stopping = False
 
+        sock = socket.socket(socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][0])
         try:
-            logging.debug("Message received from Peer: %r, From: %r, to To %r.", Peer, From, To)
-            routing.Router.deliver(mail.MailRequest(Peer, From, To, Data))
-        except SMTPError as err:
-            # looks like they want to return an error, so send it out
-            # and yes, you should still use SMTPError in your handlers
-            return str(err)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((host, port))
+        finally:
+            sock.close()
+
+    def start(self):
+        """
+        Forks the workers and supervises them.  Unlike the other receivers
+        this blocks until the workers are stopped.
+        """
+        logging.info("ReceiverWorkers starting %d workers on %s:%d.", self.workers, self.host, self.port)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+        # every worker logs its own throttle table
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.signal_workers(signal.SIGUSR1))
+
+        for i in range(self.workers):
+            self.spawn()
+        self.supervise()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker()
+        self.children[pid] = time.time()
+
+    def run_worker(self):
+        """Body of the forked worker process, it never returns."""
+        status = 0
+        try:
+            for signum in (signal.SIGHUP, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            receiver = AsyncSMTPReceiver(self.host, self.port, reuse_port=True)
+            # finish the message being processed and stop the loop
+            signal.signal(signal.SIGTERM, lambda signum, frame: receiver.stop())
+            signal.signal(signal.SIGUSR1, lambda signum, frame: log_throttle_table(receiver))
+            logging.info("Receiver worker %d listening on %s:%d.", os.getpid(), self.host, self.port)
+            receiver.serve_forever()
         except Exception:
-            logging.exception("Exception while processing message from Peer: %r, From: %r, to To %r.",
-                              Peer, From, To)
-            undeliverable_message(Data, "Error in message %r:%r:%r, look in logs." % (Peer, From, To))
+            logging.exception("Receiver worker %d crashed.", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
 
-    def close(self):
-        """Doesn't do anything except log who called this, since nobody should.  Ever."""
-        if six.PY3:
-            trace = traceback.format_exc(chain=False)
-        else:
-            trace = traceback.format_exc()
-        logging.error(trace)
+    def supervise(self):
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+
+            logging.error("Receiver worker %d exited with status %d, starting a new one.", pid, status)
+            if time.time() - started < self.respawn_delay:
+                # don't fork in a tight loop when the workers can't start at all
+                time.sleep(self.respawn_delay)
+            self.spawn()
+
+        logging.info("ReceiverWorkers stopped.")
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    def signal_workers(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
 
 
 class QueueReceiver(object):
@@ -342,47 +428,55 @@ class QueueReceiver(object):
     same way otherwise.
     """
 
-    def __init__(self, queue_dir, sleep=10, size_limit=0, oversize_dir=None, workers=10):
+    def __init__(self, queue_dir, sleep=10, size_limit=0, oversize_dir=None, workers=10, rescan=60):
         """
         The router should be fully configured and ready to work, the queue_dir
         can be a fully qualified path or relative. The option workers dictates
         how many threads are started to process messages. Consider adding
         ``@nolocking`` to your handlers if you are able to.
+        New messages are reported by inotify, the whole queue is listed only
+        after rescan seconds without any (sleep is used without inotify).
         """
-        self.queue = queue.Queue(queue_dir, pop_limit=size_limit,
-                                 oversize_dir=oversize_dir)
+        self.queue = queue.open_queue(queue_dir, pop_limit=size_limit,
+                                      oversize_dir=oversize_dir)
         self.sleep = sleep
+        self.rescan = rescan
 
         # Pool is from multiprocess.dummy which uses threads rather than processes
         self.workers = Pool(workers)
 
     def start(self, one_shot=False):
         """
-        Start simply loops indefinitely sleeping and pulling messages
-        off for processing when they are available.
+        Start pulls off the messages already in the queue and then waits
+        for new ones with salmonwatcher.QueueWatcher.
 
         If you give one_shot=True it will stop once it has exhausted the queue
         """
 
         logging.info("Queue receiver started on queue dir %s", self.queue.dir)
-        logging.debug("Sleeping for %d seconds...", self.sleep)
-
-        # if there are no messages left in the maildir and this a one-shot, the
-        # while loop terminates
-        while not (len(self.queue) == 0 and one_shot):
-            # if there's nothing in the queue, take a break
-            if len(self.queue) == 0:
-                time.sleep(self.sleep)
-                continue
-
-            try:
-                key, msg = self.queue.pop()
-            except KeyError:
-                logging.debug("Could not find message in Queue")
-                continue
 
-            logging.debug("Pulled message with key: %r off", key)
-            self.workers.apply_async(self.process_message, args=(msg,))
+        # the watch is set up before the first listing, so nothing is missed in between
+        watcher = None
+        if not one_shot:
+            watcher = salmonwatcher.QueueWatcher(self.queue, rescan=self.rescan, sleep=self.sleep)
+        keys = self.queue.keys()
+
+        while True:
+            for key in keys:
+                try:
+                    msg = self.queue.pop_key(key)
+                except KeyError:
+                    logging.debug("Could not find message in Queue")
+                    continue
+                if msg is None:
+                    continue
+
+                logging.debug("Pulled message with key: %r off", key)
+                self.workers.apply_async(self.process_message, args=(msg,))
+
+            if one_shot:
+                break
+            keys = watcher.keys()
 
         self.workers.close()
         self.workers.join()
@@ -0,0 +1,153 @@
+"""
+The asyncore based receivers of salmon.server: SMTPReceiver for frontend:
+asyncore in salmon.yaml and LMTPReceiver.  asyncore and asynchat are gone from
+Python 3.12, so they are apart from salmon.server and imported on first use,
+the asyncio receivers (AsyncSMTPReceiver, ReceiverWorkers) don't need them.
+"""
+
+import asyncore
+import logging
+import signal
+import threading
+import traceback
+
+import lmtpd
+import six
+
+from salmon import __version__, mail, routing, smtpd_asyncore
+from salmon.server import (MessageReceiver, SMTPError, configure_receiver, log_throttle_table,
+                           undeliverable_message)
+
+lmtpd.__version__ = "Salmon Mail router LMTPD, version %s" % __version__
+
+
+class SMTPChannel(smtpd_asyncore.SMTPChannel):
+    """Replaces the standard SMTPChannel with one that rejects more than one recipient"""
+
+    def smtp_RCPT(self, arg):
+        if self.__rcpttos:
+            # We can't properly handle multiple RCPT TOs in SMTPReceiver
+            #
+            # SMTP can only return one reply at the end of DATA, making it an
+            # all or nothing reply. As we can't roll back a previously
+            # successful delivery and the delivery happens without there being
+            # a queue, we can end up in a state where one recipient has
+            # received their mail and another has not (due to a 550 response
+            # raised by the handler). At that point there's no reasonable
+            # response to give the client - we haven't delivered everything,
+            # but we haven't delivered *nothing* either.
+            #
+            # So we bug out early and hope for the best. At worst mail will
+            # bounce, but nothing will be lost.
+            #
+            # Of course, if smtpd.SMTPServer or SMTPReceiver implemented a
+            # queue and bounces like you're meant too...
+            logging.warning("Client attempted to deliver mail with multiple RCPT TOs. This is not supported.")
+            self.push("451 Will not accept multiple recipients in one transaction")
+        else:
+            smtpd_asyncore.SMTPChannel.smtp_RCPT(self, arg)
+
+
+class SMTPReceiver(MessageReceiver, smtpd_asyncore.SMTPServer):
+    """Receives emails and hands it to the Router for further processing."""
+
+    def __init__(self, host='127.0.0.1', port=8825):
+        """
+        Initializes to bind on the given port and host/IP address.  Typically
+        in deployment you'd give 0.0.0.0 for "all internet devices" but consult
+        your operating system.
+
+        This uses smtpd.SMTPServer in the __init__, which means that you have to
+        call this far after you use python-daemonize or else daemonize will
+        close the socket.
+        """
+        self.host = host
+        self.port = port
+
+        configure_receiver(self)
+
+        smtpd_asyncore.SMTPServer.__init__(
+            self,
+            (self.host, self.port),
+            None,
+            require_authentication=self.authenabled,
+            credentials=self.credentials,
+            data_size_limit=self.data_size_limit
+        )
+
+    def start(self):
+        """
+        Kicks everything into gear and starts listening on the port.  This
+        fires off threads and waits until they are done.
+        """
+        logging.info("SMTPReceiver started on %s:%d.", self.host, self.port)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: log_throttle_table(self))
+        if self.backpressure is not None:
+            self.backpressure.start()
+        self.poller = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1, 'use_poll': True})
+        self.poller.start()
+
+
+    def close(self):
+        """Doesn't do anything except log who called this, since nobody should.  Ever."""
+        if six.PY3:
+            trace = traceback.format_exc(chain=False)
+        else:
+            trace = traceback.format_exc()
+        logging.error(trace)
+
+
+class LMTPReceiver(lmtpd.LMTPServer):
+    """Receives emails and hands it to the Router for further processing."""
+
+    def __init__(self, host='127.0.0.1', port=8824, socket=None):
+        """
+        Initializes to bind on the given port and host/IP address. Remember that
+        LMTP isn't for use over a WAN, so bind it to either a LAN address or
+        localhost. If socket is not None, it will be assumed to be a path name
+        and a UNIX socket will be set up instead.
+
+        This uses lmtpd.LMTPServer in the __init__, which means that you have to
+        call this far after you use python-daemonize or else daemonize will
+        close the socket.
+        """
+        if socket is None:
+            self.socket = "%s:%d" % (host, port)
+            lmtpd.LMTPServer.__init__(self, (host, port))
+        else:
+            self.socket = socket
+            lmtpd.LMTPServer.__init__(self, socket)
+
+    def start(self):
+        """
+        Kicks everything into gear and starts listening on the port.  This
+        fires off threads and waits until they are done.
+        """
+        logging.info("LMTPReceiver started on %s.", self.socket)
+        self.poller = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1, 'use_poll': True})
+        self.poller.start()
+
+    def process_message(self, Peer, From, To, Data, **kwargs):
+        """
+        Called by lmtpd.LMTPServer when there's a message received.
+        """
+
+        try:
+            logging.debug("Message received from Peer: %r, From: %r, to To %r.", Peer, From, To)
+            routing.Router.deliver(mail.MailRequest(Peer, From, To, Data))
+        except SMTPError as err:
+            # looks like they want to return an error, so send it out
+            # and yes, you should still use SMTPError in your handlers
+            return str(err)
+        except Exception:
+            logging.exception("Exception while processing message from Peer: %r, From: %r, to To %r.",
+                              Peer, From, To)
+            undeliverable_message(Data, "Error in message %r:%r:%r, look in logs." % (Peer, From, To))
+
+    def close(self):
+        """Doesn't do anything except log who called this, since nobody should.  Ever."""
+        if six.PY3:
+            trace = traceback.format_exc(chain=False)
+        else:
+            trace = traceback.format_exc()
+        logging.error(trace)
@@ -37,11 +37,16 @@ and if remoteport is not given, then 25 is used.
 #
 # This file implements the minimal SMTP protocol as defined in RFC 5321.  It
 # has a hierarchy of classes which implement the backend functionality for the
-# smtpd.  A number of classes are provided:
+# smtpd.  A number of classes are provided (the asyncore based ones live in
+# smtpd_asyncore, they are imported from there on first use):
 #
 #   SMTPServer - the base class for the backend.  Raises NotImplementedError
 #   if you try to use it.
 #
+#   AsyncSMTPServer - the same backend API served from an asyncio event loop
+#   instead of asyncore.  Its channels share the protocol state machine
+#   (SMTPSession) with the asyncore SMTPChannel.
+#
 #   DebuggingServer - simply prints each message it receives on stdout.
 #
 #   PureProxy - Proxies all messages to a real smtpd which does final
@@ -68,14 +73,16 @@ and if remoteport is not given, then 25 is used.
 
 import sys
 import os
-import errno
 import getopt
+import io
+import shutil
+import tempfile
 import time
 import socket
-import asyncore
-import asynchat
+import threading
+import asyncio
 import collections
-from warnings import warn
+import concurrent.futures
 from email._header_value_parser import get_addr_spec, get_angle_addr
 
 import logging
@@ -84,9 +91,11 @@ import inspect
 import base64
 
 __all__ = [
-    "SMTPChannel", "SMTPServer", "DebuggingServer", "PureProxy",
-    "MailmanProxy",
+    "SMTPSession", "AsyncSMTPChannel", "AsyncSMTPServer",
+    "DataSpool", "SpooledData", "PeerThrottle", "QueueBackpressure",
 ]
+# the asyncore based classes, in smtpd_asyncore (see __getattr__)
+ASYNCORE_CLASSES = ("SMTPChannel", "SMTPServer", "DebuggingServer", "PureProxy", "MailmanProxy")
 
 program = sys.argv[0]
 __version__ = 'Python SMTP proxy version 0.3'
@@ -101,6 +110,52 @@ DEBUGSTREAM = Devnull()
 NEWLINE = '\n'
 COMMASPACE = ', '
 DATA_SIZE_DEFAULT = 33554432
+SPOOL_THRESHOLD_DEFAULT = 1048576
+REFUSED_REPLY = b'421 4.7.0 Too many connections from your host, try again later\r\n'
+BUSY_REPLY = b'421 4.3.2 System busy, try again later\r\n'
+DEFERRED_REPLY = '451 4.3.2 System busy, try again later'
+
+
+def __getattr__(name):
+    # asyncore and asynchat are gone from Python 3.12, they are imported
+    # only when the asyncore classes are used
+    if name in ASYNCORE_CLASSES:
+        from salmon import smtpd_asyncore
+        return getattr(smtpd_asyncore, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def find_prefix_at_end(haystack, needle):
+    """Returns the length of the longest end of haystack which is a
+    beginning of needle, like asynchat.find_prefix_at_end."""
+    l = len(needle) - 1
+    while l and not haystack.endswith(needle[:l]):
+        l -= 1
+    return l
+
+
+def apply_receiver_config(server, config):
+    """
+    Sets up what both SMTP receivers (salmon.server and salmonfastpath) take
+    from the receiver section of salmon.yaml: AUTH, the message size limit,
+    per peer throttling and the timeouts.  Limits missing in the section are
+    off.  It's called before the server's __init__, which gets
+    server.authenabled, server.credentials and server.data_size_limit.
+    """
+    server.config = config
+    server.authenabled = config['authenabled']
+    server.credentials = config['credentials'] if server.authenabled else None
+    # advertised with SIZE, bigger transactions are refused already at MAIL FROM
+    server.data_size_limit = config.get('max_message_size', DATA_SIZE_DEFAULT)
+    if config.get('peer_max_sessions') or config.get('peer_rate'):
+        server.throttle = PeerThrottle(
+            rate=config.get('peer_rate', 0),
+            burst=config.get('peer_burst', 1),
+            max_sessions=config.get('peer_max_sessions', 0),
+            tarpit_delay=config.get('tarpit_delay', 0),
+        )
+    server.idle_timeout = config.get('idle_timeout', 0)
+    server.session_timeout = config.get('session_timeout', 0)
 
 
 def usage(code, msg=''):
@@ -110,9 +165,370 @@ def usage(code, msg=''):
     sys.exit(code)
 
 
-class SMTPChannel(asynchat.async_chat):
+class SpooledData(object):
+    """
+    DATA of a message which DataSpool moved into a file.  Only the header
+    block is kept in memory as `headers` (it may be changed, e.g. by the BCC
+    investigation); the rest stays on disk until save() moves the file to its
+    final place, so large messages never have to be held in memory.
+    """
+    header_read_size = 65536
+    max_header_size = 1048576
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        head = b''
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(self.header_read_size)
+                head += chunk
+                end = head.find(b'\n\n')
+                if end != -1 or not chunk or len(head) >= self.max_header_size:
+                    break
+        if end != -1:
+            self._header_end = end + 2
+        else:
+            self._header_end = len(head)
+        self.headers = self._original_headers = head[:self._header_end]
+
+    def __len__(self):
+        return self.size - self._header_end + len(self.headers)
+
+    def __repr__(self):
+        return "<SpooledData %s (%d bytes)>" % (self.path, len(self))
+
+    def read(self):
+        """Returns the whole message as bytes."""
+        with open(self.path, 'rb') as f:
+            f.seek(self._header_end)
+            return self.headers + f.read()
+
+    def save(self, dest):
+        """
+        Moves the message into dest, the headers are rewritten only if they
+        changed.  The file is synced to disk before, like mailbox._sync_close
+        does for the messages which Maildir.add writes.
+        """
+        if self.headers == self._original_headers:
+            with open(self.path, 'rb') as src:
+                os.fsync(src.fileno())
+            os.rename(self.path, dest)
+        else:
+            with open(self.path, 'rb') as src, open(dest, 'wb') as dst:
+                dst.write(self.headers)
+                src.seek(self._header_end)
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.unlink(self.path)
+        self.path = None
+
+    def discard(self):
+        """Removes the spool file unless it was already saved."""
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class DataSpool(object):
+    """
+    Collects DATA of one message as it arrives.  The dot-unstuffing and CRLF
+    to LF conversion which found_terminator does on the joined lines are done
+    here chunk by chunk, and once the message grows over `threshold` bytes it
+    is written into a temporary file in `directory` instead of memory.
+    finish() returns bytes for small messages and SpooledData for large ones.
+    BDAT chunks are not dot-stuffed, they are written with unstuff=False.
+    """
+
+    def __init__(self, directory, threshold=SPOOL_THRESHOLD_DEFAULT, unstuff=True):
+        self.directory = directory
+        self.threshold = threshold
+        self.unstuff = unstuff
+        self.size = 0
+        self.path = None
+        self.file = io.BytesIO()
+        self._line_start = True
+        self._pending_cr = False
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        if self._pending_cr:
+            # the previous chunk ended in the middle of CRLF
+            self._pending_cr = False
+            if chunk[:1] == b'\n':
+                self._write(b'\n')
+                self._line_start = True
+                chunk = chunk[1:]
+            else:
+                self._write(b'\r')
+                self._line_start = False
+        if chunk.endswith(b'\r'):
+            self._pending_cr = True
+            chunk = chunk[:-1]
+        if not chunk:
+            return
+        lines = chunk.split(b'\r\n')
+        line_start = len(lines) > 1 and not lines[-1]
+        for i, line in enumerate(lines):
+            # Remove extraneous carriage returns and de-transparency according
+            # to RFC 5321, Section 4.5.2.
+            if self.unstuff and line[:1] == b'.' and (i or self._line_start):
+                lines[i] = line[1:]
+        self._write(b'\n'.join(lines))
+        self._line_start = line_start
+
+    def _write(self, data):
+        self.size += len(data)
+        self.file.write(data)
+        if self.path is None and self.size > self.threshold:
+            fd, self.path = tempfile.mkstemp(prefix='spool.', dir=self.directory)
+            spool = os.fdopen(fd, 'wb')
+            spool.write(self.file.getvalue())
+            self.file = spool
+
+    def finish(self):
+        if self._pending_cr:
+            self._pending_cr = False
+            self._write(b'\r')
+        if self.path is None:
+            return self.file.getvalue()
+        self.file.close()
+        return SpooledData(self.path, self.size)
+
+    def discard(self):
+        self.file.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class PeerThrottle(object):
+    """
+    Admission control of SMTP connections per peer IP address.
+
+    Every peer has a token bucket of new connections (`rate` tokens per
+    second, at most `burst`) and a cap of concurrent sessions.  A peer over
+    the cap is refused.  A peer out of tokens is either tarpitted (let in,
+    but the greeting is delayed by `tarpit_delay` seconds) or refused when
+    tarpitting is off.  Entries of peers without sessions expire after
+    `expire` seconds, so the table doesn't grow forever.  A limit set to 0
+    is turned off.
+    """
+
+    def __init__(self, rate=0, burst=0, max_sessions=0, tarpit_delay=0, expire=600,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_sessions = max_sessions
+        self.tarpit_delay = tarpit_delay
+        self.expire = expire
+        self.clock = clock
+        self.peers = {}
+        self.refused = 0
+        self.tarpitted = 0
+        self._next_expire = clock() + expire
+
+    def admit(self, ip):
+        """
+        Accounts a new connection from ip and returns a tuple
+        (allowed, greeting_delay).  Every allowed connection has to be
+        followed by release(ip) when it's closed.
+        """
+        now = self.clock()
+        if now >= self._next_expire:
+            self.expire_peers(now)
+
+        peer = self.peers.get(ip)
+        if peer is None:
+            peer = self.peers[ip] = {
+                "sessions": 0,
+                "tokens": self.burst,
+                "last_seen": now,
+                "accepted": 0,
+                "refused": 0,
+                "tarpitted": 0,
+            }
+        elif self.rate:
+            peer["tokens"] = min(self.burst, peer["tokens"] + (now - peer["last_seen"]) * self.rate)
+        peer["last_seen"] = now
+
+        if self.max_sessions and peer["sessions"] >= self.max_sessions:
+            return self._refuse(peer)
+
+        delay = 0
+        if self.rate:
+            if peer["tokens"] >= 1:
+                peer["tokens"] -= 1
+            elif self.tarpit_delay:
+                delay = self.tarpit_delay
+                peer["tarpitted"] += 1
+                self.tarpitted += 1
+            else:
+                return self._refuse(peer)
+
+        peer["sessions"] += 1
+        peer["accepted"] += 1
+        return True, delay
+
+    def _refuse(self, peer):
+        peer["refused"] += 1
+        self.refused += 1
+        return False, 0
+
+    def release(self, ip):
+        peer = self.peers.get(ip)
+        if peer is not None and peer["sessions"] > 0:
+            peer["sessions"] -= 1
+            peer["last_seen"] = self.clock()
+
+    def expire_peers(self, now=None):
+        now = self.clock() if now is None else now
+        for ip in [ip for ip, peer in self.peers.items()
+                   if not peer["sessions"] and now - peer["last_seen"] > self.expire]:
+            del self.peers[ip]
+        self._next_expire = now + self.expire
+
+    def snapshot(self):
+        """Returns a copy of the table: {ip: {sessions, tokens, accepted, refused, tarpitted, idle}}."""
+        now = self.clock()
+        table = {}
+        for ip, peer in list(self.peers.items()):
+            entry = dict(peer)
+            entry["idle"] = now - entry.pop("last_seen")
+            table[ip] = entry
+        return table
+
+
+class QueueBackpressure(object):
+    """
+    Admission control driven by the backlog of the queue the received
+    messages go to, so the receiver doesn't fill the disk when the relay
+    falls behind.  `measure` returns the number of messages waiting in the
+    queue and the age of the oldest one in seconds.  It is called every
+    `interval` seconds from the thread started by start(), the sessions only
+    read the last state.
+
+    With more than `defer_depth` messages, or the oldest one waiting longer
+    than `defer_age` seconds, new transactions are deferred with 451 at MAIL
+    FROM.  Over `refuse_depth` or `refuse_age` new connections are refused
+    with 421 right after connect.  Senders retry later, most spam bots
+    don't.  The state goes back as soon as the backlog is under the limits.
+    A limit set to 0 is turned off.
+    """
+    OK = "ok"
+    DEFER = "defer"
+    REFUSE = "refuse"
+
+    def __init__(self, measure, defer_depth=0, defer_age=0, refuse_depth=0, refuse_age=0,
+                 interval=10, report=60, clock=time.monotonic):
+        self.measure = measure
+        self.defer_depth = defer_depth
+        self.defer_age = defer_age
+        self.refuse_depth = refuse_depth
+        self.refuse_age = refuse_age
+        self.interval = interval
+        self.report = report
+        self.clock = clock
+        self.state = self.OK
+        self.depth = 0
+        self.age = 0
+        self.deferred = 0
+        self.refused = 0
+        self._since = clock()
+        self._reported = self._since
+        self._thread = None
+
+    def start(self):
+        """Measures the backlog right away and then every interval seconds."""
+        if self._thread is None:
+            self.update()
+            self._thread = threading.Thread(target=self._run, name="backpressure", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.update()
+
+    def update(self):
+        """Measures the backlog and switches the state when it crossed a limit."""
+        try:
+            depth, age = self.measure()
+        except Exception:
+            logging.exception("Measuring the queue backlog failed, backpressure state stays %s.", self.state)
+            return
+        self.depth, self.age = depth, age
+
+        state = self.OK
+        if self._over(depth, age, self.refuse_depth, self.refuse_age):
+            state = self.REFUSE
+        elif self._over(depth, age, self.defer_depth, self.defer_age):
+            state = self.DEFER
+
+        now = self.clock()
+        if state != self.state:
+            log = logging.info if state == self.OK else logging.warning
+            log("Queue backpressure %s -> %s after %ds: %d messages queued, the oldest waits %ds "
+                "(defer at %d messages/%ds, refuse at %d messages/%ds), %d deferred, %d refused so far.",
+                self.state, state, now - self._since, depth, age, self.defer_depth, self.defer_age,
+                self.refuse_depth, self.refuse_age, self.deferred, self.refused)
+            self.state = state
+            self._since = self._reported = now
+        elif state != self.OK and self.report and now - self._reported >= self.report:
+            logging.warning("Queue backpressure still %s: %d messages queued, the oldest waits %ds, "
+                            "%d deferred, %d refused so far.",
+                            state, depth, age, self.deferred, self.refused)
+            self._reported = now
+
+    @staticmethod
+    def _over(depth, age, max_depth, max_age):
+        return bool(max_depth and depth >= max_depth or max_age and age >= max_age)
+
+    def admit(self):
+        """Returns False when a new connection has to be refused."""
+        if self.state == self.REFUSE:
+            self.refused += 1
+            return False
+        return True
+
+    def accept_mail(self):
+        """Returns False when a new transaction has to be deferred."""
+        if self.state != self.OK:
+            self.deferred += 1
+            return False
+        return True
+
+    def snapshot(self):
+        """Returns the state, the last measured backlog and the counters as a dict."""
+        return {
+            "state": self.state,
+            "depth": self.depth,
+            "age": self.age,
+            "since": self.clock() - self._since,
+            "deferred": self.deferred,
+            "refused": self.refused,
+        }
+
+
+class SMTPSession(object):
+    """
+    The SMTP protocol state machine shared by SMTPChannel and
+    AsyncSMTPChannel.  It knows nothing about sockets; subclasses provide
+    push(), set_terminator() and close_when_done() and feed received bytes
+    through collect_incoming_data() and found_terminator() the same way
+    asynchat does.
+    """
     COMMAND = 0
     DATA = 1
+    BDAT = 2
 
     command_size_limit = 512
     command_size_limits = collections.defaultdict(lambda x=command_size_limit: x)
@@ -124,9 +540,9 @@ class SMTPChannel(asynchat.async_chat):
         except ValueError:
             return self.command_size_limit
 
-    def __init__(self, server, conn, addr, data_size_limit=DATA_SIZE_DEFAULT,
-                 map=None, enable_SMTPUTF8=False, decode_data=False, require_authentication=False, credential_validator=None):
-        asynchat.async_chat.__init__(self, conn, map=map)
+    def _init_session(self, server, addr, data_size_limit=DATA_SIZE_DEFAULT,
+                      enable_SMTPUTF8=False, decode_data=False, require_authentication=False,
+                      credential_validator=None):
         self.require_authentication = require_authentication
         self.authenticating = False
         self.authenticated = False
@@ -136,8 +552,8 @@ class SMTPChannel(asynchat.async_chat):
         self.authenticated_user = None
 
         self.smtp_server = server
-        self.conn = conn
         self.addr = addr
+        self.data_spool = None
         self.data_size_limit = data_size_limit
         self.enable_SMTPUTF8 = enable_SMTPUTF8
         self._decode_data = decode_data
@@ -159,18 +575,7 @@ class SMTPChannel(asynchat.async_chat):
         self.extended_smtp = False
         self.command_size_limits.clear()
         self.fqdn = socket.getfqdn()
-        try:
-            self.peer = conn.getpeername()
-        except OSError as err:
-            # a race condition  may occur if the other end is closing
-            # before we can get the peername
-            self.close()
-            if err.args[0] != errno.ENOTCONN:
-                raise
-            return
-        print('Peer:', repr(self.peer), file=DEBUGSTREAM)
-        self.push('220 %s %s' % (self.fqdn, __version__))
-        
+
     def _set_post_data_state(self):
         """Reset state variables to their post-DATA state."""
         self.smtp_state = self.COMMAND
@@ -178,6 +583,15 @@ class SMTPChannel(asynchat.async_chat):
         self.rcpttos = []
         self.require_SMTPUTF8 = False
         self.num_bytes = 0
+        # CHUNKING (RFC 3030): bytes announced by BDAT so far in this
+        # transaction, whether the last chunk was announced and the reply
+        # for the chunk being read when the transaction already failed
+        self.chunking = False
+        self.chunk_bytes = 0
+        self.chunk_size = 0
+        self.chunk_last = False
+        self.chunk_error = None
+        self.discard_spool()
         self.set_terminator(b'\r\n')
 
     def _set_rset_state(self):
@@ -187,133 +601,6 @@ class SMTPChannel(asynchat.async_chat):
         self.received_lines = []
 
 
-    # properties for backwards-compatibility
-    @property
-    def __server(self):
-        warn("Access to __server attribute on SMTPChannel is deprecated, "
-            "use 'smtp_server' instead", DeprecationWarning, 2)
-        return self.smtp_server
-    @__server.setter
-    def __server(self, value):
-        warn("Setting __server attribute on SMTPChannel is deprecated, "
-            "set 'smtp_server' instead", DeprecationWarning, 2)
-        self.smtp_server = value
-
-    @property
-    def __line(self):
-        warn("Access to __line attribute on SMTPChannel is deprecated, "
-            "use 'received_lines' instead", DeprecationWarning, 2)
-        return self.received_lines
-    @__line.setter
-    def __line(self, value):
-        warn("Setting __line attribute on SMTPChannel is deprecated, "
-            "set 'received_lines' instead", DeprecationWarning, 2)
-        self.received_lines = value
-
-    @property
-    def __state(self):
-        warn("Access to __state attribute on SMTPChannel is deprecated, "
-            "use 'smtp_state' instead", DeprecationWarning, 2)
-        return self.smtp_state
-    @__state.setter
-    def __state(self, value):
-        warn("Setting __state attribute on SMTPChannel is deprecated, "
-            "set 'smtp_state' instead", DeprecationWarning, 2)
-        self.smtp_state = value
-
-    @property
-    def __greeting(self):
-        warn("Access to __greeting attribute on SMTPChannel is deprecated, "
-            "use 'seen_greeting' instead", DeprecationWarning, 2)
-        return self.seen_greeting
-    @__greeting.setter
-    def __greeting(self, value):
-        warn("Setting __greeting attribute on SMTPChannel is deprecated, "
-            "set 'seen_greeting' instead", DeprecationWarning, 2)
-        self.seen_greeting = value
-
-    @property
-    def __mailfrom(self):
-        warn("Access to __mailfrom attribute on SMTPChannel is deprecated, "
-            "use 'mailfrom' instead", DeprecationWarning, 2)
-        return self.mailfrom
-    @__mailfrom.setter
-    def __mailfrom(self, value):
-        warn("Setting __mailfrom attribute on SMTPChannel is deprecated, "
-            "set 'mailfrom' instead", DeprecationWarning, 2)
-        self.mailfrom = value
-
-    @property
-    def __rcpttos(self):
-        warn("Access to __rcpttos attribute on SMTPChannel is deprecated, "
-            "use 'rcpttos' instead", DeprecationWarning, 2)
-        return self.rcpttos
-    @__rcpttos.setter
-    def __rcpttos(self, value):
-        warn("Setting __rcpttos attribute on SMTPChannel is deprecated, "
-            "set 'rcpttos' instead", DeprecationWarning, 2)
-        self.rcpttos = value
-
-    @property
-    def __data(self):
-        warn("Access to __data attribute on SMTPChannel is deprecated, "
-            "use 'received_data' instead", DeprecationWarning, 2)
-        return self.received_data
-    @__data.setter
-    def __data(self, value):
-        warn("Setting __data attribute on SMTPChannel is deprecated, "
-            "set 'received_data' instead", DeprecationWarning, 2)
-        self.received_data = value
-
-    @property
-    def __fqdn(self):
-        warn("Access to __fqdn attribute on SMTPChannel is deprecated, "
-            "use 'fqdn' instead", DeprecationWarning, 2)
-        return self.fqdn
-    @__fqdn.setter
-    def __fqdn(self, value):
-        warn("Setting __fqdn attribute on SMTPChannel is deprecated, "
-            "set 'fqdn' instead", DeprecationWarning, 2)
-        self.fqdn = value
-
-    @property
-    def __peer(self):
-        warn("Access to __peer attribute on SMTPChannel is deprecated, "
-            "use 'peer' instead", DeprecationWarning, 2)
-        return self.peer
-    @__peer.setter
-    def __peer(self, value):
-        warn("Setting __peer attribute on SMTPChannel is deprecated, "
-            "set 'peer' instead", DeprecationWarning, 2)
-        self.peer = value
-
-    @property
-    def __conn(self):
-        warn("Access to __conn attribute on SMTPChannel is deprecated, "
-            "use 'conn' instead", DeprecationWarning, 2)
-        return self.conn
-    @__conn.setter
-    def __conn(self, value):
-        warn("Setting __conn attribute on SMTPChannel is deprecated, "
-            "set 'conn' instead", DeprecationWarning, 2)
-        self.conn = value
-
-    @property
-    def __addr(self):
-        warn("Access to __addr attribute on SMTPChannel is deprecated, "
-            "use 'addr' instead", DeprecationWarning, 2)
-        return self.addr
-    @__addr.setter
-    def __addr(self, value):
-        warn("Setting __addr attribute on SMTPChannel is deprecated, "
-            "set 'addr' instead", DeprecationWarning, 2)
-        self.addr = value
-
-    # Overrides base class for convenience.
-    def push(self, msg):
-        asynchat.async_chat.push(self, bytes(
-            msg + '\r\n', 'utf-8' if self.require_SMTPUTF8 else 'ascii'))
-
     # Implementation of base class abstract method
     def collect_incoming_data(self, data):
         limit = None
@@ -321,10 +608,18 @@ class SMTPChannel(asynchat.async_chat):
             limit = self.max_command_size_limit
         elif self.smtp_state == self.DATA:
             limit = self.data_size_limit
+        elif self.smtp_state == self.BDAT:
+            # the chunk is read even when it is refused, but not stored
+            if self.data_spool is not None and self.chunk_error is None:
+                self.data_spool.write(data)
+            return
         if limit and self.num_bytes > limit:
             return
         elif limit:
             self.num_bytes += len(data)
+        if self.data_spool is not None and self.smtp_state == self.DATA:
+            self.data_spool.write(data)
+            return
         if self._decode_data:
             self.received_lines.append(str(data, 'utf-8'))
         else:
@@ -370,33 +665,64 @@ class SMTPChannel(asynchat.async_chat):
                 return
             method(arg)
             return
+        elif self.smtp_state == self.BDAT:
+            self.smtp_state = self.COMMAND
+            self.set_terminator(b'\r\n')
+            self._chunk_received()
         else:
             if self.smtp_state != self.DATA:
                 self.push('451 Internal confusion')
                 self.num_bytes = 0
                 return
             if self.data_size_limit and self.num_bytes > self.data_size_limit:
+                # back to commands, the next transaction must not be swallowed as DATA
+                self._set_post_data_state()
                 self.push('552 Error: Too much mail data')
-                self.num_bytes = 0
                 return
-            # Remove extraneous carriage returns and de-transparency according
-            # to RFC 5321, Section 4.5.2.
-            data = []
-            for text in line.split(self._linesep):
-                if text and text[0] == self._dotsep:
-                    data.append(text[1:])
-                else:
-                    data.append(text)
-            self.received_data = self._newline.join(data)
-            args = (self.peer, self.mailfrom, self.rcpttos, self.received_data, self.authenticated_user)
-            kwargs = {}
-            status = self.smtp_server.process_message(*args, **kwargs)
-            self._set_post_data_state()
-            if not status:
-                self.push('250 OK')
+            if self.data_spool is not None:
+                # already unstuffed while it was received
+                self.received_data = self.data_spool.finish()
+                self.data_spool = None
             else:
-                self.push(status)
-    
+                # Remove extraneous carriage returns and de-transparency according
+                # to RFC 5321, Section 4.5.2.
+                data = []
+                for text in line.split(self._linesep):
+                    if text and text[0] == self._dotsep:
+                        data.append(text[1:])
+                    else:
+                        data.append(text)
+                self.received_data = self._newline.join(data)
+            self._process_received_data()
+
+    def _process_received_data(self):
+        args = (self.peer, self.mailfrom, self.rcpttos, self.received_data, self.authenticated_user)
+        kwargs = {}
+        status = self.smtp_server.process_message(*args, **kwargs)
+        self._set_post_data_state()
+        if not status:
+            self.push('250 OK')
+        else:
+            self.push(status)
+
+    def _chunk_received(self):
+        """Replies to a BDAT chunk once all its bytes were read."""
+        if self.chunk_error is not None:
+            self.push(self.chunk_error)
+            self.chunk_error = None
+            return
+        if self.data_size_limit and self.chunk_bytes > self.data_size_limit:
+            # the rest of the transaction is refused as well
+            self._set_post_data_state()
+            self.push('552 Error: message size exceeds fixed maximum message size')
+            return
+        if not self.chunk_last:
+            self.push('250 OK %d octets received' % self.chunk_size)
+            return
+        self.received_data = self.data_spool.finish()
+        self.data_spool = None
+        self._process_received_data()
+
 
     def smtp_AUTH(self, arg):
 
@@ -484,11 +810,13 @@ class SMTPChannel(asynchat.async_chat):
         self.extended_smtp = True
         self.push('250-%s' % self.fqdn)
         #self.push('250-%s Hello %s' %  (self.fqdn, arg))
+        self.push('250-PIPELINING')
         if self.data_size_limit:
             self.push('250-SIZE %s' % self.data_size_limit)
             self.command_size_limits['MAIL'] += 26
         if not self._decode_data:
             self.push('250-8BITMIME')
+            self.push('250-CHUNKING')
         if self.enable_SMTPUTF8:
             self.push('250-SMTPUTF8')
             self.command_size_limits['MAIL'] += 10
@@ -554,6 +882,8 @@ class SMTPChannel(asynchat.async_chat):
                 self.push(msg)
             elif lc_arg == 'DATA':
                 self.push('250 Syntax: DATA')
+            elif lc_arg == 'BDAT' and not self._decode_data:
+                self.push('250 Syntax: BDAT chunk-size [LAST]')
             elif lc_arg == 'RSET':
                 self.push('250 Syntax: RSET')
             elif lc_arg == 'NOOP':
@@ -630,6 +960,10 @@ class SMTPChannel(asynchat.async_chat):
         if len(params.keys()) > 0:
             self.push('555 MAIL FROM parameters not recognized or not implemented')
             return
+        backpressure = self.smtp_server.backpressure
+        if backpressure is not None and not backpressure.accept_mail():
+            self.push(DEFERRED_REPLY)
+            return
         self.mailfrom = address
         print('sender:', self.mailfrom, file=DEBUGSTREAM)
         self.push('250 OK')
@@ -686,25 +1020,301 @@ class SMTPChannel(asynchat.async_chat):
         if arg:
             self.push('501 Syntax: DATA')
             return
+        if self.chunking:
+            self.push('503 Error: DATA not allowed after BDAT')
+            return
         self.smtp_state = self.DATA
+        spool_dir = getattr(self.smtp_server, 'spool_dir', None)
+        if spool_dir and not self._decode_data:
+            self.data_spool = DataSpool(spool_dir, self.smtp_server.spool_threshold)
         self.set_terminator(b'\r\n.\r\n')
         self.push('354 End data with <CR><LF>.<CR><LF>')
 
+    def smtp_BDAT(self, arg):
+        """
+        CHUNKING (RFC 3030).  `BDAT <size> [LAST]` is followed by exactly
+        size bytes of the message without any dot-stuffing.  The chunks are
+        written into a DataSpool as they arrive, the message is processed
+        after the LAST one.  A refused chunk is still read, so the session
+        stays in sync with a pipelining client.
+        """
+        if self._decode_data:
+            self.push('500 Error: command "BDAT" not recognized')
+            return
+        params = (arg or '').split()
+        if (not 1 <= len(params) <= 2 or not params[0].isdigit()
+                or (len(params) == 2 and params[1].upper() != 'LAST')):
+            # the size of the chunk which follows is unknown
+            self.push('501 Syntax: BDAT chunk-size [LAST]')
+            self.close_when_done()
+            return
+        size = int(params[0])
+        self.chunk_size = size
+        self.chunk_error = None
+        if not self.seen_greeting:
+            self.chunk_error = '503 Error: send HELO first'
+        elif not self.rcpttos:
+            self.chunk_error = '503 Error: need RCPT command'
+        else:
+            if not self.chunking:
+                self.chunking = True
+                spool_dir = getattr(self.smtp_server, 'spool_dir', None)
+                if spool_dir:
+                    self.data_spool = DataSpool(spool_dir, self.smtp_server.spool_threshold,
+                                                unstuff=False)
+                else:
+                    # without a spool directory the chunks stay in memory
+                    self.data_spool = DataSpool(None, float('inf'), unstuff=False)
+            self.chunk_bytes += size
+            self.chunk_last = len(params) == 2
+            if self.data_size_limit and self.chunk_bytes > self.data_size_limit:
+                # nothing more is stored, the chunk is only read to be dropped
+                self.discard_spool()
+        if size:
+            self.smtp_state = self.BDAT
+            self.set_terminator(size)
+        else:
+            self._chunk_received()
+
+    def discard_spool(self):
+        """Drops DATA spooled so far, e.g. when the client disconnects in the middle."""
+        if self.data_spool is not None:
+            self.data_spool.discard()
+            self.data_spool = None
+
     # Commands that have not been implemented
     def smtp_EXPN(self, arg):
         self.push('502 EXPN not implemented')
 
 
-class SMTPServer(asyncore.dispatcher):
-    # SMTPChannel class to use for managing client connections
-    channel_class = SMTPChannel
+class AsyncSMTPChannel(SMTPSession, asyncio.Protocol):
+    """
+    SMTPSession driven by an asyncio transport instead of asynchat.  It keeps
+    its own input buffer and splits it on the current terminator exactly like
+    async_chat.handle_read() does, so the session code is shared unchanged.
+    Replies to all commands found in one read are sent in a single write,
+    which is what makes PIPELINING pay off.  A received message is handed to
+    process_message() in a thread of the server, the loop keeps serving the
+    other sessions while it is routed and written to disk.
+    """
+
+    def __init__(self, server, data_size_limit=DATA_SIZE_DEFAULT,
+                 enable_SMTPUTF8=False, decode_data=False, require_authentication=False,
+                 credential_validator=None):
+        self.transport = None
+        self.conn = None
+        self.peer = None
+        self.closing = False
+        self.ac_in_buffer = b''
+        self.terminator = b'\r\n'
+        self.throttled_peer = None
+        self._replies = None
+        self._processing = False
+        self._idle_timer = None
+        self._session_timer = None
+        self._init_session(server, None, data_size_limit, enable_SMTPUTF8, decode_data,
+                           require_authentication, credential_validator)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn = transport.get_extra_info('socket')
+        self.peer = self.addr = transport.get_extra_info('peername')
+        print('Peer:', repr(self.peer), file=DEBUGSTREAM)
+
+        backpressure = self.smtp_server.backpressure
+        if backpressure is not None and not backpressure.admit():
+            transport.write(BUSY_REPLY)
+            self.close_when_done()
+            return
+
+        delay = 0
+        throttle = self.smtp_server.throttle
+        if throttle is not None:
+            allowed, delay = throttle.admit(self.peer[0])
+            if not allowed:
+                transport.write(REFUSED_REPLY)
+                self.close_when_done()
+                return
+            self.throttled_peer = self.peer[0]
+
+        loop = asyncio.get_event_loop()
+        if self.smtp_server.session_timeout:
+            self._session_timer = loop.call_later(self.smtp_server.session_timeout, self.timeout)
+        if delay:
+            # tarpit: nothing is read until the delayed greeting is sent
+            transport.pause_reading()
+            loop.call_later(delay, self._greet)
+        else:
+            self._greet()
+
+    def _greet(self):
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.push('220 %s %s' % (self.fqdn, __version__))
+        # the idle timer starts with the greeting, a tarpitted peer isn't idle
+        self._touch()
+        self.transport.resume_reading()
+
+    def _touch(self):
+        if self.smtp_server.idle_timeout:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+            self._idle_timer = asyncio.get_event_loop().call_later(
+                self.smtp_server.idle_timeout, self.timeout)
+
+    def timeout(self):
+        print('Timeout:', repr(self.peer), file=DEBUGSTREAM)
+        self.discard_spool()
+        self.push('421 4.4.2 %s Error: timeout exceeded' % self.fqdn)
+        self.close_when_done()
+
+    def connection_lost(self, exc):
+        self.closing = True
+        self.transport = None
+        self.discard_spool()
+        for timer in (self._idle_timer, self._session_timer):
+            if timer is not None:
+                timer.cancel()
+        if self.throttled_peer is not None:
+            self.smtp_server.throttle.release(self.throttled_peer)
+            self.throttled_peer = None
+
+    def data_received(self, data):
+        self._touch()
+        self.ac_in_buffer += data
+        self._replies = []
+        try:
+            self._handle_buffer()
+        finally:
+            self._flush_replies()
+
+    def _handle_buffer(self):
+        # Same splitting rules as asynchat.async_chat.handle_read.
+        while self.ac_in_buffer and not self.closing and not self._processing:
+            lb = len(self.ac_in_buffer)
+            terminator = self.terminator
+            if isinstance(terminator, int):
+                n = terminator
+                if lb < n:
+                    self.collect_incoming_data(self.ac_in_buffer)
+                    self.ac_in_buffer = b''
+                    self.terminator = self.terminator - lb
+                else:
+                    self.collect_incoming_data(self.ac_in_buffer[:n])
+                    self.ac_in_buffer = self.ac_in_buffer[n:]
+                    self.terminator = 0
+                    self.found_terminator()
+                continue
+            terminator_len = len(terminator)
+            index = self.ac_in_buffer.find(terminator)
+            if index != -1:
+                if index > 0:
+                    self.collect_incoming_data(self.ac_in_buffer[:index])
+                self.ac_in_buffer = self.ac_in_buffer[index + terminator_len:]
+                self.found_terminator()
+            else:
+                index = find_prefix_at_end(self.ac_in_buffer, terminator)
+                if index:
+                    if index != lb:
+                        self.collect_incoming_data(self.ac_in_buffer[:-index])
+                        self.ac_in_buffer = self.ac_in_buffer[-index:]
+                    break
+                self.collect_incoming_data(self.ac_in_buffer)
+                self.ac_in_buffer = b''
+
+    def _process_received_data(self):
+        # nothing is read until the reply, the commands pipelined after the
+        # message stay in the buffer
+        args = (self.peer, self.mailfrom, self.rcpttos, self.received_data, self.authenticated_user)
+        self._processing = True
+        if self.transport is not None:
+            self.transport.pause_reading()
+        future = asyncio.get_event_loop().run_in_executor(
+            self.smtp_server.executor, self.smtp_server.process_message, *args)
+        future.add_done_callback(self._message_processed)
+
+    def _message_processed(self, future):
+        self._processing = False
+        try:
+            status = future.result()
+        except Exception:
+            logging.exception("Exception while processing message from Peer: %r.", self.peer)
+            status = '451 Requested action aborted: local error in processing'
+        self._set_post_data_state()
+        self._touch()
+        self._replies = []
+        try:
+            self.push(status or '250 OK')
+            if self.transport is not None and not self.transport.is_closing():
+                self.transport.resume_reading()
+            self._handle_buffer()
+        finally:
+            self._flush_replies()
+
+    def set_terminator(self, term):
+        if isinstance(term, str):
+            term = bytes(term, 'ascii')
+        elif isinstance(term, int) and term < 0:
+            raise ValueError('the number of received bytes must be positive')
+        self.terminator = term
+
+    def get_terminator(self):
+        return self.terminator
+
+    def push(self, msg):
+        if self.transport is None or self.transport.is_closing():
+            return
+        reply = bytes(msg + '\r\n', 'utf-8' if self.require_SMTPUTF8 else 'ascii')
+        if self._replies is not None:
+            self._replies.append(reply)
+        else:
+            self.transport.write(reply)
+
+    def _flush_replies(self):
+        replies, self._replies = self._replies, None
+        if replies and self.transport is not None and not self.transport.is_closing():
+            self.transport.write(b''.join(replies))
+
+    def close_when_done(self):
+        # transport.close() flushes whatever is still buffered before closing.
+        self._flush_replies()
+        self.closing = True
+        if self.transport is not None:
+            self.transport.close()
+
+    close = close_when_done
+
+
+class AsyncSMTPServer(object):
+    """
+    asyncio counterpart of SMTPServer.  The listening socket is created in
+    the constructor (so a bad address fails right away, like SMTPServer) and
+    serve_forever() runs an event loop accepting AsyncSMTPChannel sessions.
+    Subclasses override process_message() exactly as with SMTPServer, it is
+    called from one of message_threads threads, never from the loop.
+    With reuse_port=True the socket is bound with SO_REUSEPORT, so several
+    processes can serve the same address.
+    """
+    channel_class = AsyncSMTPChannel
+    backlog = 1024
+    spool_dir = None
+    spool_threshold = SPOOL_THRESHOLD_DEFAULT
+    throttle = None
+    backpressure = None
+    # seconds without any data from the client / of the whole session
+    # before it is closed with 421, 0 turns the timeout off
+    idle_timeout = 0
+    session_timeout = 0
+    # threads calling process_message(), a slow disk write holds up only them
+    message_threads = 4
 
     def __init__(self, localaddr, remoteaddr, require_authentication=False,
                  credentials=None,
-                 data_size_limit=DATA_SIZE_DEFAULT, map=None,
-                 enable_SMTPUTF8=False, decode_data=False):
+                 data_size_limit=DATA_SIZE_DEFAULT,
+                 enable_SMTPUTF8=False, decode_data=False, reuse_port=False):
         self._localaddr = localaddr
         self._remoteaddr = remoteaddr
+        self.reuse_port = reuse_port
         self.data_size_limit = data_size_limit
         self.enable_SMTPUTF8 = enable_SMTPUTF8
         self._decode_data = decode_data
@@ -717,222 +1327,72 @@ class SMTPServer(asyncore.dispatcher):
         else:
             self.credential_validator = None
 
-        asyncore.dispatcher.__init__(self, map=map)
+        self.loop = None
+        self.executor = None
+        self.socket = self.create_listen_socket(localaddr)
+        print('%s started at %s\n\tLocal addr: %s\n\tRemote addr:%s' % (
+            self.__class__.__name__, time.ctime(time.time()),
+            localaddr, remoteaddr), file=DEBUGSTREAM)
+
+    def create_listen_socket(self, localaddr):
+        gai_results = socket.getaddrinfo(*localaddr, type=socket.SOCK_STREAM)
+        sock = socket.socket(gai_results[0][0], gai_results[0][1])
         try:
-            gai_results = socket.getaddrinfo(*localaddr,
-                                             type=socket.SOCK_STREAM)
-            self.create_socket(gai_results[0][0], gai_results[0][1])
             # try to re-use a server port if possible
-            self.set_reuse_addr()
-            self.bind(localaddr)
-            self.listen(5)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                # several processes listen on the same port, the kernel
+                # spreads new connections between them
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(localaddr)
+            sock.listen(self.backlog)
+            sock.setblocking(False)
         except:
-            self.close()
+            sock.close()
             raise
-        else:
-            print('%s started at %s\n\tLocal addr: %s\n\tRemote addr:%s' % (
-                self.__class__.__name__, time.ctime(time.time()),
-                localaddr, remoteaddr), file=DEBUGSTREAM)
-
-    def handle_accepted(self, conn, addr):
-        print('Incoming connection from %s' % repr(addr), file=DEBUGSTREAM)
-        channel = self.channel_class(self,
-                                     conn,
-                                     addr,
-                                     self.data_size_limit,
-                                     self._map,
-                                     self.enable_SMTPUTF8,
-                                     self._decode_data,
-                                     require_authentication=self.require_authentication, 
-                                     credential_validator=self.credential_validator
-                                    )
+        return sock
+
+    def _make_channel(self):
+        return self.channel_class(self,
+                                  self.data_size_limit,
+                                  self.enable_SMTPUTF8,
+                                  self._decode_data,
+                                  require_authentication=self.require_authentication,
+                                  credential_validator=self.credential_validator
+                                 )
+
+    def serve_forever(self):
+        """Runs a fresh event loop in the calling thread until stop() is called."""
+        if self.backpressure is not None:
+            self.backpressure.start()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            self.message_threads, thread_name_prefix='smtpd-message')
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(
+            self.loop.create_server(self._make_channel, sock=self.socket))
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+            # the messages being processed are still queued
+            self.executor.shutdown(wait=True)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
 
     # API for "doing something useful with the message"
     def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
         """Override this abstract method to handle messages from the client.
-        peer is a tuple containing (ipaddr, port) of the client that made the
-        socket connection to our smtp port.
-        mailfrom is the raw address the client claims the message is coming
-        from.
-        rcpttos is a list of raw addresses the client wishes to deliver the
-        message to.
-        data is a string containing the entire full text of the message,
-        headers (if supplied) and all.  It has been `de-transparencied'
-        according to RFC 821, Section 4.5.2.  In other words, a line
-        containing a `.' followed by other text has had the leading dot
-        removed.
-        kwargs is a dictionary containing additional information.  It is
-        empty if decode_data=True was given as init parameter, otherwise
-        it will contain the following keys:
-            'mail_options': list of parameters to the mail command.  All
-                            elements are uppercase strings.  Example:
-                            ['BODY=8BITMIME', 'SMTPUTF8'].
-            'rcpt_options': same, for the rcpt command.
-        This function should return None for a normal `250 Ok' response;
-        otherwise, it should return the desired response string in RFC 821
-        format.
+        See SMTPServer.process_message for the meaning of the arguments and
+        the return value.
         """
         raise NotImplementedError
 
 
-class DebuggingServer(SMTPServer):
-
-    def _print_message_content(self, peer, data):
-        inheaders = 1
-        lines = data.splitlines()
-        for line in lines:
-            # headers first
-            if inheaders and not line:
-                peerheader = 'X-Peer: ' + peer[0]
-                if not isinstance(data, str):
-                    # decoded_data=false; make header match other binary output
-                    peerheader = repr(peerheader.encode('utf-8'))
-                print(peerheader)
-                inheaders = 0
-            if not isinstance(data, str):
-                # Avoid spurious 'str on bytes instance' warning.
-                line = repr(line)
-            print(line)
-
-    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
-        print('---------- MESSAGE FOLLOWS ----------')
-        if kwargs:
-            if kwargs.get('mail_options'):
-                print('mail options: %s' % kwargs['mail_options'])
-            if kwargs.get('rcpt_options'):
-                print('rcpt options: %s\n' % kwargs['rcpt_options'])
-        self._print_message_content(peer, data)
-        print('------------ END MESSAGE ------------')
-
-
-class PureProxy(SMTPServer):
-    def __init__(self, *args, **kwargs):
-        if 'enable_SMTPUTF8' in kwargs and kwargs['enable_SMTPUTF8']:
-            raise ValueError("PureProxy does not support SMTPUTF8.")
-        super(PureProxy, self).__init__(*args, **kwargs)
-
-    def process_message(self, peer, mailfrom, rcpttos, data):
-        lines = data.split('\n')
-        # Look for the last header
-        i = 0
-        for line in lines:
-            if not line:
-                break
-            i += 1
-        lines.insert(i, 'X-Peer: %s' % peer[0])
-        data = NEWLINE.join(lines)
-        refused = self._deliver(mailfrom, rcpttos, data)
-        # TBD: what to do with refused addresses?
-        print('we got some refusals:', refused, file=DEBUGSTREAM)
-
-    def _deliver(self, mailfrom, rcpttos, data):
-        import smtplib
-        refused = {}
-        try:
-            s = smtplib.SMTP()
-            s.connect(self._remoteaddr[0], self._remoteaddr[1])
-            try:
-                refused = s.sendmail(mailfrom, rcpttos, data)
-            finally:
-                s.quit()
-        except smtplib.SMTPRecipientsRefused as e:
-            print('got SMTPRecipientsRefused', file=DEBUGSTREAM)
-            refused = e.recipients
-        except (OSError, smtplib.SMTPException) as e:
-            print('got', e.__class__, file=DEBUGSTREAM)
-            # All recipients were refused.  If the exception had an associated
-            # error code, use it.  Otherwise,fake it with a non-triggering
-            # exception code.
-            errcode = getattr(e, 'smtp_code', -1)
-            errmsg = getattr(e, 'smtp_error', 'ignore')
-            for r in rcpttos:
-                refused[r] = (errcode, errmsg)
-        return refused
-
-
-class MailmanProxy(PureProxy):
-    def __init__(self, *args, **kwargs):
-        if 'enable_SMTPUTF8' in kwargs and kwargs['enable_SMTPUTF8']:
-            raise ValueError("MailmanProxy does not support SMTPUTF8.")
-        super(PureProxy, self).__init__(*args, **kwargs)
-
-    def process_message(self, peer, mailfrom, rcpttos, data):
-        from io import StringIO
-        from Mailman import Utils
-        from Mailman import Message
-        from Mailman import MailList
-        # If the message is to a Mailman mailing list, then we'll invoke the
-        # Mailman script directly, without going through the real smtpd.
-        # Otherwise we'll forward it to the local proxy for disposition.
-        listnames = []
-        for rcpt in rcpttos:
-            local = rcpt.lower().split('@')[0]
-            # We allow the following variations on the theme
-            #   listname
-            #   listname-admin
-            #   listname-owner
-            #   listname-request
-            #   listname-join
-            #   listname-leave
-            parts = local.split('-')
-            if len(parts) > 2:
-                continue
-            listname = parts[0]
-            if len(parts) == 2:
-                command = parts[1]
-            else:
-                command = ''
-            if not Utils.list_exists(listname) or command not in (
-                    '', 'admin', 'owner', 'request', 'join', 'leave'):
-                continue
-            listnames.append((rcpt, listname, command))
-        # Remove all list recipients from rcpttos and forward what we're not
-        # going to take care of ourselves.  Linear removal should be fine
-        # since we don't expect a large number of recipients.
-        for rcpt, listname, command in listnames:
-            rcpttos.remove(rcpt)
-        # If there's any non-list destined recipients left,
-        print('forwarding recips:', ' '.join(rcpttos), file=DEBUGSTREAM)
-        if rcpttos:
-            refused = self._deliver(mailfrom, rcpttos, data)
-            # TBD: what to do with refused addresses?
-            print('we got refusals:', refused, file=DEBUGSTREAM)
-        # Now deliver directly to the list commands
-        mlists = {}
-        s = StringIO(data)
-        msg = Message.Message(s)
-        # These headers are required for the proper execution of Mailman.  All
-        # MTAs in existence seem to add these if the original message doesn't
-        # have them.
-        if not msg.get('from'):
-            msg['From'] = mailfrom
-        if not msg.get('date'):
-            msg['Date'] = time.ctime(time.time())
-        for rcpt, listname, command in listnames:
-            print('sending message to', rcpt, file=DEBUGSTREAM)
-            mlist = mlists.get(listname)
-            if not mlist:
-                mlist = MailList.MailList(listname, lock=0)
-                mlists[listname] = mlist
-            # dispatch on the type of command
-            if command == '':
-                # post
-                msg.Enqueue(mlist, tolist=1)
-            elif command == 'admin':
-                msg.Enqueue(mlist, toadmin=1)
-            elif command == 'owner':
-                msg.Enqueue(mlist, toowner=1)
-            elif command == 'request':
-                msg.Enqueue(mlist, torequest=1)
-            elif command in ('join', 'leave'):
-                # TBD: this is a hack!
-                if command == 'join':
-                    msg['Subject'] = 'subscribe'
-                else:
-                    msg['Subject'] = 'unsubscribe'
-                msg.Enqueue(mlist, torequest=1)
-
-
 class CredentialValidator():
     def __init__(self, credentials=None):
         self.credentials = credentials
@@ -1046,6 +1506,7 @@ if __name__ == '__main__':
         except PermissionError:
             print('Cannot setuid "nobody"; try running with -n option.', file=sys.stderr)
             sys.exit(1)
+    import asyncore
     try:
         asyncore.loop()
     except KeyboardInterrupt:
@@ -0,0 +1,153 @@
+"""
+Benchmark of the receiver queue backends.
+
+--test backlog fills a plain Maildir queue and a sharded one (see
+salmonqueueindex) in a temporary directory with the same number of small
+messages, e.g. the backlog left after a long relay outage, and prints how
+long it takes to list the queue, count it and pop messages off it one by one
+and in batches. The plain queue is listed for every pop(), so --pops is kept
+small there.
+--test storm pushes a storm of small messages one by one into a Maildir
+queue and into the SQLite queue (see salmonsqlqueue) with and without the
+group commit, and then drains each of them with pop_batch.
+
+Run it with the python from the receiver virtualenv, e.g.
+    python benchmark_queue.py --messages 1000000 --shards 256
+    python benchmark_queue.py --test storm --messages 20000
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from salmon import queue
+
+MESSAGE = (
+    b"From: bench@example.com\r\n"
+    b"To: victim@example.com\r\n"
+    b"Subject: queue benchmark\r\n\r\n"
+    b"queued during a relay outage\r\n"
+)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument(
+        "--test", type=str, choices=["backlog", "storm"], default="backlog", help="What to benchmark"
+    )
+    parser.add_argument(
+        "--messages", "-m", type=int, default=None,
+        help="Number of queued messages, 1000000 for backlog and 20000 for storm by default"
+    )
+    parser.add_argument(
+        "--shards", "-s", type=int, default=256, help="Number of shards of the sharded queue"
+    )
+    parser.add_argument(
+        "--pops", type=int, default=20, help="Number of messages popped one by one"
+    )
+    parser.add_argument(
+        "--batch", "-b", type=int, default=1000, help="Number of messages popped in one pop_batch"
+    )
+    parser.add_argument(
+        "--commit-interval", type=float, default=0.05, help="Group commit interval of the SQLite queue"
+    )
+    parser.add_argument(
+        "--dir", type=str, default=None, help="Directory for the queues, a temporary one by default"
+    )
+    args = parser.parse_args()
+    if args.messages is None:
+        args.messages = 1000000 if args.test == "backlog" else 20000
+    return args
+
+
+def timed(function, *args):
+    started = time.time()
+    result = function(*args)
+    return result, time.time() - started
+
+
+def fill(inq, messages):
+    """Writes the messages straight into new/ with Maildir style keys, pushing
+    a million messages one by one would take much longer than the benchmark."""
+    now = int(time.time()) - messages
+    pid = os.getpid()
+    for i in range(messages):
+        key = "%d.M%dP%dQ%d.benchmark" % (now + i // 1000, i % 1000 * 1000, pid, i)
+        with open(inq.new_path(key), "wb") as f:
+            f.write(MESSAGE)
+
+
+def pop_one_by_one(inq, count):
+    for i in range(count):
+        inq.pop()
+
+
+def benchmark(name, directory, args, shards):
+    inq = queue.Queue(directory, shards=shards)
+    _, elapsed = timed(fill, inq, args.messages)
+    print("{} queue ({} shards):".format(name, inq.shards))
+    print("    fill {} messages:        {:.2f} s".format(args.messages, elapsed))
+
+    inq = queue.Queue(directory, shards=shards)
+    keys, elapsed = timed(inq.keys)
+    print("    keys():                     {:.3f} s".format(elapsed))
+    count, elapsed = timed(len, inq)
+    print("    len() = {:<8}            {:.3f} s".format(count, elapsed))
+    _, elapsed = timed(pop_one_by_one, inq, args.pops)
+    print("    pop() per message:          {:.2f} ms".format(elapsed / max(args.pops, 1) * 1000))
+    batch, elapsed = timed(inq.pop_batch, args.batch)
+    print("    pop_batch({}) per message: {:.3f} ms".format(
+        args.batch, elapsed / max(len(batch), 1) * 1000))
+    _, elapsed = timed(inq.push, MESSAGE)
+    print("    push():                     {:.2f} ms".format(elapsed * 1000))
+
+
+def push_storm(inq, messages):
+    for i in range(messages):
+        inq.push(MESSAGE)
+
+
+def drain(inq, batch):
+    popped = 0
+    while True:
+        messages = inq.pop_batch(batch)
+        if not messages:
+            return popped
+        popped += len(messages)
+
+
+def storm(name, inq, args):
+    started = time.time()
+    push_storm(inq, args.messages)
+    if getattr(inq, "store", None) is not None:
+        # the last group commit is counted as well
+        inq.store.flush()
+    elapsed = time.time() - started
+    print("{}:".format(name))
+    print("    push() per second:          {:.0f}".format(args.messages / elapsed))
+    popped, elapsed = timed(drain, inq, args.batch)
+    print("    pop_batch({}) per second: {:.0f} ({} messages)".format(args.batch, popped / elapsed, popped))
+
+
+def main():
+    args = parse_arguments()
+    work_dir = args.dir or tempfile.mkdtemp(prefix="benchmark_queue")
+    try:
+        if args.test == "storm":
+            storm("maildir", queue.Queue(os.path.join(work_dir, "maildir"), shards=0), args)
+            storm("sqlite", queue.SQLiteQueue(os.path.join(work_dir, "sqlite"), commit_interval=0), args)
+            storm("sqlite, group commit every {} s".format(args.commit_interval),
+                  queue.SQLiteQueue(os.path.join(work_dir, "group"), commit_interval=args.commit_interval),
+                  args)
+            return
+        benchmark("plain", os.path.join(work_dir, "plain"), args, 0)
+        benchmark("sharded", os.path.join(work_dir, "sharded"), args, args.shards)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
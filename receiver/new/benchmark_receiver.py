@@ -0,0 +1,243 @@
+"""
+Benchmark of the receiver SMTP front ends.
+
+It starts smtpd.SMTPServer (asyncore) and/or smtpd.AsyncSMTPServer (asyncio)
+in a separate process and drives it with many concurrent SMTP clients, then it
+prints how many sessions were open at the same time, how many of them failed
+and how many messages per second were accepted. With --target it benchmarks an
+already running salmon receiver instead (e.g. the whole receiver pipeline).
+--mode pipelining sends MAIL, RCPT and DATA without waiting for each reply and
+--mode bdat sends the whole transaction with BDAT ... LAST in one write.
+
+Run it with the python from the receiver virtualenv, e.g.
+    python benchmark_receiver.py --clients 2000 --messages 5
+"""
+
+import argparse
+import asyncio
+import asyncore
+import multiprocessing
+import resource
+import socket
+import time
+
+from salmon import smtpd
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument(
+        "--frontend",
+        type=str,
+        choices=["asyncore", "asyncio", "both"],
+        default="both",
+        help="Which SMTP front end to benchmark",
+    )
+    parser.add_argument(
+        "--clients", "-c", type=int, default=1000, help="Number of concurrent SMTP sessions"
+    )
+    parser.add_argument(
+        "--messages", "-m", type=int, default=5, help="Number of messages sent in each session"
+    )
+    parser.add_argument(
+        "--size", "-s", type=int, default=4096, help="Size of the message body in bytes"
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=["data", "pipelining", "bdat"],
+        default="data",
+        help="How the clients send a message",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="Timeout of one SMTP reply in seconds"
+    )
+    parser.add_argument(
+        "--target",
+        type=str,
+        default=None,
+        help="host:port of a running receiver, no benchmark server is started then",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def raise_nofile_limit():
+    """Thousands of sessions need more file descriptors than the usual 1024."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class NullServer(smtpd.SMTPServer):
+    """asyncore server which accepts and drops every message."""
+
+    def process_message(self, peer, mailfrom, rcpttos, data, user=None):
+        return None
+
+
+class AsyncNullServer(smtpd.AsyncSMTPServer):
+    """asyncio server which accepts and drops every message."""
+
+    backlog = 4096
+
+    def process_message(self, peer, mailfrom, rcpttos, data, user=None):
+        return None
+
+
+def run_server(frontend, port):
+    raise_nofile_limit()
+    if frontend == "asyncio":
+        AsyncNullServer(("127.0.0.1", port), None).serve_forever()
+    else:
+        NullServer(("127.0.0.1", port), None)
+        asyncore.loop(timeout=0.1, use_poll=True)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception("Benchmark server did not start on %s:%d" % (host, port))
+
+
+class Stats(object):
+    def __init__(self):
+        self.connected = 0
+        self.peak = 0
+        self.sessions = 0
+        self.failed = 0
+        self.messages = 0
+
+
+async def expect(reader, code, timeout):
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if not line:
+            raise ConnectionError("connection closed")
+        if line[3:4] != b"-":
+            break
+    if not line.startswith(code):
+        raise ConnectionError(line.decode(errors="replace").strip())
+
+
+async def session(host, port, args, body, stats, start):
+    await start.wait()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), args.timeout)
+        stats.connected += 1
+        stats.peak = max(stats.peak, stats.connected)
+        try:
+            await expect(reader, b"220", args.timeout)
+            writer.write(b"EHLO benchmark\r\n")
+            await expect(reader, b"250", args.timeout)
+            for i in range(args.messages):
+                if args.mode == "data":
+                    writer.write(b"MAIL FROM:<bench@example.com>\r\n")
+                    await expect(reader, b"250", args.timeout)
+                    writer.write(b"RCPT TO:<victim@example.com>\r\n")
+                    await expect(reader, b"250", args.timeout)
+                    writer.write(b"DATA\r\n")
+                    await expect(reader, b"354", args.timeout)
+                    writer.write(body)
+                else:
+                    writer.write(ENVELOPE + (body if args.mode == "bdat" else b"DATA\r\n"))
+                    await expect(reader, b"250", args.timeout)
+                    await expect(reader, b"250", args.timeout)
+                    if args.mode == "pipelining":
+                        await expect(reader, b"354", args.timeout)
+                        writer.write(body)
+                await expect(reader, b"250", args.timeout)
+                stats.messages += 1
+            writer.write(b"QUIT\r\n")
+            await expect(reader, b"221", args.timeout)
+        finally:
+            stats.connected -= 1
+        stats.sessions += 1
+    except (OSError, asyncio.TimeoutError):
+        stats.failed += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+ENVELOPE = b"MAIL FROM:<bench@example.com>\r\nRCPT TO:<victim@example.com>\r\n"
+
+
+def make_body(size, mode="data"):
+    headers = (
+        b"From: bench@example.com\r\n"
+        b"To: victim@example.com\r\n"
+        b"Subject: receiver benchmark\r\n"
+        b"Date: Mon, 01 Jun 2020 10:00:00 +0000\r\n\r\n"
+    )
+    line = b"x" * 76 + b"\r\n"
+    body = line * (size // len(line) + 1)
+    message = headers + body[:size]
+    if mode == "bdat":
+        return b"BDAT %d LAST\r\n" % len(message) + message
+    return message + b"\r\n.\r\n"
+
+
+async def drive(host, port, args):
+    stats = Stats()
+    start = asyncio.Event()
+    body = make_body(args.size, args.mode)
+    tasks = [
+        asyncio.ensure_future(session(host, port, args, body, stats, start))
+        for i in range(args.clients)
+    ]
+    started = time.time()
+    start.set()
+    await asyncio.gather(*tasks)
+    return stats, time.time() - started
+
+
+def benchmark(name, host, port, args):
+    loop = asyncio.new_event_loop()
+    try:
+        stats, elapsed = loop.run_until_complete(drive(host, port, args))
+    finally:
+        loop.close()
+    print("{} ({}):".format(name, args.mode))
+    print("    sessions ok/failed:        {}/{}".format(stats.sessions, stats.failed))
+    print("    peak concurrent sessions:  {}".format(stats.peak))
+    print("    messages accepted:         {}".format(stats.messages))
+    print("    elapsed:                   {:.2f} s".format(elapsed))
+    print("    messages per second:       {:.1f}".format(stats.messages / elapsed if elapsed else 0))
+
+
+def main():
+    args = parse_arguments()
+    raise_nofile_limit()
+    if args.target:
+        host, port = args.target.rsplit(":", 1)
+        benchmark(args.target, host, int(port), args)
+        return
+
+    frontends = ["asyncore", "asyncio"] if args.frontend == "both" else [args.frontend]
+    for frontend in frontends:
+        port = free_port()
+        server = multiprocessing.Process(target=run_server, args=(frontend, port), daemon=True)
+        server.start()
+        try:
+            wait_for_port("127.0.0.1", port)
+            benchmark(frontend, "127.0.0.1", port, args)
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
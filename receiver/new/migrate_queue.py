@@ -0,0 +1,84 @@
+"""
+Moves the messages of a Maildir queue into the SQLite queue (queue_backend:
+sqlite in salmon.yaml, see salmonsqlqueue) in the same directory.
+
+The messages keep their keys and metadata and are copied in batches, every
+batch is committed before its files are removed, so the migration can be
+interrupted and started again. Stop the receiver and the relay, switch
+queue_backend to sqlite and run it from the receiver myproject directory
+with the python from the receiver virtualenv, e.g.
+    python migrate_queue.py --queue run/queue
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+from salmon import queue, salmonqueueindex, salmonsqlqueue
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument(
+        "--queue", "-q", type=str, default="run/queue", help="Directory of the queue"
+    )
+    parser.add_argument(
+        "--batch", "-b", type=int, default=1000, help="Number of messages committed together"
+    )
+    args = parser.parse_args()
+    return args
+
+
+def read_message(maildir, key):
+    """Returns (data, metadata) of a message of the Maildir queue or None."""
+    try:
+        with open(maildir.new_path(key), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        try:
+            data = maildir.mbox.get_bytes(key)
+        except KeyError:
+            return None
+    try:
+        with open(salmonqueueindex.metadata_path(maildir.dir, key, maildir.shards)) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        metadata = None
+    return data, metadata
+
+
+def migrate(queue_dir, batch):
+    maildir = queue.Queue(queue_dir, shards=salmonqueueindex.read_layout(queue_dir))
+    store = queue.SQLiteQueue(queue_dir, commit_interval=0).store
+    keys = sorted(maildir.keys(), key=salmonqueueindex.arrival)
+    moved = 0
+    for start in range(0, len(keys), batch):
+        messages = []
+        for key in keys[start:start + batch]:
+            message = read_message(maildir, key)
+            if message is not None:
+                messages.append((key,) + message)
+        store.add_many(messages)
+        for key, data, metadata in messages:
+            try:
+                maildir.remove(key)
+            except KeyError:
+                pass
+        moved += len(messages)
+        logging.info("Moved %d of %d messages.", moved, len(keys))
+    return moved
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parse_arguments()
+    started = time.time()
+    moved = migrate(args.queue, args.batch)
+    print("Moved {} messages from the Maildir into {} in {:.1f} s.".format(
+        moved, os.path.join(args.queue, salmonsqlqueue.DB_FILE), time.time() - started))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,73 @@
-import logging
-import logging.config
-import os
-from salmon import queue
-from salmon.routing import Router
-from salmon.server import Relay, QueueReceiver
+from salmon import salmonstartup
 
-from . import settings
+# times the imports of the boot until the finally below, see salmonstartup
+salmonstartup.start()
+try:
+    import logging
+    import logging.config
+    import os
+    from salmon import queue
+    from salmon.routing import Router
+    from salmon.salmondelivery import DeliveryService
+    from salmon.salmonfastpath import FastPath
+    from salmon.salmonoverload import Overload
+    from salmon.salmonpipeline import RelayPipeline
+    from salmon.server import Relay, QueueReceiver, QueueWorkers
 
-logging.config.fileConfig("config/logging.conf")
+    from . import settings
 
-# the relay host to actually send the final message to
-settings.relay = Relay(host=settings.relay_config['host'],
-                       port=settings.relay_config['port'], debug=1)
+    logging.config.fileConfig("config/logging.conf")
 
-# Include the maildir option we've set in settings.py
-settings.receiver = QueueReceiver(settings.receiver_config['maildir'])
+    # the relay host to actually send the final message to
+    settings.relay = Relay(host=settings.relay_config['host'],
+                           port=settings.relay_config['port'], debug=1)
 
-Router.defaults(**settings.router_defaults)
-Router.load(settings.handlers)
-Router.RELOAD = True
-Router.UNDELIVERABLE_QUEUE = queue.Queue("run/undeliverable")
+    # sends the relayed emails with it, see salmonrelay
+    settings.delivery = DeliveryService(settings.relay,
+                                        retries=settings.delivery_config['retries'],
+                                        retry_delay=settings.delivery_config['retry_delay'],
+                                        keepalive=settings.delivery_config['keepalive'])
+
+    # parse, rate and deliver the messages in stages, see salmonpipeline
+    pipeline = None
+    if settings.pipeline_config['enabled']:
+        pipeline = RelayPipeline(parse_workers=settings.pipeline_config['parse_workers'],
+                                 delivery_threads=settings.pipeline_config['delivery_threads'],
+                                 queue_size=settings.pipeline_config['queue_size'],
+                                 report=settings.pipeline_config['report'],
+                                 batch_size=settings.pipeline_config['batch_size'])
+
+    overload = Overload(depth=settings.overload_config['depth'], age=settings.overload_config['age'])
+
+    if settings.fastpath_config['enabled']:
+        # receive the emails in this process too, see salmonfastpath
+        settings.receiver = FastPath(host=settings.fastpath_config['host'],
+                                     port=settings.fastpath_config['port'],
+                                     journal_dir=settings.fastpath_config['journal'],
+                                     commit_interval=settings.fastpath_config['commit_interval'],
+                                     queue_size=settings.fastpath_config['queue_size'],
+                                     attempts=settings.receiver_config['attempts'],
+                                     pipeline=pipeline,
+                                     overload=overload)
+    else:
+        # Include the maildir option we've set in settings.py
+        settings.receiver = QueueReceiver(settings.receiver_config['maildir'],
+                                          rescan=settings.receiver_config['rescan'],
+                                          shards=settings.receiver_config['shards'],
+                                          backend=settings.receiver_config['backend'],
+                                          lease=settings.receiver_config['lease'],
+                                          attempts=settings.receiver_config['attempts'],
+                                          pipeline=pipeline,
+                                          overload=overload)
+        if settings.receiver_config['workers'] > 1:
+            settings.receiver = QueueWorkers(settings.receiver, settings.receiver_config['workers'])
+
+    Router.defaults(**settings.router_defaults)
+    Router.load(settings.handlers)
+    Router.RELOAD = True
+    Router.UNDELIVERABLE_QUEUE = queue.Queue("run/undeliverable")
+finally:
+    salmonstartup.stop()
+
+# logs how long the start took, the relay starts processing the queue next
+salmonstartup.report()
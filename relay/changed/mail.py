@@ -11,15 +11,17 @@ APIs for doing attachments and such.
 """
 from __future__ import print_function, unicode_literals
 
-from email.utils import parseaddr
+from email.utils import getaddresses, parseaddr
+import email.parser
 import mimetypes
 import os
-import warnings
 import re
+import warnings
 
 import six
 
 from salmon import bounce, encoding
+from salmon.salmonheaders import HeaderIndex
 
 # You can change this to 'Delivered-To' on servers that support it like Postfix
 ROUTABLE_TO_HEADER = 'to'
@@ -67,6 +69,9 @@ class MailRequest(object):
         one.
         """
         self.Peer = Peer
+        self._header_index = None
+        self._message = None
+        self._base = None
         self.Data = Data
         try:
             self.From = _decode_header_randomness(From).pop()
@@ -77,22 +82,92 @@ class MailRequest(object):
         except KeyError:
             self.To = None
 
-        self.base = encoding.from_string(self.Data)
-
-        if 'from' not in self.base:
-            self.base['from'] = self.From
-        if 'to' not in self.base:
-            # do NOT use ROUTABLE_TO here
-            self.base['to'] = self.To
-
-        self.From = self.From or self.base['from']
-        self.To = self.To or self.base[ROUTABLE_TO_HEADER]
+        # read from the header index, the email is parsed only when it's needed
+        self.From = self.From or self._header('from')
+        self.To = self.To or self._header(ROUTABLE_TO_HEADER)
 
         self.bounce = None
 
     def __repr__(self):
         return "From: %r" % [self.Peer, self.From, self.To]
 
+    @property
+    def Data(self):
+        return self._data
+
+    @Data.setter
+    def Data(self, value):
+        self._data = value
+        self._header_index = None
+        self._message = None
+
+    @property
+    def header_index(self):
+        """salmonheaders.HeaderIndex of Data, built once and rebuilt after Data changes."""
+        if self._header_index is None:
+            self._header_index = HeaderIndex(self.Data)
+        return self._header_index
+
+    @property
+    def message(self):
+        """
+        The email.message.Message parsed from Data, parsed once on first use
+        and again after Data changes.  It is shared by everything reading
+        the email (salmonmailparser among others), so don't change it, change
+        Data instead.
+        """
+        if self._message is None:
+            if isinstance(self.Data, bytes):
+                self._message = email.parser.BytesParser().parsebytes(self.Data)
+            else:
+                self._message = email.parser.Parser().parsestr(self.Data)
+        return self._message
+
+    @property
+    def base(self):
+        """
+        The salmon.encoding.MailBase of the email, built on first use.  It
+        gets its own parse of Data, because the From and To headers are
+        added to it when they're missing.
+        """
+        if self._base is None:
+            base = encoding.from_string(self.Data)
+            if 'from' not in base:
+                base['from'] = self.From
+            if 'to' not in base:
+                # do NOT use ROUTABLE_TO here
+                base['to'] = self.To
+            self._base = base
+        return self._base
+
+    @base.setter
+    def base(self, value):
+        self._base = value
+
+    def _header(self, name):
+        value = self.header_index.get(name)
+        if value is None:
+            return None
+        # the same str the email package gives for the header
+        charset = 'utf-8' if isinstance(self.Data, str) else 'ascii'
+        return encoding.header_from_mime_encoding(value.decode(charset, 'surrogateescape'))
+
+    def rewrite(self, replacements):
+        """
+        Replaces all occurrences of the keys of replacements (bytes) in Data
+        with their values in one pass, the longer key wins where two of them
+        overlap.  Data is set once, so the parsed message and the header
+        index are dropped once for all the replacements.
+        """
+        replacements = {old: new for old, new in replacements.items() if old}
+        if not replacements:
+            return
+        data = self.Data
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        pattern = re.compile(b'|'.join(re.escape(old) for old in sorted(replacements, key=len, reverse=True)))
+        self.Data = pattern.sub(lambda match: replacements[match.group(0)], data)
+
     def all_parts(self):
         """Returns all multipart mime parts.  This could be an empty list."""
         return self.base.parts
@@ -158,16 +233,17 @@ class MailRequest(object):
         return self.bounce.score > threshold
 
     def get_bcc(self):
-        bcc_pos = re.search(b"\nBcc:", self.Data)
-        if bcc_pos is not None:
-            start = bcc_pos.start() + 5
-            date_pos = re.search(b"\nDate:", self.Data)
-            end = date_pos.end() - 6
-            address = self.Data[start:end].decode("utf-8")
-            address_list = address.split(",")
-            bcc_address_list = [x.strip() for x in address_list]
-            return bcc_address_list
-        return []
+        """Returns the addresses in the Bcc header the receiver added."""
+        bcc = self.header_index.get("bcc")
+        if bcc is None:
+            return []
+        return [x.strip() for x in bcc.decode("utf-8").split(",") if x.strip()]
+
+    def get_header_recipients(self):
+        """Returns the lowercase addresses in the To and Cc headers."""
+        values = self.header_index.get_all("to") + self.header_index.get_all("cc")
+        addresses = getaddresses([value.decode("utf-8", "replace") for value in values])
+        return [address.lower() for name, address in addresses if address]
 
     @property
     def original(self):
@@ -8,6 +8,7 @@ from __future__ import print_function, unicode_literals
 
 import errno
 import hashlib
+import json
 import logging
 import mailbox
 import os
@@ -17,23 +18,30 @@ import hashlib
 
 import six
 
-from salmon import mail
+from salmon import mail, salmonqueueindex, salmonsqlqueue
 
 # we calculate this once, since the hostname shouldn't change for every
 # email we put in a queue
 HASHED_HOSTNAME = hashlib.md5(socket.gethostname().encode("utf-8")).hexdigest()
 
-PEER = ''
-USER = ''
 sensorName = "SALMON"
 
+# subdirectory of the Maildir with the metadata sidecars the receiver writes
+META_DIR = salmonqueueindex.META_DIR
+# subdirectory of the Maildir with a directory of messages claimed by each worker
+PROCESSING_DIR = 'processing'
+
+
+def new_key():
+    """Returns a new queue key, it starts with the arrival time."""
+    now = time.time()
+    return "%s.M%sP%sQ%s.%s" % (int(now), int(now % 1 * 1e6), os.getpid(),
+                                mailbox.Maildir._count, HASHED_HOSTNAME)
+
+
 class SafeMaildir(mailbox.Maildir):
     def _create_tmp(self):
-        global PEER
-        logging.critical("PEER in queue: %s", PEER)
-        now = time.time()
-        uniq = "%s.M%sP%sQ%s.%s" % (int(now), int(now % 1 * 1e6), os.getpid(),
-                                    mailbox.Maildir._count, HASHED_HOSTNAME)
+        uniq = new_key()
         path = os.path.join(self._path, 'tmp', uniq)
         try:
             os.stat(path)
@@ -67,7 +75,7 @@ class Queue(object):
     most robust, but could implement others later.
     """
 
-    def __init__(self, queue_dir, safe=True, pop_limit=0, oversize_dir=None):
+    def __init__(self, queue_dir, safe=True, pop_limit=0, oversize_dir=None, shards=None):
         """
         This gives the Maildir queue directory to use, and whether you want
         this Queue to use the SafeMaildir variant which hashes the hostname
@@ -83,6 +91,11 @@ class Queue(object):
         The oversize protection only works on pop messages off, not
         putting them in, get, or any other call.  If you use get you can
         use self.oversize to also check if it's oversize manually.
+
+        With shards new/ is split into that many subdirectories and keys(),
+        len() and pop() use an index of the pending messages instead of
+        listing the Maildir, see salmonqueueindex.  Without shards the queue
+        keeps the layout it was created with (by the receiver).
         """
         self.dir = queue_dir
 
@@ -91,8 +104,13 @@ class Queue(object):
         else:
             self.mbox = mailbox.Maildir(queue_dir)
 
+        self.shards = salmonqueueindex.setup_layout(queue_dir, shards)
+        self._index = None
+
         self.pop_limit = pop_limit
+        self._setup_oversize(oversize_dir)
 
+    def _setup_oversize(self, oversize_dir):
         if oversize_dir:
             if not os.path.exists(oversize_dir):
                 mailbox.Maildir(oversize_dir)
@@ -111,7 +129,12 @@ class Queue(object):
         """
         if not isinstance(message.Data, (six.text_type, six.binary_type)):
             message = str(message)
-        return self.mbox.add(message.Data)
+        key = self.mbox.add(message.Data)
+        if self.shards:
+            os.rename(os.path.join(self.dir, "new", key), self.new_path(key))
+        if self._index is not None:
+            self._index.add(key)
+        return key
 
     def pop(self):
         """
@@ -120,18 +143,15 @@ class Queue(object):
 
         It returns a (key, message) tuple for that item.
         """
+        if self.shards:
+            batch = self.pop_batch(1)
+            return batch[0] if batch else (None, None)
+
         for key in self.mbox.iterkeys():
             over, over_name = self.oversize(key)
 
             if over:
-                if self.oversize_dir:
-                    logging.info("Message key %s over size limit %d, moving to %s.",
-                                 key, self.pop_limit, self.oversize_dir)
-                    os.rename(over_name, os.path.join(self.oversize_dir, key))
-                else:
-                    logging.info("Message key %s over size limit %d, DELETING (set oversize_dir).",
-                                 key, self.pop_limit)
-                    os.unlink(over_name)
+                self._drop_oversize(key, over_name)
             else:
                 try:
                     msg = self.get(key)
@@ -143,30 +163,257 @@ class Queue(object):
 
         return None, None
 
+    def pop_batch(self, n):
+        """
+        Pops up to n messages off the queue, the oldest ones first, and
+        returns a list of (key, message) tuples.  The keys come from the
+        index, the queue is listed again only when it runs empty.  Oversize
+        messages are moved away and not returned.
+        """
+        index = self.index()
+        if not len(index):
+            index = self.index(refresh=True)
+        batch = []
+        while len(batch) < n:
+            keys = index.pop(n - len(batch))
+            if not keys:
+                break
+            for key in keys:
+                try:
+                    msg = self.pop_key(key)
+                except KeyError:
+                    # popped by another process
+                    continue
+                if msg is not None:
+                    batch.append((key, msg))
+        return batch
+
+    def pop_key(self, key):
+        """
+        Pops the message with the given key off the queue.  Oversize messages
+        are moved away like in pop() and None is returned for them.  Raises
+        KeyError when there is no such message (any more).
+        """
+        try:
+            over, over_name = self.oversize(key)
+        except FileNotFoundError:
+            raise KeyError(key)
+        if over:
+            self._drop_oversize(key, over_name)
+            return None
+        try:
+            msg = self.get(key)
+        finally:
+            self.remove(key)
+        return msg
+
+    def _drop_oversize(self, key, over_name):
+        if self.oversize_dir:
+            logging.info("Message key %s over size limit %d, moving to %s.",
+                         key, self.pop_limit, self.oversize_dir)
+            os.rename(over_name, os.path.join(self.oversize_dir, key))
+        else:
+            logging.info("Message key %s over size limit %d, DELETING (set oversize_dir).",
+                         key, self.pop_limit)
+            os.unlink(over_name)
+
+    def index(self, refresh=False):
+        """
+        Returns the salmonqueueindex.QueueIndex of the pending messages.  It
+        is built by listing the queue the first time and with refresh,
+        after that it knows about what this Queue pushes and removes.
+        """
+        if self._index is None or refresh:
+            self._index = salmonqueueindex.QueueIndex(salmonqueueindex.scan(self.new_dirs()))
+        return self._index
+
+    def new_dirs(self):
+        """Returns the directories with the new messages."""
+        return salmonqueueindex.new_dirs(self.dir, self.shards)
+
+    def new_path(self, key):
+        """Returns the path of the new message with the given key."""
+        return salmonqueueindex.message_path(self.dir, key, self.shards)
+
     def get(self, key):
         """
         Get the specific message referenced by the key.  The message is NOT
-        removed from the queue.
+        removed from the queue.  Returns None when there is no such message.
         """
-        msg_file = self.mbox.get_file(key)
+        try:
+            # new/<key> is opened directly, mailbox lists the whole
+            # queue whenever it looks up a key it has not seen yet
+            msg_file = open(self.new_path(key), "rb")
+        except FileNotFoundError:
+            try:
+                msg_file = self.mbox.get_file(key)
+            except KeyError:
+                return None
 
-        if not msg_file:
-            return None
+        with msg_file:
+            msg_data = msg_file.read()
 
-        msg_data = msg_file.read()
+        return self._request(msg_data, self.get_metadata(key))
 
+    def _request(self, msg_data, metadata):
         try:
-            return mail.MailRequest(self.dir, None, None, msg_data)
+            msg = mail.MailRequest(self.dir, None, None, msg_data)
         except Exception as exc:
             logging.exception("Failed to decode message: %s; msg_data: %r",   exc, msg_data)
             return None
 
+        msg.metadata = metadata
+        return msg
+
+    def get_metadata(self, key):
+        """
+        Returns the metadata of the SMTP session (peer, user, sensor, ...)
+        which the receiver stored next to the message, or None.
+        """
+        try:
+            with open(salmonqueueindex.metadata_path(self.dir, key, self.shards)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
     def remove(self, key):
         """Removes the queue, but not returned."""
-        self.mbox.remove(key)
+        if self._index is not None:
+            self._index.discard(key)
+        try:
+            os.unlink(self.new_path(key))
+        except FileNotFoundError:
+            if self.shards:
+                raise KeyError(key)
+            self.mbox.remove(key)
+        try:
+            os.unlink(salmonqueueindex.metadata_path(self.dir, key, self.shards))
+        except OSError:
+            pass
+
+    def claim(self, key, worker):
+        """
+        Claims the message for the worker, so no other worker sharing the
+        queue gets it, and returns it.  The message is renamed into
+        processing/<worker>/ and its modification time is the start of the
+        lease, see reclaim.  Returns None when another worker was faster or
+        the message can't be decoded (it is dropped then like by pop).
+        Finish the message with complete.
+        """
+        path = self.processing_path(key, worker)
+        try:
+            # the lease starts before the message shows up in processing/, with the
+            # time it arrived another worker's reclaim could take it back right away
+            os.utime(self.new_path(key))
+            os.rename(self.new_path(key), path)
+        except FileNotFoundError:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                return self.claim(key, worker)
+            return None
+        if self._index is not None:
+            self._index.discard(key)
+
+        try:
+            with open(path, "rb") as msg_file:
+                msg = self._request(msg_file.read(), self.get_metadata(key))
+        except FileNotFoundError:
+            # reclaimed by another worker meanwhile
+            return None
+        if msg is None:
+            self.complete(key, worker)
+        return msg
+
+    def complete(self, key, worker):
+        """
+        Removes a message claimed by the worker.  Raises KeyError when the
+        worker doesn't hold it any more, e.g. its lease expired.
+        """
+        try:
+            os.unlink(self.processing_path(key, worker))
+        except FileNotFoundError:
+            raise KeyError(key)
+        try:
+            os.unlink(salmonqueueindex.metadata_path(self.dir, key, self.shards))
+        except OSError:
+            pass
+
+    def reclaim(self, lease, worker=None):
+        """
+        Puts messages claimed more than lease seconds ago (by a worker that
+        crashed or hangs) back into new/ and returns how many.  The claims
+        of worker are skipped, the worker renews them itself (see renew).
+        Every reclaimed message has one more failed attempt in its metadata.
+        """
+        expired = time.time() - lease
+        reclaimed = 0
+        processing = os.path.join(self.dir, PROCESSING_DIR)
+        try:
+            workers = os.listdir(processing)
+        except FileNotFoundError:
+            return 0
+        for holder in workers:
+            if holder == worker:
+                continue
+            try:
+                entries = list(os.scandir(os.path.join(processing, holder)))
+            except NotADirectoryError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime >= expired:
+                        continue
+                    os.rename(entry.path, self.new_path(entry.name))
+                except FileNotFoundError:
+                    # completed or reclaimed by someone else meanwhile
+                    continue
+                self._add_attempt(entry.name)
+                reclaimed += 1
+                logging.warning("Lease of message key %s claimed by %s expired, it is back in the queue.",
+                                entry.name, holder)
+        return reclaimed
+
+    def renew(self, keys, worker):
+        """Starts the leases of messages the worker holds again, e.g. while they wait in the pipeline."""
+        for key in keys:
+            try:
+                os.utime(self.processing_path(key, worker))
+            except FileNotFoundError:
+                pass
+
+    def release(self, key, worker):
+        """
+        Puts a message claimed by the worker back into new/ after a failed
+        attempt, which is counted in its metadata.  Raises KeyError when the
+        worker doesn't hold it any more.
+        """
+        try:
+            os.rename(self.processing_path(key, worker), self.new_path(key))
+        except FileNotFoundError:
+            raise KeyError(key)
+        self._add_attempt(key)
+
+    def _add_attempt(self, key):
+        path = salmonqueueindex.metadata_path(self.dir, key, self.shards)
+        metadata = self.get_metadata(key) or {}
+        metadata["attempts"] = metadata.get("attempts", 0) + 1
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(metadata, f)
+        os.replace(path + ".tmp", path)
+
+    def processing_path(self, key, worker):
+        """Returns the path of a message claimed by the worker."""
+        return os.path.join(self.dir, PROCESSING_DIR, worker, key)
 
     def __len__(self):
-        """Returns the number of messages in the queue."""
+        """
+        Returns the number of messages in the queue.  In the sharded layout
+        it is the number of indexed messages, messages pushed by other
+        processes are counted after the next keys().
+        """
+        if self.shards:
+            return len(self.index())
         return len(self.mbox)
 
     # synonym of __len__ for backwards compatibility
@@ -187,13 +434,153 @@ class Queue(object):
 
     def keys(self):
         """
-        Returns the keys in the queue.
+        Returns the keys in the queue.  In the sharded layout the queue is
+        listed into a fresh index and the keys are the oldest first.
         """
+        if self.shards:
+            return self.index(refresh=True).keys()
         return self.mbox.keys()
 
     def oversize(self, key):
         if self.pop_limit:
-            file_name = os.path.join(self.dir, "new", key)
+            file_name = self.new_path(key)
             return os.path.getsize(file_name) > self.pop_limit, file_name
         else:
             return False, None
+
+
+class SQLiteQueue(Queue):
+    """
+    Queue with the messages in an SQLite database in the queue directory
+    instead of a Maildir, see salmonsqlqueue.  It has the same API, pop()
+    and pop_batch() return the oldest messages first.
+    """
+
+    def __init__(self, queue_dir, pop_limit=0, oversize_dir=None, commit_interval=0):
+        self.dir = queue_dir
+        self.mbox = None
+        self.shards = 0
+        self.store = salmonsqlqueue.MessageStore(queue_dir, commit_interval)
+        self.pop_limit = pop_limit
+        self._setup_oversize(oversize_dir)
+
+    def push(self, message):
+        if isinstance(message.Data, (six.text_type, six.binary_type)):
+            msg_data = message.Data
+        else:
+            msg_data = str(message)
+        key = new_key()
+        mailbox.Maildir._count += 1
+        self.store.add(key, msg_data, getattr(message, "metadata", None))
+        return key
+
+    def pop(self):
+        batch = self.pop_batch(1)
+        return batch[0] if batch else (None, None)
+
+    def pop_batch(self, n):
+        """Pops up to n messages off the queue in one transaction."""
+        batch = []
+        while len(batch) < n:
+            rows = self.store.pop(n - len(batch))
+            if not rows:
+                break
+            for key, msg_data, metadata in rows:
+                msg = self._popped(key, msg_data, metadata)
+                if msg is not None:
+                    batch.append((key, msg))
+        return batch
+
+    def pop_key(self, key):
+        rows = self.store.pop(key=key)
+        if not rows:
+            raise KeyError(key)
+        return self._popped(*rows[0])
+
+    def _popped(self, key, msg_data, metadata):
+        if self.pop_limit and len(msg_data) > self.pop_limit:
+            self._drop_oversize(key, msg_data)
+            return None
+        return self._request(msg_data, metadata)
+
+    def _drop_oversize(self, key, msg_data):
+        if self.oversize_dir:
+            logging.info("Message key %s over size limit %d, moving to %s.",
+                         key, self.pop_limit, self.oversize_dir)
+            with open(os.path.join(self.oversize_dir, key), "wb") as f:
+                f.write(msg_data)
+        else:
+            logging.info("Message key %s over size limit %d, DELETING (set oversize_dir).",
+                         key, self.pop_limit)
+
+    def get(self, key):
+        row = self.store.get(key)
+        if row is None:
+            return None
+        return self._request(*row)
+
+    def get_metadata(self, key):
+        return self.store.get_metadata(key)
+
+    def remove(self, key):
+        if not self.store.remove(key):
+            raise KeyError(key)
+
+    def claim(self, key, worker):
+        row = self.store.claim(key, worker)
+        if row is None:
+            return None
+        msg = self._request(*row)
+        if msg is None:
+            self.complete(key, worker)
+        return msg
+
+    def complete(self, key, worker):
+        if not self.store.complete(key, worker):
+            raise KeyError(key)
+
+    def reclaim(self, lease, worker=None):
+        reclaimed = self.store.reclaim(lease, worker)
+        if reclaimed:
+            logging.warning("Leases of %d messages expired, they are back in the queue.", reclaimed)
+        return reclaimed
+
+    def renew(self, keys, worker):
+        self.store.renew(keys, worker)
+
+    def release(self, key, worker):
+        if not self.store.release(key, worker):
+            raise KeyError(key)
+
+    def __len__(self):
+        return len(self.store)
+
+    count = __len__
+
+    def clear(self):
+        self.store.clear()
+
+    def keys(self):
+        return self.store.keys()
+
+    def oversize(self, key):
+        size = self.store.size(key)
+        if size is None:
+            raise KeyError(key)
+        return bool(self.pop_limit) and size > self.pop_limit, None
+
+
+def open_queue(queue_dir, backend=None, **kwargs):
+    """
+    Returns the queue in queue_dir, a Queue (Maildir) or an SQLiteQueue
+    depending on backend.  Without backend it is the one the receiver
+    set up in queue_dir.
+    """
+    if backend is None:
+        backend = "sqlite" if salmonsqlqueue.exists(queue_dir) else "maildir"
+    if backend == "sqlite":
+        kwargs.pop("shards", None)
+        return SQLiteQueue(queue_dir, **kwargs)
+    if backend != "maildir":
+        raise ValueError("unknown queue backend %r" % backend)
+    return Queue(queue_dir, **kwargs)
@@ -6,6 +6,8 @@ from __future__ import print_function, unicode_literals
 
 import asyncore
 import logging
+import os
+import signal
 import smtpd
 import smtplib
 import threading
@@ -13,13 +15,14 @@ import time
 import traceback
 import socket
 import logging
-import re
 
 from dns import resolver
 import lmtpd
 import six
 
-from salmon import __version__, mail, queue, routing, salmonmailparser, salmonscheduler
+from salmon import (__version__, mail, queue, routing, salmondb, salmonmailparser, salmonqueueindex, salmonscheduler,
+                    salmonstartup, salmonwatcher)
+from salmon import utils
 from salmon.bounce import COMBINED_STATUS_CODES, PRIMARY_STATUS_CODES, SECONDARY_STATUS_CODES
 
 lmtpd.__version__ = "Salmon Mail router LMTPD, version %s" % __version__
@@ -123,28 +126,54 @@ class Relay(object):
         You can pass in an alternate To and From, which will be used in the
         SMTP/LMTP send lines rather than what's in the message.
         """
+        hostname = self.hostname or self.resolve_relay_host(self.envelope(message, To, From)[0])
+        relay_host = self.configure_relay(hostname)
+        self.deliver_with(relay_host, message, To, From)
+        relay_host.quit()
+
+    def envelope(self, message, To=None, From=None):
+        """Returns the recipient and the sender the message is sent with."""
         # Check in multiple places for To and From.
         # Ordered in preference.
         recipient = To or getattr(message, 'To', None) or message['To']
         sender = From or getattr(message, 'From', None) or message['From']
+        return recipient, sender
 
-        hostname = self.hostname or self.resolve_relay_host(recipient)
-        relay_host = self.configure_relay(hostname)
+    def deliver_with(self, relay_host, message, To=None, From=None):
+        """
+        Sends the message over relay_host, a connection made by
+        configure_relay, and leaves it open.  See deliver for To and From.
+        """
+        recipient, sender = self.envelope(message, To, From)
+        manifest = (getattr(message, "metadata", None) or {}).get("recipients")
+        if manifest:
+            self.deliver_to_recipients(relay_host, sender, message, manifest)
+            return
         logging.debug("Sending email from %s to %s (To field)" % (sender, recipient))
         bcc = message.get_bcc()
         if len(bcc) > 0:
-            bcc_pos = re.search(b"\nBcc:", message.Data)
-            start = bcc_pos.start()
-            date_pos = re.search(b"\nDate:", message.Data)
-            end = date_pos.end() - 6
-            to_remove = message.Data[start:end]
             for email in bcc:
-                data = message.Data
-                data = data.replace(to_remove,  b"\nBcc: " + bytes(email, encoding="utf-8"))
+                # every BCC recipient sees only itself in the Bcc header
+                data = message.header_index.set_header("Bcc", email)
                 relay_host.sendmail(sender, recipient.split(",") + [email], data)
         else:
             relay_host.sendmail(sender, recipient.split(","), message.Data)
-        relay_host.quit()
+
+    def deliver_to_recipients(self, relay_host, sender, message, recipients):
+        """
+        Delivers a message stored once for all its envelope recipients (the
+        recipient manifest in the metadata sidecar).  The recipients named
+        in To or Cc get one copy without the Bcc header, every other one
+        gets its own copy with only its address in Bcc.
+        """
+        visible = set(message.get_header_recipients())
+        to_visible = [email for email in recipients if email.lower() in visible]
+        blind = [email for email in recipients if email.lower() not in visible]
+        logging.debug("Sending email from %s to %s, blind copies to %s" % (sender, to_visible, blind))
+        if to_visible:
+            relay_host.sendmail(sender, to_visible, message.header_index.remove_header("Bcc"))
+        for email in blind:
+            relay_host.sendmail(sender, [email], message.header_index.set_header("Bcc", email))
 
     def resolve_relay_host(self, To):
         target_host = To.split("@")[1]
@@ -317,43 +346,178 @@ class QueueReceiver(object):
     """
     totalRelay = 0  # Global relay counter
 
-    def __init__(self, queue_dir, sleep=2, size_limit=0, oversize_dir=None):
+    def __init__(self, queue_dir, sleep=2, size_limit=0, oversize_dir=None, rescan=60, shards=None,
+                 backend=None, worker=None, lease=600, pipeline=None, overload=None, attempts=3):
         """
         The router should be fully configured and ready to work, the queue_dir
         can be a fully qualified path or relative. The option workers dictates
         how many threads are started to process messages. Consider adding
         ``@nolocking`` to your handlers if you are able to.
+        New messages are reported by inotify, the whole queue is listed only
+        after rescan seconds without any (sleep is used without inotify).
+        With shards the queue is switched to the sharded layout, see
+        salmonqueueindex.  The backend (maildir or sqlite) is the one of the
+        queue_dir by default, see queue.open_queue.
+        Every message is claimed (see Queue.claim) by the worker (hostname
+        and pid by default) before it is processed, so several relay
+        processes can share the queue.  Messages claimed more than lease
+        seconds ago by a worker that died are put back into the queue, the
+        worker renews the leases of the messages it holds.  A message which
+        failed attempts times (0 tries forever) is moved to the undeliverable
+        directory instead of being processed again.
+        With a pipeline (see salmonpipeline.RelayPipeline) the claimed
+        messages are parsed, rated and delivered in its stages and completed
+        when they are delivered, instead of one after another.
+        With overload (see salmonoverload.Overload) the messages are scored
+        in degraded mode while the queue is too deep or its messages too old.
         """
-        self.queue = queue.Queue(queue_dir, pop_limit=size_limit,
-                                 oversize_dir=oversize_dir)
+        self.queue = queue.open_queue(queue_dir, backend, pop_limit=size_limit,
+                                      oversize_dir=oversize_dir, shards=shards)
+        self.backend = backend
         self.queue_dir = queue_dir
         self.sleep = sleep
+        self.rescan = rescan
+        self.worker = worker
+        self.lease = lease
+        self.pipeline = pipeline
+        self.overload = overload
+        self.attempts = attempts
+        # keys of the messages this worker holds, their leases are renewed
+        self.claimed = set()
+        self.claimed_lock = threading.Lock()
 
     def start(self, one_shot=False):
         """
-        Start simply loops indefinitely sleeping and pulling messages
-        off for processing when they are available.
+        Start processes the messages already in the queue and then waits
+        for new ones with salmonwatcher.QueueWatcher.
 
         If you give one_shot=True it will stop once it has exhausted the queue
         """
 
-        logging.info("Queue receiver started on queue dir %s", self.queue_dir)
+        worker = self.worker or "%s-%d" % (socket.gethostname(), os.getpid())
+        logging.info("Queue receiver %s started on queue dir %s", worker, self.queue_dir)
+        inq = None
+        if self.pipeline is not None:
+            # started first, its processes are forked before any thread or queue connection exists
+            self.pipeline.start(lambda key: self.complete(inq, key, worker),
+                                lambda key, msg: self.fail(inq, key, worker, msg))
+        else:
+            # with the pipeline, its parse processes load the NLP model
+            salmonstartup.warm_up()
         salmonscheduler.schedule()
-        inq = queue.Queue(self.queue_dir)
+        # the emails stored before the ssdeep index existed are indexed while the queue drains
+        salmondb.start_backfill()
+        inq = queue.open_queue(self.queue_dir, self.backend)
+        # nothing is held yet, the claims a previous run of this worker left are reclaimed too
+        inq.reclaim(self.lease)
+        reclaimed = time.time()
+        threading.Thread(target=self.renew, args=(inq, worker), name="lease-renew", daemon=True).start()
+
+        # the watch is set up before the first listing, so nothing is missed in between
+        watcher = None
+        if not one_shot:
+            watcher = salmonwatcher.QueueWatcher(inq, rescan=self.rescan, sleep=self.sleep)
+        keys = inq.keys()
 
         while True:
-            keys = inq.keys()
-            for key in keys:
-                msg = inq.get(key)
-                if msg:
-                    logging.info("Pulled message with key: %r off", key)
-                    salmonmailparser.process_email(key, msg)
-                    logging.info("Removed %r key from queue.\n\n", key)
-                inq.remove(key)
+            for i, key in enumerate(keys):
+                degraded = self.degraded(len(keys) - i, key)
+                msg = inq.claim(key, worker)
+                if msg is None:
+                    # claimed by another worker or already gone
+                    continue
+                failed = (msg.metadata or {}).get("attempts", 0)
+                if self.attempts and failed >= self.attempts:
+                    self.give_up(inq, key, worker, msg, failed)
+                    continue
+                with self.claimed_lock:
+                    self.claimed.add(key)
+                logging.info("Pulled message with key: %r off", key)
+                if self.pipeline is not None:
+                    self.pipeline.submit(key, msg, degraded)
+                    continue
+                try:
+                    salmonmailparser.process_email(key, msg, degraded)
+                except Exception:
+                    logging.exception("Processing message key %r failed.", key)
+                    self.fail(inq, key, worker, msg)
+                    continue
+                self.complete(inq, key, worker)
+            if self.pipeline is not None:
+                # the listing is done, the last batch doesn't wait for more messages
+                self.pipeline.flush()
             if one_shot:
+                if self.pipeline is not None:
+                    self.pipeline.stop()
                 return
-            else:
-                time.sleep(self.sleep)
+            if time.time() - reclaimed >= self.lease / 2:
+                inq.reclaim(self.lease, worker)
+                reclaimed = time.time()
+            keys = watcher.keys()
+
+    def degraded(self, depth, key):
+        """Returns True when the message with the key is scored in degraded
+        mode, depth is the number of messages left in the queue listing."""
+        if self.overload is None:
+            return False
+        if self.pipeline is not None:
+            depth += self.pipeline.pending
+        return self.overload.check(depth, salmonqueueindex.age(key))
+
+    def complete(self, inq, key, worker):
+        """Removes a processed message from the queue, see Queue.complete."""
+        with self.claimed_lock:
+            self.claimed.discard(key)
+        try:
+            inq.complete(key, worker)
+            logging.info("Removed %r key from queue.\n\n", key)
+        except KeyError:
+            logging.warning("Lease of message key %r expired while it was processed, "
+                            "it may be processed twice.", key)
+
+    def fail(self, inq, key, worker, msg):
+        """
+        Puts a message whose processing failed back into the queue (see
+        Queue.release), or moves it to the undeliverable directory when it
+        failed attempts times.
+        """
+        failed = (msg.metadata or {}).get("attempts", 0) + 1
+        if self.attempts and failed >= self.attempts:
+            self.give_up(inq, key, worker, msg, failed)
+            return
+        with self.claimed_lock:
+            self.claimed.discard(key)
+        try:
+            inq.release(key, worker)
+            logging.warning("Message key %r failed, it is back in the queue.", key)
+        except KeyError:
+            logging.warning("Lease of message key %r expired while it was processed.", key)
+
+    def give_up(self, inq, key, worker, msg, failed):
+        """Moves a message which failed too many times to the undeliverable directory."""
+        logging.error("Message key %r failed %d times, it is moved to the undeliverable directory.", key, failed)
+        try:
+            salmonmailparser.move_to_undeliverable(key, msg)
+        except Exception:
+            logging.exception("Moving message key %r to the undeliverable directory failed.", key)
+        self.complete(inq, key, worker)
+
+    def renew(self, inq, worker):
+        """
+        Renews the leases of the messages the worker holds every quarter of
+        the lease, so they aren't reclaimed while they wait in the pipeline
+        or for a delivery retry.
+        """
+        while True:
+            time.sleep(self.lease / 4)
+            with self.claimed_lock:
+                keys = list(self.claimed)
+            if not keys:
+                continue
+            try:
+                inq.renew(keys, worker)
+            except Exception:
+                logging.exception("Renewing the leases of %d messages failed.", len(keys))
 
     def process_message(self, msg):
         """
@@ -375,3 +539,88 @@ class QueueReceiver(object):
             logging.exception("Exception while processing message from Peer: "
                               "%r, From: %r, to To %r.", msg.Peer, msg.From, msg.To)
             undeliverable_message(msg.Data, "Router failed to catch exception.")
+
+
+class QueueWorkers(object):
+    """
+    Runs the QueueReceiver in several processes which all drain the same
+    queue.  Every message is claimed by one of them (see Queue.claim), the
+    messages of a worker that died are processed by the others after the
+    lease expired.  The limit of relayed emails (globalcounter) applies to
+    every worker on its own.
+
+    The parent process (the one in the salmon pid file) only supervises: it
+    starts a new worker when one dies and passes SIGHUP/SIGTERM from
+    `salmon stop` on to the workers.
+    """
+    respawn_delay = 1
+
+    def __init__(self, receiver, workers=2):
+        self.receiver = receiver
+        self.workers = workers
+        self.children = {}
+        self.stopping = False
+
+    def start(self):
+        """
+        Forks the workers and supervises them, it blocks until the workers
+        are stopped.
+        """
+        logging.info("QueueWorkers starting %d workers on queue dir %s.", self.workers, self.receiver.queue_dir)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+
+        for i in range(self.workers):
+            self.spawn()
+        self.supervise()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker()
+        self.children[pid] = time.time()
+
+    def run_worker(self):
+        """Body of the forked worker process, it never returns."""
+        status = 0
+        try:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            # connections opened by the settings before the fork belong to the parent
+            salmondb.session.close()
+            salmondb.engine.dispose()
+            if utils.settings.data["relay"]["mqtt"]:
+                utils.settings.client.connect()
+            self.receiver.start()
+        except Exception:
+            logging.exception("Queue worker %d crashed.", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def supervise(self):
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+
+            logging.error("Queue worker %d exited with status %d, starting a new one.", pid, status)
+            if time.time() - started < self.respawn_delay:
+                # don't fork in a tight loop when the workers can't start at all
+                time.sleep(self.respawn_delay)
+            self.spawn()
+
+        logging.info("QueueWorkers stopped.")
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -4,45 +4,87 @@
 # relay server requires authentication, `starttls' (boolean) or `ssl' (boolean)
 # for secure connections.
 import os
+import sys
 import yaml
 import iottl
 import logging
 import json
-import spacy
 import warnings
 warnings.filterwarnings("ignore")
+from salmon import salmondb
+from salmon import salmonstartup
 from salmon.salmonconclude import push_into_db
+from salmon.salmonnlp import NlpService
 from salmon.salmondb import Settings
 from salmon.salmondb import are_credentials_in_db
+from salmon.salmondb import index_minhash_signatures
 
 
 confpath = os.path.dirname(os.path.realpath(__file__)) + "/../../../configuration/salmon.yaml"
-with open(confpath) as f:
+with salmonstartup.step('salmon.yaml'), open(confpath) as f:
     data = yaml.load(f, Loader=yaml.FullLoader)
 
 relay_config = {'host': data['relay']['relayhost'], 'port': data['relay']['relayport']}
-receiver_config = {'maildir': data['directory']['queuepath']}
+receiver_config = {'maildir': data['directory']['queuepath'], 'rescan': data['relay'].get('queue_rescan', 60),
+                   'shards': data['global'].get('queue_shards', 0),
+                   'backend': data['global'].get('queue_backend', 'maildir'),
+                   'workers': data['relay'].get('workers', 1), 'lease': data['relay'].get('queue_lease', 600),
+                   'attempts': data['relay'].get('queue_attempts', 3)}
+pipeline_config = {'enabled': data['relay'].get('pipeline', False),
+                   'parse_workers': data['relay'].get('parse_workers', 2),
+                   'delivery_threads': data['relay'].get('delivery_threads', 4),
+                   'queue_size': data['relay'].get('pipeline_queue', 100),
+                   'report': data['relay'].get('pipeline_report', 60),
+                   'batch_size': data['relay'].get('nlp_batch', 16) if data['relay']['analyze_text'] else 1}
+nlp_config = {'model': data['relay'].get('nlp_model', 'en_core_web_sm'),
+              'exclude': data['relay'].get('nlp_exclude', ['parser', 'lemmatizer', 'senter']),
+              'batch_size': data['relay'].get('nlp_batch', 16), 'processes': data['relay'].get('nlp_processes', 1),
+              'max_chars': data['relay'].get('nlp_max_chars', 20000)}
+nlp_warm_up = data['relay'].get('nlp_warm_up', True)
+delivery_config = {'retries': data['relay'].get('delivery_retries', 2),
+                   'retry_delay': data['relay'].get('delivery_retry_delay', 1),
+                   'keepalive': data['relay'].get('delivery_keepalive', 30)}
+fastpath_config = {'enabled': data['relay'].get('fastpath', False),
+                   'host': data['receiver']['listenhost'], 'port': data['receiver']['listenport'],
+                   'journal': 'run/journal' if data['relay'].get('fastpath_journal', True) else None,
+                   'commit_interval': data['global'].get('queue_commit_interval', 0),
+                   'queue_size': data['relay'].get('fastpath_queue', 1000)}
+overload_config = {'depth': data['relay'].get('overload_depth', 0), 'age': data['relay'].get('overload_age', 0)}
 handlers = data['global']['handlers']
 router_defaults = data['global']['router_defaults']
 
 if data['relay']['mqtt']:
-    client = iottl.Hermes(data['relay']['mqtt_server'], username=data['relay']['mqtt_username'], password=data['relay']['mqtt_password'])
-    if not client.connect():
-        logging.error('ERROR: Failed to connect to server!')
-        sys.exit(1)
+    with salmonstartup.step('mqtt'):
+        client = iottl.Hermes(data['relay']['mqtt_server'], username=data['relay']['mqtt_username'], password=data['relay']['mqtt_password'])
+        if not client.connect():
+            logging.error('ERROR: Failed to connect to server!')
+            sys.exit(1)
 
 if data["relay"]["use_rule_file"]:
-    with open(os.path.dirname(os.path.realpath(__file__)) + "/../../../configuration/rules.json") as json_file:
-        rules = json.load(json_file)
+    with salmonstartup.step('rules'):
+        with open(os.path.dirname(os.path.realpath(__file__)) + "/../../../configuration/rules.json") as json_file:
+            rules = json.load(json_file)
 
 if data["relay"]["analyze_text"]:
-    nlp = spacy.load("en_core_web_sm")
+    # the model is loaded on the first email, or in the background once the relay has started
+    nlp = NlpService(**nlp_config)
+    if nlp_warm_up:
+        salmonstartup.add_warm_up(nlp.warm_up)
+
+# the tables missing in the database are created before anything reads or writes it
+with salmonstartup.step('database'):
+    salmondb.init()
+
+# the emails stored before the minhash similarity backend was turned on get their signatures
+if data['relay'].get('similarity', 'ssdeep') != 'ssdeep':
+    with salmonstartup.step('minhash signatures'):
+        index_minhash_signatures()
 
 # push username and password into database if it is not already there
-for i in range(0, len(data['receiver']['credentials']), 2):
-    username = data['receiver']['credentials'][i].strip('()')
-    password = data['receiver']['credentials'][i+1].strip('()')
-    if not are_credentials_in_db(username, password):
-        credentials = Settings(username, password)
-        push_into_db(credentials)
-# the config/boot.py will turn these values into variables set in settings
+with salmonstartup.step('credentials'):
+    for i in range(0, len(data['receiver']['credentials']), 2):
+        username = data['receiver']['credentials'][i].strip('()')
+        password = data['receiver']['credentials'][i+1].strip('()')
+        if not are_credentials_in_db(username, password):
+            credentials = Settings(username, password)
+            push_into_db(credentials)
@@ -0,0 +1,167 @@
+"""
+Benchmark of the way from the receiver to the relay.
+
+It sends emails to a running honeypot over SMTP and waits until the relay
+saved them into the rawspams directory (save_eml must be on), then it prints
+how many emails per second went through and how long it took from sending an
+email to its saved eml. Run it against the split mode (salmon-receiver and
+salmon-relay) and against the fast path (fastpath: True, salmon-relay only)
+to compare them, e.g. from hermes/salmon-relay/myproject:
+    python benchmark_fastpath.py --messages 2000 --clients 8
+--rate sends the emails at a fixed rate instead of as fast as possible, the
+latency is only meaningful below the throughput of the relay.
+"""
+
+import argparse
+import os
+import smtplib
+import threading
+import time
+import uuid
+
+import yaml
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--target", type=str, default=None, help="host:port of the receiver, "
+                        "listenhost and listenport of salmon.yaml by default")
+    parser.add_argument("--rawspams", type=str, default=None, help="Directory the relay saves the emails "
+                        "into, rawspampath of salmon.yaml by default")
+    parser.add_argument("--config", type=str, default="../../configuration/salmon.yaml", help="Path of salmon.yaml")
+    parser.add_argument("--messages", "-m", type=int, default=1000, help="Number of emails sent")
+    parser.add_argument("--clients", "-c", type=int, default=4, help="Number of concurrent SMTP sessions")
+    parser.add_argument("--rate", "-r", type=float, default=0, help="Emails per second, 0 sends them "
+                        "as fast as the receiver takes them")
+    parser.add_argument("--size", "-s", type=int, default=4096, help="Size of the email body in bytes")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for the relay")
+    return parser.parse_args()
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.deferred = 0
+        self.failed = 0
+
+
+def make_email(run, i, size):
+    line = "benchmark of the way from the receiver to the relay, email %d\r\n" % i
+    body = (line * (size // len(line) + 1))[:size]
+    return (
+        "From: bench@example.com\r\n"
+        "To: victim@example.com\r\n"
+        "Subject: relay benchmark %d\r\n"
+        "X-Benchmark-Run: %s\r\n"
+        "X-Benchmark-Sent: %.6f\r\n\r\n%s" % (i, run, time.time(), body)
+    )
+
+
+def send(host, port, run, numbers, args, stats, started):
+    client = None
+    for i in numbers:
+        if args.rate:
+            # every client sends its share of the emails at its share of the rate
+            delay = started + i / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            if client is None:
+                client = smtplib.SMTP(host, port, timeout=60)
+            client.sendmail("bench@example.com", ["victim@example.com"], make_email(run, i, args.size))
+            result = "accepted"
+        except smtplib.SMTPResponseException as err:
+            result = "deferred" if 400 <= err.smtp_code < 500 else "failed"
+            client = None
+        except (smtplib.SMTPException, OSError):
+            result = "failed"
+            client = None
+        with stats.lock:
+            setattr(stats, result, getattr(stats, result) + 1)
+    if client is not None:
+        client.quit()
+
+
+def read_sent_time(path, run):
+    """Returns the X-Benchmark-Sent time of the saved email of this run, None for other emails."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(4096).decode("utf-8", "replace")
+    except OSError:
+        return None
+    if "X-Benchmark-Run: %s" % run not in head:
+        return None
+    for line in head.splitlines():
+        if line.startswith("X-Benchmark-Sent:"):
+            return float(line.split(":", 1)[1])
+    return None
+
+
+def collect(rawspams, run, expected, seen, timeout):
+    """Waits until the expected number of emails of this run is saved, returns
+    a list of (sent, saved) times."""
+    times = []
+    deadline = time.time() + timeout
+    while len(times) < expected and time.time() < deadline:
+        for entry in os.scandir(rawspams):
+            if entry.name in seen:
+                continue
+            sent = read_sent_time(entry.path, run)
+            if sent is None:
+                # written just now, or not from this run
+                if time.time() - entry.stat().st_mtime > 5:
+                    seen.add(entry.name)
+                continue
+            seen.add(entry.name)
+            times.append((sent, entry.stat().st_mtime))
+        time.sleep(0.2)
+    return times
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def main():
+    args = parse_arguments()
+    config = {}
+    if args.target is None or args.rawspams is None:
+        with open(args.config) as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+    if args.target:
+        host, port = args.target.rsplit(":", 1)
+    else:
+        host, port = config["receiver"]["listenhost"], config["receiver"]["listenport"]
+    rawspams = args.rawspams or config["directory"]["rawspampath"]
+
+    run = uuid.uuid4().hex
+    seen = set(os.listdir(rawspams))
+    stats = Stats()
+    started = time.time()
+    clients = [
+        threading.Thread(target=send, args=(host, int(port), run, range(i, args.messages, args.clients),
+                                            args, stats, started))
+        for i in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    sent = time.time() - started
+    print("Sent %d emails in %.1f s (%.1f/s): %d accepted, %d deferred, %d failed." % (
+        args.messages, sent, args.messages / sent, stats.accepted, stats.deferred, stats.failed))
+
+    times = collect(rawspams, run, stats.accepted, seen, args.timeout)
+    if not times:
+        print("No email was saved, is save_eml on?")
+        return
+    elapsed = max(saved for sent, saved in times) - started
+    latencies = sorted(max(saved - sent, 0) for sent, saved in times)
+    print("Relay saved %d emails in %.1f s: %.1f emails/s." % (len(times), elapsed, len(times) / elapsed))
+    print("Latency from sending to the saved eml: median %.3f s, 95%% %.3f s, max %.3f s." % (
+        percentile(latencies, 0.5), percentile(latencies, 0.95), latencies[-1]))
+
+
+if __name__ == "__main__":
+    main()
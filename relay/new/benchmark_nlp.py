@@ -0,0 +1,112 @@
+"""
+Benchmark of the text analysis of the relay (analyze_text).
+
+The relay used to load the whole en_core_web_sm and run it on every email
+separately. Now salmonnlp loads only the components the relay uses and the
+pipeline analyzes the emails parsed together with nlp.pipe, see
+salmonconclude.analyze_texts. This script analyzes every eml of a directory
+(the body for the rating and the subject, body_plain and body_html for the
+document vectors) both ways and prints the emails per second, e.g. from
+hermes/salmon-relay/myproject with the emails the relay saved (save_eml must be on):
+    python benchmark_nlp.py --batches 1 16 64 --processes 1 2
+"""
+
+import argparse
+import logging
+import os
+import time
+
+import spacy
+import yaml
+
+from salmon import salmonconclude, salmonmailparser, salmonnlp, salmonspam, salmonvectors, utils
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--emails", type=str, default=None, help="Directory with the eml files, "
+                        "rawspampath of salmon.yaml by default")
+    parser.add_argument("--config", type=str, default="../../configuration/salmon.yaml", help="Path of salmon.yaml")
+    parser.add_argument("--model", type=str, default="en_core_web_sm", help="Name or path of the spaCy model")
+    parser.add_argument("--limit", "-l", type=int, default=0, help="Number of emails read at most, 0 reads all")
+    parser.add_argument("--rounds", "-r", type=int, default=2, help="Number of times every email is analyzed")
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 16, 64], help="Numbers of emails analyzed at once")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1], help="Numbers of the processes of nlp.pipe")
+    parser.add_argument("--max-chars", type=int, default=20000, help="Characters of a text passed to the model")
+    return parser.parse_args()
+
+
+def read_emails(directory, limit):
+    emails = []
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if not entry.is_file():
+            continue
+        with open(entry.path, "rb") as f:
+            mail_fields = salmonmailparser.parse_email(entry.name, f.read())
+        if mail_fields is not None:
+            emails.append(mail_fields)
+        if limit and len(emails) >= limit:
+            break
+    return emails
+
+
+def analyze_one_by_one(nlp, emails):
+    """How the relay analyzed the emails before, one model call per text."""
+    for mail_fields in emails:
+        text = salmonconclude.get_analyzed_text(mail_fields)
+        if text is not None:
+            salmonspam.get_text_features(nlp, text)
+        salmonvectors.get_doc_vectors(
+            nlp, str(mail_fields["subject"]), mail_fields["text"], salmonconclude.get_html_text(mail_fields)
+        )
+
+
+def analyze_in_batches(service, emails):
+    """How the pipeline analyzes the emails now, batch_size of them at once."""
+    utils.settings.nlp = service
+    for i in range(0, len(emails), service.batch_size):
+        salmonconclude.analyze_texts(emails[i:i + service.batch_size])
+
+
+def measure(function, nlp, emails, rounds):
+    started = time.perf_counter()
+    for i in range(rounds):
+        function(nlp, emails)
+    return len(emails) * rounds / (time.perf_counter() - started)
+
+
+def main():
+    args = parse_arguments()
+    directory = args.emails
+    if directory is None:
+        with open(args.config) as f:
+            directory = yaml.load(f, Loader=yaml.FullLoader)["directory"]["rawspampath"]
+    emails = read_emails(directory, args.limit)
+    if not emails:
+        print("No email in %s." % directory)
+        return
+    # parse_email and the model log every email
+    logging.disable(logging.CRITICAL)
+    utils.import_settings(False)
+
+    size = sum(len(mail_fields["text"] or salmonconclude.get_html_text(mail_fields)) for mail_fields in emails)
+    print("%d emails, %d characters of the body on average, %d rounds." % (
+        len(emails), size / len(emails), args.rounds))
+    whole = spacy.load(args.model)
+    print("One by one, the whole model (%s): %.1f emails/s" % (
+        ", ".join(whole.pipe_names), measure(analyze_one_by_one, whole, emails, args.rounds)))
+    slim = salmonnlp.NlpService(args.model, max_chars=args.max_chars)
+    # loaded here, the model is loaded on the first text otherwise
+    slim.warm_up()
+    print("One by one, without %s: %.1f emails/s" % (
+        ", ".join(salmonnlp.EXCLUDE), measure(analyze_one_by_one, slim, emails, args.rounds)))
+    for processes in args.processes:
+        slim.processes = processes
+        for batch in args.batches:
+            slim.batch_size = batch
+            print("Batches of %d, %d processes: %.1f emails/s" % (
+                batch, processes, measure(analyze_in_batches, slim, emails, args.rounds)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark of parsing the emails in the relay.
+
+The relay used to parse every email twice: MailRequest built a
+salmon.encoding.MailBase of it and salmonmailparser parsed the raw bytes
+again with email.parser. Now MailRequest reads From and To from its header
+index and parses the email once, on first use, for salmonmailparser and
+everything else. This script parses every eml of a directory both ways and
+prints the time per email, e.g. from hermes/salmon-relay/myproject with the
+emails the relay saved (save_eml must be on):
+    python benchmark_parse.py --rounds 5
+"""
+
+import argparse
+import email.parser
+import logging
+import os
+import time
+
+import yaml
+
+from salmon import encoding, mail, salmonmailparser
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--emails", type=str, default=None, help="Directory with the eml files, "
+                        "rawspampath of salmon.yaml by default")
+    parser.add_argument("--config", type=str, default="../../configuration/salmon.yaml", help="Path of salmon.yaml")
+    parser.add_argument("--limit", "-l", type=int, default=0, help="Number of emails read at most, 0 reads all")
+    parser.add_argument("--rounds", "-r", type=int, default=3, help="Number of times every email is parsed")
+    return parser.parse_args()
+
+
+def read_emails(directory, limit):
+    emails = []
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if not entry.is_file():
+            continue
+        with open(entry.path, "rb") as f:
+            emails.append((entry.name, f.read()))
+        if limit and len(emails) >= limit:
+            break
+    return emails
+
+
+def parse_twice(key, data):
+    """How the relay parsed an email before, returns the seconds spent
+    parsing and the seconds of the whole salmonmailparser.parse_email."""
+    started = time.perf_counter()
+    encoding.from_string(data)
+    message = email.parser.BytesParser().parsebytes(data)
+    parse_time = time.perf_counter() - started
+    salmonmailparser.parse_email(key, message)
+    return parse_time, time.perf_counter() - started
+
+
+def parse_once(key, data):
+    """How the relay parses an email now, see parse_twice."""
+    started = time.perf_counter()
+    mail_request = mail.MailRequest(key, None, None, data)
+    message = mail_request.message
+    parse_time = time.perf_counter() - started
+    salmonmailparser.parse_email(key, message)
+    return parse_time, time.perf_counter() - started
+
+
+def measure(function, emails, rounds):
+    parse_time = 0.0
+    total = 0.0
+    for i in range(rounds):
+        for key, data in emails:
+            parsed, spent = function(key, data)
+            parse_time += parsed
+            total += spent
+    count = len(emails) * rounds
+    return parse_time / count, total / count
+
+
+def main():
+    args = parse_arguments()
+    directory = args.emails
+    if directory is None:
+        with open(args.config) as f:
+            directory = yaml.load(f, Loader=yaml.FullLoader)["directory"]["rawspampath"]
+    emails = read_emails(directory, args.limit)
+    if not emails:
+        print("No email in %s." % directory)
+        return
+    # parse_email logs every email
+    logging.disable(logging.CRITICAL)
+
+    size = sum(len(data) for key, data in emails) / len(emails)
+    print("%d emails, %.1f kB on average, %d rounds." % (len(emails), size / 1024, args.rounds))
+    before = measure(parse_twice, emails, args.rounds)
+    after = measure(parse_once, emails, args.rounds)
+    print("Parsed twice: %.3f ms parsing, %.3f ms with parse_email per email." % (before[0] * 1000, before[1] * 1000))
+    print("Parsed once:  %.3f ms parsing, %.3f ms with parse_email per email." % (after[0] * 1000, after[1] * 1000))
+    print("Saved %.3f ms per email (%.0f%% of the parsing, %.0f%% with parse_email)." % (
+        (before[0] - after[0]) * 1000, 100 * (before[0] - after[0]) / before[0],
+        100 * (before[1] - after[1]) / before[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Benchmark of the similarity check of the relay.
+
+Spam.get_ids_for_similarity_check used to load all the email fields from
+the database and compare the ssdeep hash of every email with each of them.
+Now it compares it only with the candidates from the ssdeep index (see
+salmondb.get_similar_mail_fields), the ones with a common n-gram of the
+chunks of the same block size. This script stores the given numbers of
+generated emails in a temporary database, a few similar ones for every
+template, indexes them like salmondb does it after an upgrade and prints
+the time of one similarity check both ways, e.g. from
+hermes/salmon-relay/myproject:
+    python benchmark_similarity.py --sizes 10000 100000 1000000
+The old way loads everything for every email, it's run --full-queries times only.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import ssdeep
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from salmon import salmondb
+
+WORDS = (
+    "account password bank verify login click here update your details invoice payment "
+    "order shipping delivery package offer free winner prize claim now limited time "
+    "dear customer user security alert suspended confirm identity link below thank you"
+).split()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Numbers of the emails in the database")
+    parser.add_argument("--queries", "-q", type=int, default=200, help="Number of similarity checks with the index")
+    parser.add_argument("--full-queries", type=int, default=3, help="Number of similarity checks without it")
+    parser.add_argument("--similar", type=int, default=5, help="Number of similar emails of every template")
+    parser.add_argument("--seed", type=int, default=21)
+    return parser.parse_args()
+
+
+def make_text(generator, template):
+    text = list(template)
+    for i in range(generator.randint(0, len(text) // 10)):
+        text[generator.randrange(len(text))] = generator.choice(WORDS)
+    return " ".join(text)
+
+
+def make_template(generator):
+    return [generator.choice(WORDS) for i in range(generator.randint(30, 600))]
+
+
+def fill(session, count, similar, generator):
+    """Stores count emails, returns the templates."""
+    table = salmondb.MailFields.__table__
+    templates = []
+    rows = []
+    for i in range(count):
+        if i % similar == 0:
+            templates.append(make_template(generator))
+        rows.append({
+            "email_date": "0", "ssdeep": ssdeep.hash(make_text(generator, templates[-1])),
+            "length": 0, "attachment": False, "subject": "", "body_plain": "", "body_html": "",
+        })
+        if len(rows) == 10000:
+            session.execute(table.insert(), rows)
+            rows = []
+    if rows:
+        session.execute(table.insert(), rows)
+    session.commit()
+    return templates
+
+
+def check_full(ssdeep_hash):
+    """How the relay checked the similarity before, see Spam.get_ids_for_similarity_check."""
+    return [fields.id for fields in salmondb.get_mail_fields() if ssdeep.compare(ssdeep_hash, fields.ssdeep) >= 50]
+
+
+def check_indexed(ssdeep_hash):
+    """How the relay checks the similarity now."""
+    return [
+        fields.id for fields in salmondb.get_similar_mail_fields(ssdeep_hash)
+        if ssdeep.compare(ssdeep_hash, fields.ssdeep) >= 50
+    ]
+
+
+def measure(function, hashes):
+    started = time.perf_counter()
+    results = [function(ssdeep_hash) for ssdeep_hash in hashes]
+    return (time.perf_counter() - started) / len(hashes), results
+
+
+def run(size, args, directory):
+    generator = random.Random(args.seed)
+    path = os.path.join(directory, "similarity_%d.db" % size)
+    engine = create_engine("sqlite:///" + path, echo=False)
+    salmondb.Base.metadata.create_all(engine)
+    salmondb.session = sessionmaker(bind=engine)()
+
+    started = time.perf_counter()
+    templates = fill(salmondb.session, size, args.similar, generator)
+    filled = time.perf_counter() - started
+    started = time.perf_counter()
+    salmondb.index_mail_fields(batch_size=10000)
+    indexed = time.perf_counter() - started
+
+    # half of the checked emails are like the stored ones, half are new
+    hashes = []
+    for i in range(args.queries):
+        template = generator.choice(templates) if i % 2 == 0 else make_template(generator)
+        hashes.append(ssdeep.hash(make_text(generator, template)))
+    indexed_time, indexed_results = measure(check_indexed, hashes)
+    candidates = sum(len(salmondb.get_similar_mail_fields(ssdeep_hash)) for ssdeep_hash in hashes) / len(hashes)
+    full_time, full_results = measure(check_full, hashes[:args.full_queries])
+    same = all(sorted(a) == sorted(b) for a, b in zip(full_results, indexed_results))
+
+    print("%d emails: stored in %.1f s, indexed in %.1f s, %.0f MB with the index." % (
+        size, filled, indexed, os.path.getsize(path) / 2 ** 20))
+    print("  without the index: %.1f ms per email" % (full_time * 1000))
+    print("  with the index:    %.2f ms per email, %.1f candidates on average, %s results" % (
+        indexed_time * 1000, candidates, "same" if same else "DIFFERENT"))
+    salmondb.session.close()
+    engine.dispose()
+    os.remove(path)
+
+
+def main():
+    args = parse_arguments()
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            run(size, args, directory)
+
+
+if __name__ == "__main__":
+    main()
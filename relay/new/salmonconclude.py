@@ -12,14 +12,18 @@ Author: Silvie Chlupová
 Date    Created: 09/17/2019
 """
 
+import collections
 import logging
 import ssdeep
 import warnings
 warnings.filterwarnings("ignore")
-import re
 import os
 from datetime import datetime
+from salmon import salmonhtml
+from salmon import salmonminhash
 from salmon import salmonrelay
+from salmon import salmonurls
+from salmon import salmonvectors
 from salmon import utils
 from salmon.salmondb import MailFields
 from salmon.salmondb import MaybeTestMail
@@ -38,11 +42,16 @@ from salmon.salmondb import delete_maybetestmail_record
 from salmon.salmondb import update_link_rating
 from salmon.salmondb import email_into_db
 from salmon.salmondb import move_to_testmail
+from salmon.salmondb import get_similar_by_minhash
 from salmon.salmonspam import Spam
+from salmon.salmonspam import get_text_features as get_nlp_features
+from salmon.salmonspam import get_doc_features
 from salmon.salmonspam import update_statistics
 
+# similar emails found by each similarity backend since the start, see compare_similarity_backends
+similarity_counts = collections.Counter()
 
-def conclude(mail_fields, key, mail_request):
+def conclude(mail_fields, key, mail_request, deliver=True, degraded=False):
     """This is a key function of the whole relay part.
 
     Function calls other auxiliary functions and calculates the
@@ -52,9 +61,13 @@ def conclude(mail_fields, key, mail_request):
         mail_fields (dict): Email parsed in the dictionary.
         key (str): Name of the file picked up from queue/new.
         mail_request (MailRequest): Instance of the MailRequest class with eml data.
+        deliver (bool): Pass the email to salmonrelay, the pipeline (see salmonpipeline)
+            does it in its delivery stage instead.
+        degraded (bool): Skip the expensive checks (link history, text analysis and
+            similarity) while the relay is overloaded, see salmonoverload.
 
     Returns:
-        int: Final email rating when the environmental variable SALMON_SETTINGS_MODULE is set.
+        int: Final email rating.
     """
     logging.debug(
         "[+] (salmonconclude.py) - In conclude, started calculating the final spam rating."
@@ -65,14 +78,16 @@ def conclude(mail_fields, key, mail_request):
 
     # just for the testing purpose
     if mail_fields["text"] == "this is testing email from salmon":
-        salmonrelay.relay(mail_fields, key, mail_request, 100)
+        if deliver:
+            salmonrelay.relay(mail_fields, key, mail_request, 100)
         return 100
 
+    # the checks get the visible text of text/html, the database keeps the raw html
     spam = Spam(
         subject=str(mail_fields["subject"]),
         email_date=str(mail_fields["date"]),
         body_plain=mail_fields["text"],
-        body_html=mail_fields["html"],
+        body_html=get_html_text(mail_fields),
         ssdeep=mail_fields["ssdeep"],
         length=mail_fields["len"],
         attachment=attachment,
@@ -81,11 +96,19 @@ def conclude(mail_fields, key, mail_request):
         subject=spam.subject,
         email_date=spam.email_date,
         body_plain=spam.body_plain,
-        body_html=spam.body_html,
+        body_html=mail_fields["html"],
         ssdeep=spam.ssdeep,
         length=spam.length,
         attachment=spam.attachment,
     )
+    if utils.settings.data["relay"].get("similarity", "ssdeep") != "ssdeep":
+        # stored with the email fields, see salmondb.index_minhash
+        database_mail_fields.minhash = salmonminhash.get_signature(spam.subject, spam.body_plain, spam.body_html)
+    if utils.settings.data["relay"]["analyze_text"] and not degraded:
+        # stored with the email fields for the similarity checks of the next emails, see salmondb.store_doc_vectors
+        database_mail_fields.doc_vectors = mail_fields.get("doc_vectors")
+        if database_mail_fields.doc_vectors is None:
+            database_mail_fields.doc_vectors = get_doc_vectors(mail_fields)
     sender = Sender(mail_fields["from"], mail_fields["from_name"], database_mail_fields)
     recipient_model_list = spam.get_recipients_for_db(
         mail_fields["to"], database_mail_fields
@@ -101,7 +124,7 @@ def conclude(mail_fields, key, mail_request):
     # 3.check - check if the email contains links
     links_from_db = None
     links_into_db = None
-    if len(mail_fields["links"]) > 0:
+    if len(mail_fields["links"]) > 0 and not degraded:
         links_from_db = get_links()
         links_into_db = spam.get_links_for_db(mail_fields["links"], links_from_db)
 
@@ -125,11 +148,17 @@ def conclude(mail_fields, key, mail_request):
 
     # 9.check - analyze what is written in the email
     # this is optional and has to be set in the salmon.yaml
-    if utils.settings.data["relay"]["analyze_text"]:
+    if utils.settings.data["relay"]["analyze_text"] and not degraded:
         analyze_text(mail_fields, spam)
 
     # 10.check - verify that similar email is not already in the database
-    tables = get_tables_from_similar(spam)
+    if degraded:
+        logging.info(
+            "[+] (salmonconclude.py) - Relay is overloaded, skipping the link history, text analysis and similarity checks."
+        )
+        tables = []
+    else:
+        tables = get_tables_from_similar(spam, database_mail_fields.minhash, database_mail_fields.doc_vectors)
 
     # there is a very high probability that email is testing
     push_into_db_testing(
@@ -168,7 +197,7 @@ def conclude(mail_fields, key, mail_request):
     if is_recipient_in_testmail:
         recipient_in_testmail(spam)
 
-    if len(mail_fields["links"]) > 0:
+    if links_from_db is not None:
         spam.update_link_rating(mail_fields["links"], links_from_db)
 
     if links_into_db and spam.rating >= 50:
@@ -190,9 +219,9 @@ def conclude(mail_fields, key, mail_request):
     final_rating = spam.rating
 
     del spam
-    if "SALMON_SETTINGS_MODULE" in os.environ:
-        return final_rating
-    salmonrelay.relay(mail_fields, key, mail_request, final_rating)
+    if deliver and "SALMON_SETTINGS_MODULE" not in os.environ:
+        salmonrelay.relay(mail_fields, key, mail_request, final_rating)
+    return final_rating
 
 
 def recipient_in_testmail(spam):
@@ -246,19 +275,100 @@ def analyze_text(mail_fields, spam):
         mail_fields (dict): Email parsed in the dictionary.
         spam (Spam): Instance of the Spam class.
     """
-    url_regex_pattern = re.compile(
-        r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)"
-        "(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+"
-        "|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?\xab\xbb\u201c\u201d\u2018\u2019]))"
-    )
+    features = mail_fields.get("text_features")
+    if features is None:
+        features = get_text_features(mail_fields)
+    if features is not None:
+        spam.analyze_text_in_body(features, mail_fields)
+
+
+def get_text_features(mail_fields):
+    """Function runs the NLP model on body_plain, or body_html when there
+    is no body_plain, without the links. The pipeline calls it in its parse
+    processes and stores the result in mail_fields["text_features"].
+
+    Args:
+        mail_fields (dict): Email parsed in the dictionary.
+
+    Returns:
+        TextFeatures: Result of salmonspam.get_text_features, None without a body.
+    """
+    text = get_analyzed_text(mail_fields)
+    if text is None:
+        return None
+    return get_nlp_features(utils.settings.nlp, text)
+
+
+def get_analyzed_text(mail_fields):
+    """Function returns body_plain, or the visible text of body_html when
+    there is no body_plain, without the links.
+
+    Args:
+        mail_fields (dict): Email parsed in the dictionary.
+
+    Returns:
+        str: The text for the NLP analysis, None without a body.
+    """
     if mail_fields["text"]:
-        spam.analyze_text_in_body(
-            utils.settings.nlp, "plain", url_regex_pattern, mail_fields
-        )
+        text = mail_fields["text"]
     elif mail_fields["html"]:
-        spam.analyze_text_in_body(
-            utils.settings.nlp, "html", url_regex_pattern, mail_fields
-        )
+        text = get_html_text(mail_fields)
+    else:
+        return None
+    return salmonurls.remove_links(text)
+
+
+def analyze_texts(mail_fields_list):
+    """Function runs the NLP model on the texts of several emails at once,
+    see salmonnlp, and stores the results of get_text_features and
+    get_doc_vectors in mail_fields["text_features"] and mail_fields["doc_vectors"].
+
+    Args:
+        mail_fields_list (list): Emails parsed in the dictionaries.
+    """
+    bodies = [get_analyzed_text(mail_fields) for mail_fields in mail_fields_list]
+    fields = [
+        salmonvectors.get_texts(str(mail_fields["subject"]), mail_fields["text"], get_html_text(mail_fields))
+        for mail_fields in mail_fields_list
+    ]
+    texts = []
+    for body, field_texts in zip(bodies, fields):
+        # a body without anything but the links is analyzed too, like in get_text_features
+        if body is not None:
+            texts.append(body)
+        texts.extend(text for text in field_texts if text)
+    docs = iter(utils.settings.nlp.pipe(texts))
+    for mail_fields, body, field_texts in zip(mail_fields_list, bodies, fields):
+        mail_fields["text_features"] = get_doc_features(next(docs)) if body is not None else None
+        mail_fields["doc_vectors"] = salmonvectors.get_vectors([next(docs) if text else None for text in field_texts])
+
+
+def get_doc_vectors(mail_fields):
+    """Function computes the document vectors of the subject, body_plain
+    and body_html for the similarity checks. The pipeline calls it in its
+    parse processes and stores the result in mail_fields["doc_vectors"].
+
+    Args:
+        mail_fields (dict): Email parsed in the dictionary.
+
+    Returns:
+        numpy.ndarray: Result of salmonvectors.get_doc_vectors, None without any text.
+    """
+    return salmonvectors.get_doc_vectors(
+        utils.settings.nlp, str(mail_fields["subject"]), mail_fields["text"], get_html_text(mail_fields)
+    )
+
+
+def get_html_text(mail_fields):
+    """Function returns the visible text of body_html, see salmonhtml.
+
+    Args:
+        mail_fields (dict): Email parsed in the dictionary.
+
+    Returns:
+        str: Text of body_html without the markup, the raw html when it wasn't extracted.
+    """
+    return mail_fields.get("html_text", mail_fields["html"])
 
 
 def push_into_db_testing(records, spam, mail_fields, recipient, sender):
@@ -289,23 +399,24 @@ def push_into_db_testing(records, spam, mail_fields, recipient, sender):
         push_email_into_db(mail_fields, test_email, recipient, sender)
 
 
-def get_tables_from_similar(spam):
+def get_tables_from_similar(spam, signature=None, vectors=None):
     """Check if similar emails are in the database.
 
     Args:
         spam (Spam): Instance of the Spam class.
+        signature (numpy.ndarray): MinHash signature of the email, see salmonminhash.
+        vectors (numpy.ndarray): Document vectors of the email with analyze_text, see salmonvectors.
     
     Returns:
         list: List of similar records.
     """
-    similar_emails_ids = spam.get_ids_for_similarity_check()
+    similar_emails_ids = get_similar_emails_ids(spam, signature)
     records = []
     if similar_emails_ids:
-        for spam_id in similar_emails_ids:
-            if utils.settings.data["relay"]["analyze_text"]:
-                records_list = spam.get_records_if_similar(spam_id, utils.settings.nlp)
-                records.append(records_list)
-            else:
+        if utils.settings.data["relay"]["analyze_text"]:
+            records = spam.get_records_if_similar(similar_emails_ids, vectors, utils.settings.nlp)
+        else:
+            for spam_id in similar_emails_ids:
                 mail_fields_from_db = get_mail_fields_by_id(spam_id)
                 record = get_testmail_by_mailfield_id(mail_fields_from_db.id)
                 if record:
@@ -313,10 +424,6 @@ def get_tables_from_similar(spam):
                 record = get_maybetestmail_by_mailfield_id(mail_fields_from_db.id)
                 if record:
                     records.append(record)
-        try:
-            records = [item for sublist in records for item in sublist]
-        except TypeError as e:
-            pass
         if len(records) > 0:
             logging.debug(
                 "[+] (salmonconclude.py) - There are similar emails in the database."
@@ -324,6 +431,50 @@ def get_tables_from_similar(spam):
     return records
 
 
+def get_similar_emails_ids(spam, signature):
+    """Function looks up the similar emails with the similarity backend set
+    in salmon.yaml: ssdeep, minhash, or both, when the ssdeep ones are used
+    and the MinHash ones are only compared with them.
+
+    Args:
+        spam (Spam): Instance of the Spam class.
+        signature (numpy.ndarray): MinHash signature of the email, see salmonminhash.
+
+    Returns:
+        list: Ids of the similar email fields in the database.
+    """
+    backend = utils.settings.data["relay"].get("similarity", "ssdeep")
+    threshold = utils.settings.data["relay"].get("minhash_threshold", 0.5)
+    if backend == "minhash":
+        return get_similar_by_minhash(signature, threshold)
+    similar_emails_ids = spam.get_ids_for_similarity_check()
+    if backend == "both":
+        compare_similarity_backends(similar_emails_ids, get_similar_by_minhash(signature, threshold))
+    return similar_emails_ids
+
+
+def compare_similarity_backends(ssdeep_ids, minhash_ids):
+    """Function logs how many similar emails ssdeep and MinHash found,
+    for this email and since the start.
+
+    Args:
+        ssdeep_ids (list): Ids of the similar email fields found by ssdeep.
+        minhash_ids (list): Ids of the similar email fields found by MinHash.
+    """
+    ssdeep_ids = set(ssdeep_ids)
+    minhash_ids = set(minhash_ids)
+    similarity_counts.update(
+        {"ssdeep": len(ssdeep_ids), "minhash": len(minhash_ids), "both": len(ssdeep_ids & minhash_ids)}
+    )
+    logging.info(
+        "[+] (salmonconclude.py) - Similar emails found by ssdeep %d, by MinHash %d, by both %d "
+        "(%d, %d and %d since the start)." % (
+            len(ssdeep_ids), len(minhash_ids), len(ssdeep_ids & minhash_ids),
+            similarity_counts["ssdeep"], similarity_counts["minhash"], similarity_counts["both"],
+        )
+    )
+
+
 class DBUpdater:
     """The class decides if the current email doesn't look more like  a testing one.
 
@@ -393,8 +544,8 @@ class DBUpdater:
                     % self.__internal_rating
                 )
             if (
-                username in self.mail_fields_dict["html"]
-                and username not in mail_fields_from_db.body_html
+                username in get_html_text(self.mail_fields_dict)
+                and username not in salmonhtml.visible_text(mail_fields_from_db.body_html)
             ):
                 self.__internal_rating += 17
                 logging.debug(
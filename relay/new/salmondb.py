@@ -11,16 +11,37 @@ from sqlalchemy import String
 from sqlalchemy import Text
 from sqlalchemy import Float
 from sqlalchemy import Boolean
+from sqlalchemy import BigInteger
+from sqlalchemy import LargeBinary
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import or_
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import backref
 from salmon.base import Base
 from salmon.base import Session
 from salmon.base import engine
+from salmon import salmonhtml
+from salmon import salmonminhash
+from salmon import salmonvectors
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.exc import SQLAlchemyError
 from datetime import datetime
 import logging
 import os
+import re
+import threading
+
+# ssdeep.compare scores two chunks of the hashes only if they have a common substring this long
+NGRAM_LENGTH = 7
+# ssdeep.compare shortens the sequences of more than three same characters to three
+_sequence = re.compile(r"(.)\1{3,}")
+# email fields indexed in one transaction of the backfill, it shares the database with the relay
+BACKFILL_BATCH = 200
 
 
 """
@@ -59,6 +80,10 @@ class MailFields(Base):
         self.ssdeep = ssdeep
         self.length = length
         self.attachment = attachment
+        # MinHash signature stored with the email fields when it's set, see salmonminhash
+        self.minhash = None
+        # document vectors stored with the email fields when they're set, see salmonvectors
+        self.doc_vectors = None
 
     def __repr__(self):
         return "[+] (salmondb.py) - Adding new email fields with id {}.".format(self.id)
@@ -178,6 +203,67 @@ class Sender(Base):
         return "[+] (salmondb.py) - Adding new sender {}.".format(self.email)
 
 
+class SsdeepIndex(Base):
+    """Data model for the block size and the chunks of the ssdeep hash of email fields.
+
+    The chunks are shortened like ssdeep.compare does it, an empty row
+    (block size 0) is for a hash which can't be parsed.
+    """
+
+    __tablename__ = "ssdeep_index"
+    __table_args__ = (Index("ix_ssdeep_index_hash", "block_size", "chunk", "double_chunk"),)
+
+    mail_fields_id = Column(Integer, ForeignKey("mail_fields.id"), primary_key=True)
+    block_size = Column(Integer, nullable=False)
+    chunk = Column(String(64), nullable=False)
+    double_chunk = Column(String(64), nullable=False)
+
+
+class SsdeepNgram(Base):
+    """Data model for the inverted index of the n-grams of the ssdeep chunks.
+
+    The n-grams of the chunk are stored with the block size of the hash, the
+    ones of the double chunk with twice the block size, ssdeep.compare only
+    compares chunks of the same block size.
+    """
+
+    __tablename__ = "ssdeep_ngrams"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    block_size = Column(Integer, primary_key=True)
+    ngram = Column(String(NGRAM_LENGTH), primary_key=True)
+    mail_fields_id = Column(Integer, ForeignKey("mail_fields.id"), primary_key=True)
+
+
+class MinHashSignature(Base):
+    """Data model for the MinHash signature of email fields, see salmonminhash."""
+
+    __tablename__ = "minhash_signatures"
+
+    mail_fields_id = Column(Integer, ForeignKey("mail_fields.id"), primary_key=True)
+    signature = Column(LargeBinary, nullable=False)
+
+
+class MinHashBand(Base):
+    """Data model for the LSH index of the MinHash signatures, the bucket of every band of a signature."""
+
+    __tablename__ = "minhash_bands"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    band = Column(Integer, primary_key=True)
+    bucket = Column(BigInteger, primary_key=True)
+    mail_fields_id = Column(Integer, ForeignKey("mail_fields.id"), primary_key=True)
+
+
+class DocVectors(Base):
+    """Data model for the document vectors of email fields, see salmonvectors."""
+
+    __tablename__ = "doc_vectors"
+
+    mail_fields_id = Column(Integer, ForeignKey("mail_fields.id"), primary_key=True)
+    vectors = Column(LargeBinary, nullable=False)
+
+
 class Statistics(Base):
     """Data model for statistics."""
 
@@ -196,6 +282,215 @@ class Statistics(Base):
         self.last_modified = last_modified
 
 
+"""
+    ---------------------------
+    SSDEEP INDEX
+    ---------------------------
+"""
+def split_ssdeep(ssdeep_hash):
+    """Splits the ssdeep hash into its block size and chunks, shortened like ssdeep.compare does it.
+
+    Args:
+        ssdeep_hash (str): Hash from salmonmailparser.get_fuzzy_hash.
+
+    Returns:
+        tuple: Block size (int), chunk (str) and double chunk (str), (0, "", "") if it isn't a hash.
+    """
+    try:
+        block_size, chunk, double_chunk = ssdeep_hash.split(":")
+        block_size = int(block_size)
+    except (AttributeError, ValueError):
+        return 0, "", ""
+    return block_size, _sequence.sub(r"\1\1\1", chunk), _sequence.sub(r"\1\1\1", double_chunk)
+
+
+def get_ssdeep_ngrams(block_size, chunk, double_chunk):
+    """Returns the set of (block size, n-gram) of the chunks, see SsdeepNgram."""
+    ngrams = set()
+    for size, text in ((block_size, chunk), (block_size * 2, double_chunk)):
+        for i in range(len(text) - NGRAM_LENGTH + 1):
+            ngrams.add((size, text[i:i + NGRAM_LENGTH]))
+    return ngrams
+
+
+def index_ssdeep(connection, mail_fields_id, ssdeep_hash):
+    """Stores the ssdeep hash of email fields in the ssdeep index.
+
+    Args:
+        connection (Connection): Connection of the session storing the email fields.
+        mail_fields_id (int): Id of the record in the table for email fields.
+        ssdeep_hash (str): Its ssdeep hash.
+    """
+    # SQLite gives the ids of deleted email fields to new ones, a bulk delete doesn't remove them from the index
+    remove_ssdeep_index(connection, mail_fields_id)
+    index_row, ngram_rows = get_ssdeep_index_rows(mail_fields_id, ssdeep_hash)
+    insert_ssdeep_index(connection, [index_row], ngram_rows)
+
+
+def get_ssdeep_index_rows(mail_fields_id, ssdeep_hash):
+    """Returns the row of the ssdeep_index table and the rows of the ssdeep_ngrams table of email fields."""
+    block_size, chunk, double_chunk = split_ssdeep(ssdeep_hash)
+    index_row = {
+        "mail_fields_id": mail_fields_id, "block_size": block_size, "chunk": chunk, "double_chunk": double_chunk,
+    }
+    ngram_rows = [
+        {"block_size": size, "ngram": ngram, "mail_fields_id": mail_fields_id}
+        for size, ngram in get_ssdeep_ngrams(block_size, chunk, double_chunk)
+    ]
+    return index_row, ngram_rows
+
+
+def insert_ssdeep_index(connection, index_rows, ngram_rows):
+    """Inserts the rows from get_ssdeep_index_rows."""
+    connection.execute(SsdeepIndex.__table__.insert(), index_rows)
+    if ngram_rows:
+        connection.execute(SsdeepNgram.__table__.insert(), ngram_rows)
+
+
+def remove_ssdeep_index(connection, mail_fields_id):
+    """Removes email fields from the ssdeep index.
+
+    Args:
+        connection (Connection): Connection of the session deleting the email fields.
+        mail_fields_id (int): Id of the record in the table for email fields.
+    """
+    index = SsdeepIndex.__table__
+    row = connection.execute(index.select().where(index.c.mail_fields_id == mail_fields_id)).first()
+    if row is None:
+        return
+    ngrams = SsdeepNgram.__table__
+    rows = [
+        {"size": size, "old_ngram": ngram, "id": mail_fields_id}
+        for size, ngram in get_ssdeep_ngrams(row.block_size, row.chunk, row.double_chunk)
+    ]
+    if rows:
+        connection.execute(
+            ngrams.delete().where(and_(
+                ngrams.c.block_size == bindparam("size"),
+                ngrams.c.ngram == bindparam("old_ngram"),
+                ngrams.c.mail_fields_id == bindparam("id"),
+            )),
+            rows,
+        )
+    connection.execute(index.delete().where(index.c.mail_fields_id == mail_fields_id))
+
+
+"""
+    ---------------------------
+    MINHASH INDEX
+    ---------------------------
+"""
+def index_minhash(connection, mail_fields_id, signature):
+    """Stores the MinHash signature of email fields and its LSH bands.
+
+    Args:
+        connection (Connection): Connection of the session storing the email fields.
+        mail_fields_id (int): Id of the record in the table for email fields.
+        signature (numpy.ndarray): Its signature from salmonminhash.get_signature.
+    """
+    remove_minhash_index(connection, mail_fields_id)
+    signature_row, band_rows = get_minhash_index_rows(mail_fields_id, signature)
+    insert_minhash_index(connection, [signature_row], band_rows)
+
+
+def get_minhash_index_rows(mail_fields_id, signature):
+    """Returns the row of the minhash_signatures table and the rows of the minhash_bands table of email fields."""
+    signature_row = {"mail_fields_id": mail_fields_id, "signature": salmonminhash.to_bytes(signature)}
+    band_rows = [
+        {"band": band, "bucket": bucket, "mail_fields_id": mail_fields_id}
+        for band, bucket in enumerate(salmonminhash.get_bands(signature))
+    ]
+    return signature_row, band_rows
+
+
+def insert_minhash_index(connection, signature_rows, band_rows):
+    """Inserts the rows from get_minhash_index_rows."""
+    if signature_rows:
+        connection.execute(MinHashSignature.__table__.insert(), signature_rows)
+        connection.execute(MinHashBand.__table__.insert(), band_rows)
+
+
+def remove_minhash_index(connection, mail_fields_id):
+    """Removes email fields from the MinHash index.
+
+    Args:
+        connection (Connection): Connection of the session deleting the email fields.
+        mail_fields_id (int): Id of the record in the table for email fields.
+    """
+    signatures = MinHashSignature.__table__
+    row = connection.execute(signatures.select().where(signatures.c.mail_fields_id == mail_fields_id)).first()
+    if row is None:
+        return
+    bands = MinHashBand.__table__
+    connection.execute(
+        bands.delete().where(and_(
+            bands.c.band == bindparam("old_band"),
+            bands.c.bucket == bindparam("old_bucket"),
+            bands.c.mail_fields_id == bindparam("id"),
+        )),
+        [
+            {"old_band": band, "old_bucket": bucket, "id": mail_fields_id}
+            for band, bucket in enumerate(salmonminhash.get_bands(salmonminhash.from_bytes(row.signature)))
+        ],
+    )
+    connection.execute(signatures.delete().where(signatures.c.mail_fields_id == mail_fields_id))
+
+
+"""
+    ---------------------------
+    DOC VECTORS
+    ---------------------------
+"""
+# vectors of the email fields read or stored by this process, see get_doc_vectors
+doc_vectors_cache = salmonvectors.VectorCache()
+
+
+def store_doc_vectors(connection, mail_fields_id, vectors):
+    """Stores the document vectors of email fields.
+
+    Args:
+        connection (Connection): Connection of the session storing the email fields.
+        mail_fields_id (int): Id of the record in the table for email fields.
+        vectors (numpy.ndarray): Its vectors from salmonvectors.get_doc_vectors.
+    """
+    remove_doc_vectors(connection, mail_fields_id)
+    connection.execute(
+        DocVectors.__table__.insert(),
+        [{"mail_fields_id": mail_fields_id, "vectors": salmonvectors.to_bytes(vectors)}],
+    )
+    doc_vectors_cache.add(mail_fields_id, vectors)
+
+
+def remove_doc_vectors(connection, mail_fields_id):
+    """Removes the document vectors of email fields.
+
+    Args:
+        connection (Connection): Connection of the session deleting the email fields.
+        mail_fields_id (int): Id of the record in the table for email fields.
+    """
+    doc_vectors_cache.discard(mail_fields_id)
+    table = DocVectors.__table__
+    connection.execute(table.delete().where(table.c.mail_fields_id == mail_fields_id))
+
+
+@event.listens_for(MailFields, "after_insert")
+def index_inserted_mail_fields(mapper, connection, target):
+    index_ssdeep(connection, target.id, target.ssdeep)
+    if getattr(target, "minhash", None) is not None:
+        index_minhash(connection, target.id, target.minhash)
+    if getattr(target, "doc_vectors", None) is not None:
+        store_doc_vectors(connection, target.id, target.doc_vectors)
+    else:
+        remove_doc_vectors(connection, target.id)
+
+
+@event.listens_for(MailFields, "after_delete")
+def remove_deleted_mail_fields(mapper, connection, target):
+    remove_ssdeep_index(connection, target.id)
+    remove_minhash_index(connection, target.id)
+    remove_doc_vectors(connection, target.id)
+
+
 """
     ---------------------------
     SQL OPERATIONS
@@ -208,7 +503,106 @@ if engine.url.database == "salmon.db" and project != "myproject":
     raise Exception("Run salmon only from the myproject directory!")
 elif engine.url.database == "testing_salmon.db" and project != "tests":
     raise Exception("Run tests only from the tests directory!")
-Base.metadata.create_all(engine)
+
+
+def init():
+    """Creates the tables missing in the database. It is called once at the
+    start (settings.py) before the database is used, importing the module
+    doesn't touch the database."""
+    Base.metadata.create_all(engine)
+
+
+def index_mail_fields(batch_size=1000, db_session=None):
+    """Indexes the ssdeep hashes of the email fields stored before the ssdeep
+    index existed. The email fields without an index row are indexed in the
+    order of their ids, so it continues where it was interrupted and skips
+    none of them while the relay stores new emails.
+
+    Args:
+        batch_size (int): Number of email fields indexed in one transaction.
+        db_session (Session): Session of the database, the one of the module by default.
+    """
+    db_session = db_session or session
+    last = 0
+    indexed = 0
+    while True:
+        missing = db_session.query(MailFields.id, MailFields.ssdeep).outerjoin(
+            SsdeepIndex, SsdeepIndex.mail_fields_id == MailFields.id
+        ).filter(
+            MailFields.id > last, SsdeepIndex.mail_fields_id.is_(None)
+        ).order_by(MailFields.id).limit(batch_size).all()
+        # the read transaction would hold up the writes of the relay while the rows are computed
+        db_session.commit()
+        if not missing:
+            break
+        index_rows = []
+        ngram_rows = []
+        for mail_fields_id, ssdeep_hash in missing:
+            index_row, rows = get_ssdeep_index_rows(mail_fields_id, ssdeep_hash)
+            index_rows.append(index_row)
+            ngram_rows.extend(rows)
+        try:
+            insert_ssdeep_index(db_session.connection(), index_rows, ngram_rows)
+            db_session.commit()
+            indexed += len(missing)
+        except IntegrityError:
+            # another relay process indexed them meanwhile
+            db_session.rollback()
+        last = missing[-1][0]
+    if indexed:
+        logging.info("[+] (salmondb.py) - Added %d email fields into the ssdeep index." % indexed)
+
+
+def start_backfill():
+    """Indexes the email fields missing in the ssdeep index (see
+    index_mail_fields) in a background thread with its own session, so the
+    relay processes the queue meanwhile. Until it is done, the emails not
+    indexed yet aren't found as similar ones."""
+    threading.Thread(target=_backfill, name="ssdeep-backfill", daemon=True).start()
+
+
+def _backfill():
+    backfill_session = Session()
+    try:
+        index_mail_fields(BACKFILL_BATCH, backfill_session)
+    except Exception:
+        logging.exception("[-] (salmondb.py) - Indexing the ssdeep hashes of the stored email fields failed.")
+    finally:
+        backfill_session.close()
+
+
+def index_minhash_signatures(batch_size=1000):
+    """Stores the MinHash signatures of the email fields stored before the
+    minhash similarity backend was turned on, in the order of their ids like
+    index_mail_fields. Email fields without any word get no signature.
+
+    Args:
+        batch_size (int): Number of email fields indexed in one transaction.
+    """
+    last = session.query(func.max(MinHashSignature.mail_fields_id)).scalar() or 0
+    indexed = 0
+    while True:
+        missing = session.query(
+            MailFields.id, MailFields.subject, MailFields.body_plain, MailFields.body_html
+        ).filter(MailFields.id > last).order_by(MailFields.id).limit(batch_size).all()
+        if not missing:
+            break
+        signature_rows = []
+        band_rows = []
+        for mail_fields_id, subject, body_plain, body_html in missing:
+            # conclude signs the visible text of the html, the raw html is stored
+            signature = salmonminhash.get_signature(subject, body_plain, salmonhtml.visible_text(body_html))
+            if signature is None:
+                continue
+            signature_row, rows = get_minhash_index_rows(mail_fields_id, signature)
+            signature_rows.append(signature_row)
+            band_rows.extend(rows)
+        insert_minhash_index(session.connection(), signature_rows, band_rows)
+        session.commit()
+        last = missing[-1][0]
+        indexed += len(signature_rows)
+    if indexed:
+        logging.info("[+] (salmondb.py) - Added %d email fields into the MinHash index." % indexed)
 
 
 def push_into_db(obj_into_db):
@@ -291,6 +685,100 @@ def get_mail_fields():
     return mail_fields
 
 
+def get_similar_mail_fields(ssdeep_hash):
+    """Returns the email fields ssdeep.compare may find similar to the hash,
+    the ones with the same chunks or with a common n-gram of the chunks of
+    the same block size. The other ones get 0 from ssdeep.compare.
+
+    Args:
+        ssdeep_hash (str): Hash from salmonmailparser.get_fuzzy_hash.
+
+    Returns:
+        list: The id and the ssdeep hash of every candidate.
+    """
+    block_size, chunk, double_chunk = split_ssdeep(ssdeep_hash)
+    if not block_size:
+        return []
+    candidates = session.query(SsdeepIndex.mail_fields_id).filter(
+        SsdeepIndex.block_size == block_size,
+        SsdeepIndex.chunk == chunk,
+        SsdeepIndex.double_chunk == double_chunk,
+    )
+    ngrams = {}
+    for size, ngram in get_ssdeep_ngrams(block_size, chunk, double_chunk):
+        ngrams.setdefault(size, []).append(ngram)
+    if ngrams:
+        candidates = candidates.union(
+            session.query(SsdeepNgram.mail_fields_id).filter(
+                or_(*[and_(SsdeepNgram.block_size == size, SsdeepNgram.ngram.in_(ngram_list))
+                      for size, ngram_list in ngrams.items()])
+            )
+        )
+    return session.query(MailFields.id, MailFields.ssdeep).filter(MailFields.id.in_(candidates)).all()
+
+
+def get_similar_by_minhash(signature, threshold):
+    """Returns the email fields with a MinHash signature similar to the
+    signature, looked up by the LSH bands.
+
+    Args:
+        signature (numpy.ndarray): Signature from salmonminhash.get_signature, None finds nothing.
+        threshold (float): Lowest estimated Jaccard similarity of the returned ones.
+
+    Returns:
+        list: The ids of the similar email fields.
+    """
+    if signature is None:
+        return []
+    candidates = session.query(MinHashBand.mail_fields_id).filter(
+        or_(*[and_(MinHashBand.band == band, MinHashBand.bucket == bucket)
+              for band, bucket in enumerate(salmonminhash.get_bands(signature))])
+    )
+    rows = session.query(MinHashSignature.mail_fields_id, MinHashSignature.signature).join(
+        MailFields, MailFields.id == MinHashSignature.mail_fields_id
+    ).filter(MinHashSignature.mail_fields_id.in_(candidates)).all()
+    return [
+        mail_fields_id for mail_fields_id, data in rows
+        if salmonminhash.similarity(signature, salmonminhash.from_bytes(data)) >= threshold
+    ]
+
+
+def get_doc_vectors(ids):
+    """Returns the document vectors of email fields, from the cache or from
+    the database.
+
+    Args:
+        ids (list): Ids of the email fields.
+
+    Returns:
+        tuple: The ids of the email fields with vectors (list) and their
+            vectors (numpy.ndarray of shape (ids, fields, width), None without any).
+    """
+    missing = [mail_fields_id for mail_fields_id in ids if mail_fields_id not in doc_vectors_cache.rows]
+    if missing:
+        for mail_fields_id, data in session.query(DocVectors.mail_fields_id, DocVectors.vectors).filter(
+            DocVectors.mail_fields_id.in_(missing)
+        ):
+            doc_vectors_cache.add(mail_fields_id, salmonvectors.from_bytes(data))
+    return doc_vectors_cache.get(ids)
+
+
+def push_doc_vectors(mail_fields_id, vectors):
+    """Stores the document vectors of email fields stored without them.
+
+    Args:
+        mail_fields_id (int): Id of the record in the table for email fields.
+        vectors (numpy.ndarray): Its vectors from salmonvectors.get_doc_vectors.
+    """
+    try:
+        store_doc_vectors(session.connection(), mail_fields_id, vectors)
+        session.commit()
+    except SQLAlchemyError as error:
+        session.rollback()
+        logging.error(error)
+        logging.error("[-] (salmondb.py) - Error occurred during pushing the document vectors into the database.")
+
+
 def get_recipients():
     """Returns all recipients stored in the database."""
     recipients = []
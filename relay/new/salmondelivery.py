@@ -0,0 +1,146 @@
+"""salmondelivery module.
+
+This module sends the emails salmonrelay decided to relay to the relay server
+(exim, relayhost and relayport in salmon.yaml). One DeliveryService lives as
+long as the relay: it owns the Relay of config/settings.py and keeps an open
+SMTP connection per delivery thread, so a relayed email costs one SMTP
+transaction instead of a new queue, a pass through the Router and a new
+connection. Temporary failures (4xx replies, lost connections) are retried,
+emails which can't be delivered go to the undeliverable queue, and the
+outcomes are counted and logged regularly.
+"""
+
+import logging
+import smtplib
+import threading
+import time
+
+from salmon import server
+
+
+def transient(err):
+    """Returns True when delivering again may succeed after the error."""
+    if isinstance(err, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, message in err.recipients.values())
+    if isinstance(err, smtplib.SMTPResponseException):
+        return 400 <= err.smtp_code < 500
+    if isinstance(err, smtplib.SMTPException):
+        return False
+    # connection refused, timeouts, ...
+    return isinstance(err, OSError)
+
+
+class DeliveryService(object):
+    """Delivery of the relayed emails to the relay server.
+
+    Attributes:
+        relay (Relay): Relay of config/settings.py the emails are sent with.
+        retries (int): Number of times an email is sent again after a temporary failure.
+        retry_delay (float): Seconds before the first retry, doubled for every next one.
+        keepalive (int): Seconds an idle connection is kept open, 0 closes it after every email.
+        report (int): Seconds between two logged reports, 0 turns them off.
+        delivered (int): Number of emails delivered since the relay started.
+        retried (int): Number of retries since the relay started.
+        failed (int): Number of emails put into the undeliverable queue since the relay started.
+    """
+
+    def __init__(self, relay, retries=2, retry_delay=1, keepalive=30, report=300):
+        self.relay = relay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.keepalive = keepalive
+        self.report = report
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+        self.reported = time.time()
+        # the connection of every delivery thread
+        self.local = threading.local()
+
+    def submit(self, mail_request):
+        """Delivers the email, it blocks until it is delivered or given up.
+
+        An email for several recipients is sent again to all of them after a
+        temporary failure.
+
+        Args:
+            mail_request (MailRequest): Instance of the MailRequest class with eml data.
+
+        Returns:
+            bool: True when the email was delivered.
+        """
+        started = time.time()
+        attempt = 0
+        while True:
+            try:
+                self._send(mail_request)
+            except Exception as err:
+                self._disconnect()
+                if attempt < self.retries and transient(err):
+                    logging.warning(
+                        "[-] (salmondelivery.py) - Delivery to %s failed (%s), retrying.", mail_request.To, err
+                    )
+                    time.sleep(self.retry_delay * 2 ** attempt)
+                    attempt += 1
+                    self._count(retried=1)
+                    continue
+                logging.exception("[-] (salmondelivery.py) - Delivery to %s failed.", mail_request.To)
+                server.undeliverable_message(mail_request, "Delivery failed: %s" % err)
+                self._count(failed=1, busy=time.time() - started)
+                return False
+            if not self.keepalive:
+                self._disconnect()
+            self._count(delivered=1, busy=time.time() - started)
+            return True
+
+    def close(self):
+        """Closes the connection of the calling thread."""
+        self._disconnect()
+
+    def _send(self, mail_request):
+        hostname = self.relay.hostname or self.relay.resolve_relay_host(self.relay.envelope(mail_request)[0])
+        relay_host = self._connection(hostname)
+        self.relay.deliver_with(relay_host, mail_request)
+        self.local.used = time.time()
+
+    def _connection(self, hostname):
+        relay_host = getattr(self.local, "relay_host", None)
+        if relay_host is not None:
+            if self.local.hostname == hostname and time.time() - self.local.used < self.keepalive:
+                return relay_host
+            self._disconnect()
+        self.local.relay_host = self.relay.configure_relay(hostname)
+        self.local.hostname = hostname
+        self.local.used = time.time()
+        return self.local.relay_host
+
+    def _disconnect(self):
+        relay_host = getattr(self.local, "relay_host", None)
+        self.local.relay_host = None
+        if relay_host is None:
+            return
+        try:
+            relay_host.quit()
+        except (smtplib.SMTPException, OSError):
+            relay_host.close()
+
+    def _count(self, delivered=0, retried=0, failed=0, busy=0.0):
+        with self.lock:
+            self.delivered += delivered
+            self.retried += retried
+            self.failed += failed
+            self.busy += busy
+            now = time.time()
+            if not self.report or now - self.reported < self.report:
+                return
+            done = self.delivered + self.failed
+            logging.info(
+                "[+] (salmondelivery.py) - Delivery: %d emails delivered, %d retries, %d failed, "
+                "%.2f s per email since the start.", self.delivered, self.retried, self.failed,
+                self.busy / done if done else 0,
+            )
+            self.reported = now
@@ -0,0 +1,263 @@
+"""salmonfastpath module.
+
+This module runs the receiver and the relay in one process (fastpath: True
+in salmon.yaml), started with salmon-relay instead of salmon-receiver. The
+SMTP sessions are served by the asyncio server of the receiver (salmon.smtpd)
+and every received email is handed as a MailRequest to the relay through a
+bounded queue in memory, so it is not written into run/queue, listed and
+read back before it is parsed. When the queue is full the senders get 451
+and try again later. With a journal (fastpath_journal) the emails are also
+stored in an SQLite database with group commit, only to process again what
+a crash or a restart left behind. The emails are removed from the journal
+when they are delivered. An email whose processing failed is processed again
+after RETRY_DELAY seconds, and moved to the undeliverable directory when it
+failed queue_attempts times.
+"""
+
+import collections
+import logging
+import mailbox
+import queue as queue_module
+import threading
+import time
+
+from salmon import (mail, queue, salmondb, salmonheaders, salmonmailparser, salmonqueueindex, salmonscheduler,
+                    salmonstartup, smtpd, utils)
+
+FULL_REPLY = "451 4.3.2 System busy, try again later"
+# seconds a failed email waits before it is processed again
+RETRY_DELAY = 60
+
+
+class FastPathReceiver(smtpd.AsyncSMTPServer):
+    """SMTP receiver handing the emails to the FastPath."""
+
+    # accept() relies on being the only producer of the handoff queue
+    message_threads = 1
+
+    def __init__(self, fastpath, host, port, config):
+        """
+        Args:
+            fastpath (FastPath): Gets every received email.
+            host (str): Address to listen on.
+            port (int): Port to listen on.
+            config (dict): Receiver section of salmon.yaml.
+        """
+        self.fastpath = fastpath
+        # the same settings as salmon.server.configure_receiver
+        smtpd.apply_receiver_config(self, config)
+        smtpd.AsyncSMTPServer.__init__(
+            self,
+            (host, port),
+            None,
+            require_authentication=self.authenabled,
+            credentials=self.credentials,
+            data_size_limit=self.data_size_limit,
+        )
+
+    def process_message(self, Peer, From, To, Data, User):
+        """Called by smtpd.AsyncSMTPServer when there's a message received,
+        it returns the SMTP reply when the email isn't accepted."""
+        metadata = {
+            "peer": Peer[0],
+            "port": Peer[1],
+            "user": User or "none",
+            "sensor": self.config["sensorname"],
+            "mail_from": From,
+            "recipients": To,
+            "received": time.time(),
+        }
+        try:
+            # the email is stored once for all its recipients, like with store_once
+            message = mail.MailRequest(Peer, From, To, salmonheaders.investigate_bcc(To, Data))
+            message.metadata = metadata
+        except Exception:
+            logging.exception("[-] (salmonfastpath.py) - Cannot decode the message from %r.", Peer)
+            return "554 5.6.0 Message cannot be decoded"
+        return self.fastpath.accept(message)
+
+
+class FastPath(object):
+    """Receiver and relay in one process.
+
+    Attributes:
+        host (str): Address the SMTP receiver listens on.
+        port (int): Port the SMTP receiver listens on.
+        journal (SQLiteQueue): Journal of the emails not delivered yet, None without one.
+        handoff (queue.Queue): Bounded queue of the received emails waiting for the relay.
+        pipeline (RelayPipeline): Stages the emails are processed in, one after another without it.
+        overload (Overload): Scores the emails in degraded mode while the relay is behind.
+        deferred (int): Number of emails answered with 451 because the queue was full.
+        failures (dict): Key -> number of times the processing of the email failed.
+        retries (collections.deque): The failed emails waiting to be processed again, (time, key, MailRequest).
+    """
+
+    def __init__(self, host="127.0.0.1", port=2525, journal_dir=None, commit_interval=0, queue_size=1000,
+                 pipeline=None, overload=None, attempts=3):
+        """
+        Args:
+            host (str): Address to listen on.
+            port (int): Port to listen on.
+            journal_dir (str): Directory of the journal, None turns it off.
+            commit_interval (float): Seconds the journal commits the received emails together,
+                0 commits every email before it is accepted.
+            queue_size (int): Number of received emails waiting for the relay at most.
+            pipeline (RelayPipeline): See salmonpipeline.
+            overload (Overload): See salmonoverload.
+            attempts (int): Number of times an email is processed before it is moved to
+                the undeliverable directory, 0 tries forever.
+        """
+        self.host = host
+        self.port = port
+        self.journal_dir = journal_dir
+        self.commit_interval = commit_interval
+        self.journal = None
+        self.handoff = queue_module.Queue(queue_size)
+        self.pipeline = pipeline
+        self.overload = overload
+        self.receiver = None
+        self.deferred = 0
+        self.attempts = attempts
+        self.failures = {}
+        self.failures_lock = threading.Lock()
+        self.retries = collections.deque()
+
+    def start(self):
+        """Processes the emails left in the journal, then starts the SMTP
+        receiver and hands the received emails to the relay until the
+        process is stopped."""
+        if self.pipeline is not None:
+            # started first, its processes are forked before any thread or journal connection exists
+            self.pipeline.start(self.complete, self.fail)
+        else:
+            # with the pipeline, its parse processes load the NLP model
+            salmonstartup.warm_up()
+        salmonscheduler.schedule()
+        # the emails stored before the ssdeep index existed are indexed while the relay works
+        salmondb.start_backfill()
+        if self.journal_dir is not None:
+            self.journal = queue.SQLiteQueue(self.journal_dir, commit_interval=self.commit_interval)
+            self.recover()
+
+        config = utils.settings.data["receiver"]
+        self.receiver = FastPathReceiver(self, self.host, self.port, config)
+        threading.Thread(target=self.receiver.serve_forever, name="fastpath-receiver", daemon=True).start()
+        logging.info(
+            "[+] (salmonfastpath.py) - Fast path receiver started on %s:%d, queue for %d emails, journal %s.",
+            self.host, self.port, self.handoff.maxsize, self.journal_dir or "off",
+        )
+        while True:
+            try:
+                # wakes up for the failed emails waiting to be processed again
+                self.process(*self.handoff.get(timeout=RETRY_DELAY / 4))
+            except queue_module.Empty:
+                pass
+            self.retry()
+            if self.pipeline is not None and self.handoff.empty():
+                # no other email is waiting, the last batch doesn't wait for more
+                self.pipeline.flush()
+
+    def recover(self):
+        """Processes the emails a crash or a restart left in the journal."""
+        keys = self.journal.keys()
+        if keys:
+            logging.warning("[-] (salmonfastpath.py) - Processing %d emails left in the journal.", len(keys))
+        for i, key in enumerate(keys):
+            msg = self.journal.get(key)
+            if msg is None:
+                self.journal.remove(key)
+                continue
+            self.process(key, msg, len(keys) - i)
+        if self.pipeline is not None:
+            self.pipeline.flush()
+
+    def accept(self, message):
+        """Hands a received email to the relay, called from the message thread
+        of the SMTP receiver, so the journal write never holds up its event
+        loop.
+
+        Args:
+            message (MailRequest): The received email with the metadata of the SMTP session.
+
+        Returns:
+            str: The SMTP reply when the email isn't accepted, None otherwise.
+        """
+        # the receiver is the only producer, so the queue can only get emptier after the check
+        if self.handoff.full():
+            self.deferred += 1
+            if self.deferred % 1000 == 1:
+                logging.warning(
+                    "[-] (salmonfastpath.py) - The relay is behind, %d emails were deferred so far.", self.deferred
+                )
+            return FULL_REPLY
+        if self.journal is not None:
+            key = self.journal.push(message)
+        else:
+            key = queue.new_key()
+            mailbox.Maildir._count += 1
+        self.handoff.put_nowait((key, message))
+        return None
+
+    def process(self, key, msg, depth=None):
+        """Processes one email, in the pipeline when there is one."""
+        if depth is None:
+            depth = self.handoff.qsize() + 1
+        degraded = self.degraded(depth, key)
+        logging.info("Pulled message with key: %r off", key)
+        if self.pipeline is not None:
+            self.pipeline.submit(key, msg, degraded)
+            return
+        try:
+            salmonmailparser.process_email(key, msg, degraded)
+        except Exception:
+            logging.exception("[-] (salmonfastpath.py) - Processing %s failed.", key)
+            self.fail(key, msg)
+            return
+        self.complete(key)
+
+    def fail(self, key, msg):
+        """Processes an email whose processing failed again after RETRY_DELAY
+        seconds, or moves it to the undeliverable directory when it failed
+        attempts times. Called from the relay thread or the pipeline."""
+        with self.failures_lock:
+            failed = self.failures.get(key, 0) + 1
+            self.failures[key] = failed
+        if self.attempts and failed >= self.attempts:
+            logging.error(
+                "[-] (salmonfastpath.py) - %s failed %d times, it is moved to the undeliverable directory.", key, failed
+            )
+            try:
+                salmonmailparser.move_to_undeliverable(key, msg)
+            except Exception:
+                logging.exception("[-] (salmonfastpath.py) - Moving %s to the undeliverable directory failed.", key)
+            self.complete(key)
+            return
+        logging.warning("[-] (salmonfastpath.py) - %s failed, it is processed again in %d s.", key, RETRY_DELAY)
+        self.retries.append((time.time() + RETRY_DELAY, key, msg))
+
+    def retry(self):
+        """Processes the failed emails whose RETRY_DELAY passed."""
+        while self.retries and self.retries[0][0] <= time.time():
+            retried, key, msg = self.retries.popleft()
+            self.process(key, msg)
+
+    def degraded(self, depth, key):
+        """Returns True when the email with the key is scored in degraded mode,
+        depth is the number of emails waiting for the relay."""
+        if self.overload is None:
+            return False
+        if self.pipeline is not None:
+            depth += self.pipeline.pending
+        return self.overload.check(depth, salmonqueueindex.age(key))
+
+    def complete(self, key):
+        """Removes a processed email from the journal."""
+        with self.failures_lock:
+            self.failures.pop(key, None)
+        if self.journal is None:
+            return
+        try:
+            self.journal.remove(key)
+            logging.info("Removed %r key from journal.\n\n", key)
+        except KeyError:
+            logging.warning("[-] (salmonfastpath.py) - %s is not in the journal any more.", key)
@@ -0,0 +1,141 @@
+"""salmonheaders module.
+
+This module indexes the header block of a raw email in one pass. Every header
+name (lowercase) is mapped to the byte offsets of its lines (folded lines
+included) and the offset of the end of the header block is remembered, so
+the receiver and the relay can find, replace or add a header without
+scanning the whole message with regular expressions. investigate_bcc is
+shared by the SMTP receivers (salmon.server and salmonfastpath).
+It is installed into both the receiver and the relay salmon lib.
+"""
+
+
+class HeaderIndex(object):
+    """Index of the header block of raw email bytes.
+
+    Attributes:
+        data (bytes): The indexed email.
+        headers (dict): Lowercase header name -> list of (start, end) offsets
+            of the whole header lines including the line ending.
+        end (int): Offset where the header block ends (the empty line).
+        newline (bytes): Line ending used by the header block.
+    """
+
+    def __init__(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.data = data
+        self.headers = {}
+        self.newline = b"\n"
+        pos = 0
+        size = len(data)
+        current = None
+        self.end = size
+        while pos < size:
+            eol = data.find(b"\n", pos)
+            next_pos = size if eol == -1 else eol + 1
+            if pos == 0 and eol > 0 and data[eol - 1:eol] == b"\r":
+                self.newline = b"\r\n"
+            first = data[pos:pos + 1]
+            if first == b"\n" or data[pos:pos + 2] == b"\r\n":
+                self.end = pos
+                break
+            if first in (b" ", b"\t") and current is not None:
+                # folded line belongs to the previous header
+                current[1] = next_pos
+            else:
+                colon = data.find(b":", pos, next_pos)
+                if colon <= pos:
+                    # not a header line, the body starts without an empty line
+                    self.end = pos
+                    break
+                name = data[pos:colon].strip().lower().decode("ascii", "replace")
+                current = [pos, next_pos]
+                self.headers.setdefault(name, []).append(current)
+            pos = next_pos
+
+    def __contains__(self, name):
+        return name.lower() in self.headers
+
+    def span(self, name):
+        """Returns (start, end) offsets of the first header called name or None."""
+        spans = self.headers.get(name.lower())
+        if not spans:
+            return None
+        return tuple(spans[0])
+
+    def get_all(self, name):
+        """Returns the unfolded values (bytes) of all headers called name."""
+        values = []
+        for start, end in self.headers.get(name.lower(), []):
+            line = self.data[start:end]
+            value = line[line.find(b":") + 1:]
+            values.append(b" ".join(value.split()))
+        return values
+
+    def get(self, name, default=None):
+        """Returns the unfolded value of the first header called name."""
+        values = self.get_all(name)
+        return values[0] if values else default
+
+    def set_header(self, name, value):
+        """Returns the email with the first header called name replaced by
+        `name: value`, or with the header added at the end of the header
+        block when there is none. The index itself is not changed.
+
+        Args:
+            name (str): Header name.
+            value (str|bytes): Header value.
+
+        Returns:
+            bytes: Changed email.
+        """
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        line = name.encode("ascii") + b": " + value + self.newline
+        span = self.span(name)
+        if span is None:
+            if self.data and self.end == len(self.data) and not self.data.endswith(b"\n"):
+                # the last header line has no line ending
+                line = self.newline + line
+            return self.data[:self.end] + line + self.data[self.end:]
+        return self.data[:span[0]] + line + self.data[span[1]:]
+
+    def remove_header(self, name):
+        """Returns the email without any header called name.
+
+        Args:
+            name (str): Header name.
+
+        Returns:
+            bytes: Changed email.
+        """
+        spans = self.headers.get(name.lower(), [])
+        if not spans:
+            return self.data
+        parts = []
+        pos = 0
+        for start, end in spans:
+            parts.append(self.data[pos:start])
+            pos = end
+        parts.append(self.data[pos:])
+        return b"".join(parts)
+
+
+def investigate_bcc(To, Data):
+    """Envelope recipients which are not in the To or Cc header were sent
+    as BCC, they are written into a Bcc header for the relay.
+
+    Args:
+        To (list): Envelope recipients.
+        Data (bytes): Raw email.
+
+    Returns:
+        bytes: The email with the Bcc header, Data when there was no BCC recipient.
+    """
+    index = HeaderIndex(Data)
+    visible = b" ".join(index.get_all("to") + index.get_all("cc")).lower()
+    bcc_list = [x for x in To if bytes(x, encoding="utf-8").lower() not in visible]
+    if bcc_list:
+        Data = index.set_header("Bcc", ",".join(bcc_list))
+    return Data
@@ -0,0 +1,111 @@
+"""salmonhtml module.
+
+This module reads the text/html of an email for salmonmailparser in one pass
+over the markup, without building a document tree. It returns what the
+reader of the email sees, the text without the tags, comments, scripts and
+styles, one line per block with the whitespace collapsed, and the URLs of the
+href and src attributes. salmonmailparser keeps the raw html for the archive
+and the email id, the links, the fuzzy hash, the username and password checks
+and the text analysis work on the extracted text. The database keeps the raw
+html too, visible_text reads the text of the stored emails.
+It is installed into the relay salmon lib.
+"""
+
+import html.parser
+
+# elements the content of which isn't shown
+HIDDEN = frozenset(("script", "style", "template", "title"))
+# elements which start a new line of text, inline elements (a, b, span ...) don't split the words
+BLOCKS = frozenset((
+    "address", "article", "aside", "blockquote", "body", "br", "caption", "center", "dd", "div", "dl", "dt",
+    "fieldset", "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header",
+    "hr", "html", "li", "main", "nav", "ol", "p", "pre", "section", "table", "td", "th", "tr", "ul",
+))
+URL_ATTRIBUTES = frozenset(("href", "src"))
+
+
+def extract(body_html):
+    """Extracts the visible text and the URLs from the html.
+
+    Args:
+        body_html (str): text/html from the email.
+
+    Returns:
+        tuple: The visible text (str) and the URLs of the href and src attributes (list).
+    """
+    extractor = HtmlExtractor()
+    extractor.feed(body_html)
+    extractor.close()
+    return extractor.text(), extractor.urls
+
+
+def visible_text(body_html):
+    """Returns the visible text of the html of an email stored in the
+    database, like salmonmailparser.get_html_text does for a new email.
+
+    Args:
+        body_html (str): body_html of the email fields in the database.
+
+    Returns:
+        str: The visible text, the raw html when it couldn't be read.
+    """
+    if not body_html:
+        return body_html
+    try:
+        return extract(body_html)[0]
+    except Exception:
+        return body_html
+
+
+class HtmlExtractor(html.parser.HTMLParser):
+    """Streaming extractor of the visible text and the URLs, the html may be
+    passed to feed in any number of pieces.
+
+    Attributes:
+        lines (list): Lines of the visible text read so far.
+        urls (list): URLs of the href and src attributes read so far.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = []
+        self.urls = []
+        self.line = []
+        # number of the hidden elements the parser is in
+        self.hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if name in URL_ATTRIBUTES and value:
+                self.urls.append(value.strip())
+        if tag == "body":
+            # an unclosed head, title or style doesn't hide the whole body
+            self.hidden = 0
+        elif tag in HIDDEN:
+            self.hidden += 1
+        if tag in BLOCKS:
+            self.break_line()
+
+    def handle_endtag(self, tag):
+        if tag in HIDDEN and self.hidden:
+            self.hidden -= 1
+        if tag in BLOCKS:
+            self.break_line()
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.line.append(data)
+
+    def break_line(self):
+        line = " ".join("".join(self.line).split())
+        if line:
+            self.lines.append(line)
+        self.line = []
+
+    def close(self):
+        super().close()
+        self.break_line()
+
+    def text(self):
+        """Returns the visible text read so far."""
+        return "\n".join(self.lines)
@@ -20,7 +20,6 @@ import shutil
 import ssdeep
 import os
 import quopri
-import signal
 from email.header import decode_header
 from datetime import datetime
 from email.utils import parseaddr
@@ -28,59 +27,53 @@ from salmon import salmonrelay
 from salmon import server
 from salmon import utils
 from salmon import salmonconclude
+from salmon import salmonqueueindex
+from salmon import salmonhtml
+from salmon import salmonurls
 from enum import Enum
 
 
-# Timeout decorator is needed to avoid 'Catastrophic Backtracting' URL regex
-class TimedOutExc(Exception):
-    """
-    Raised when a timeout happens
-    """
-
-
 class Code(Enum):
     SUCCESS = 1
     ERROR = 2
     UNDELIVERABLE = 3
 
 
-def timeout(timeout):
-    """
-    Return a decorator that raises a TimedOutExc exception
-    after timeout seconds, if the decorated function did not return.
-    """
-    def decorate(f):
-        def handler(signum, frame):
-            raise TimedOutExc()
-
-        def new_f(*args, **kwargs):
-
-            old_handler = signal.signal(signal.SIGALRM, handler)
-            signal.alarm(timeout)
-
-            result = f(*args, **kwargs)  # f() always returns, in this scheme
-
-            signal.signal(signal.SIGALRM, old_handler)  # Old signal handler is restored
-            signal.alarm(0)  # Alarm removed
+def process_email(key, mail_request, degraded=False):
+    """Function processes the email into a dictionary,
+    which is then passed to the salmonconclude module.
 
-            return result
+    Args:
+        key (str): Name of the file being processed.
+        mail_request (MailRequest): Instance of the MailRequest class with eml data.
+        degraded (bool): Score the email in degraded mode, see salmonoverload.
 
-        new_f.func_name = f.__name__
-        return new_f
+    Returns:
+        dict: Email fields parsed into a dictionary, None if the email is undeliverable.
+    """
+    # the email parsed by the MailRequest, it isn't parsed again here
+    mail_fields = parse_email(key, mail_request.message)
+    if mail_fields is None:
+        move_to_undeliverable(key, mail_request)
+        return None
 
-    return decorate
+    if not "SALMON_SETTINGS_MODULE" in os.environ:
+        salmonconclude.conclude(mail_fields, key, mail_request, degraded=degraded)
+    return mail_fields
 
 
-def process_email(key, mail_request):
-    """Function processes the email into a dictionary,
-    which is then passed to the salmonconclude module.
+def parse_email(key, data):
+    """Function parses the email into a dictionary. It doesn't touch
+    the database or the files, so the pipeline (see salmonpipeline) can
+    call it in another process.
 
     Args:
         key (str): Name of the file being processed.
-        mail_request (MailRequest): Instance of the MailRequest class with eml data.
+        data (bytes): Raw email, or the email.message.Message already parsed from it
+            (MailRequest.message).
 
     Returns:
-        int: Final email rating when the environmental variable SALMON_SETTINGS_MODULE is set.
+        dict: Email fields parsed into a dictionary, None if the email can't be parsed.
     """
     mail_fields = {
         "to": [],
@@ -91,6 +84,8 @@ def process_email(key, mail_request):
         "date": "",
         "text": "",
         "html": "",
+        "html_text": "",
+        "html_urls": [],
         "attachmentFileName": [],
         "attachmentFile": [],
         "undecodeAttachmentFile": [],
@@ -99,8 +94,10 @@ def process_email(key, mail_request):
         "len": "",
         "s_id": "",
     }
-    p = email.parser.BytesParser()
-    msg = p.parsebytes(mail_request.Data)
+    if isinstance(data, email.message.Message):
+        msg = data
+    else:
+        msg = email.parser.BytesParser().parsebytes(data)
     code = None
 
     if get_recipient(msg, mail_fields) == Code.ERROR:
@@ -112,6 +109,7 @@ def process_email(key, mail_request):
 
     get_reply_to(msg, mail_fields)
     get_subject(msg, mail_fields)
+    get_html_text(msg, mail_fields)
     get_links(msg, mail_fields)
     mail_fields["date"] = datetime.timestamp(datetime.today())
 
@@ -122,15 +120,10 @@ def process_email(key, mail_request):
 
     if code == Code.UNDELIVERABLE:
         logging.error("[-] (salmonmailparser.py) - Some issue in parsing file %s" % key)
-        move_to_undeliverable(key)
         return None
-
-    if not "SALMON_SETTINGS_MODULE" in os.environ:
-        salmonconclude.conclude(mail_fields, key, mail_request)
     return mail_fields
 
 
-@timeout(1)
 def get_links_list(input_body):
     """Function gets links from the email body.
 
@@ -140,23 +133,16 @@ def get_links_list(input_body):
     Returns:
         list: List of links from text/plain or text/html.
     """
-    try:
-        link_regex_pattern = re.compile(
-            r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)"
-            "(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+"
-            "|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?\xab\xbb\u201c\u201d\u2018\u2019]))"
-        )
-        link_list = set([mgroups[0] for mgroups in link_regex_pattern.findall(input_body)])
-        link_list = list(set(link_list))
-        logging.debug("[+] (salmonmailparser.py) - Found links %s." % ", ".join(link_list))
-        return link_list
-    except TimedOutExc:
-        logging.info("[+] (salmonmailparser.py) - Wild Catastrophic Backtracting appeared, returning empty list []")
-        return []
+    link_list = salmonurls.find_links(input_body)
+    logging.debug("[+] (salmonmailparser.py) - Found links %s." % ", ".join(link_list))
+    return link_list
 
 
 def get_fuzzy_hash(mail_fields):
-    """Function calculates a hash of body_html, body_plain or subject.
+    """Function calculates a hash of the visible text of body_html, body_plain or subject.
+    An html without any visible text (only images or markup) is hashed as it is, like
+    all html was before the visible text was hashed, so such emails don't get the same
+    hash as every other email with the same subject.
 
     Args:
         mail_fields (dict): Email fields parsed into a dictionary.
@@ -168,12 +154,14 @@ def get_fuzzy_hash(mail_fields):
     nibh dignissim sagittis. Donec vitae arcu. Class aptent taciti sociosqu ad litora 
     torquent per conubia nostra, per inceptos hymenaeos. Sed elit dui, pellentesque a, 
     faucibus vel, interdum nec, diam."""
-    if len(mail_fields["html"]) > 0:
+    # the markup of the same template differs in ids and tracking attributes, the text doesn't
+    html_text = mail_fields.get("html_text") or mail_fields["html"]
+    if len(html_text) > 0:
         logging.debug("[+] (salmonmailparser.py) - Calculating the hash from body_html.")
-        if len(mail_fields["html"]) < 120:
-            data = mail_fields["html"] + " " + mail_fields["subject"] + random_text
+        if len(html_text) < 120:
+            data = html_text + " " + mail_fields["subject"] + random_text
         else:
-            data = mail_fields["html"] + " " + mail_fields["subject"]
+            data = html_text + " " + mail_fields["subject"]
     elif len(mail_fields["text"]) > 0:
         logging.debug("[+] (salmonmailparser.py) - Calculating the hash from body_plain.")
         if len(mail_fields["text"]) < 120:
@@ -212,16 +200,21 @@ def get_md5(text):
     return md5_hash
 
 
-def move_to_undeliverable(key):
+def move_to_undeliverable(key, mail_request=None):
     """Function moves the eml file to the directory for undeliverable emails.
 
     Args:
         key (str): Name of the file that will be moved.
+        mail_request (MailRequest): The email, written out when it is not in queue/new (claimed or in SQLite).
     """
     queuepath = utils.settings.data["directory"]["queuepath"]
     undeliverable_path = utils.settings.data["directory"]["undeliverable_path"]
     logging.error("[-] (salmonmailparser.py) - Copying %s into undeliverable directory" % key)
-    shutil.copyfile(queuepath + "/new/" + key, undeliverable_path + "/" + key)
+    source = salmonqueueindex.message_path(queuepath, key, salmonqueueindex.read_layout(queuepath))
+    if mail_request is not None and not os.path.isfile(source):
+        salmonrelay.save_raw_email(mail_request, undeliverable_path + "/" + key)
+        return
+    shutil.copyfile(source, undeliverable_path + "/" + key)
 
 
 def process_email_parts_recursively(msg, mail_fields):
@@ -453,6 +446,25 @@ def get_email_parts(msg, mail_fields):
     return Code.SUCCESS
 
 
+def get_html_text(msg, mail_fields):
+    """Function gets the visible text and the URLs of the href and src
+    attributes from text/html, see salmonhtml. The raw html stays in
+    mail_fields["html"].
+
+    Args:
+        msg (Message): Instance of the Message class with parts of the email.
+        mail_fields (dict): Email fields parsed into a dictionary.
+    """
+    if not mail_fields["html"]:
+        return
+    try:
+        mail_fields["html_text"], mail_fields["html_urls"] = salmonhtml.extract(mail_fields["html"])
+    except Exception as e:
+        logging.error("[-] (salmonmailparser.py) - Some issue in parsing text/html, using the raw html.")
+        mail_fields["html_text"] = mail_fields["html"]
+        mail_fields["html_urls"] = []
+
+
 def get_links(msg, mail_fields):
     """Function gets links from the email.
 
@@ -461,7 +473,10 @@ def get_links(msg, mail_fields):
         mail_fields (dict): Email fields parsed into a dictionary.
     """
     try:
-        mail_fields["links"] = get_links_list(mail_fields["html"])
+        # links in the visible text first, then the ones only in href and src
+        links = get_links_list(mail_fields["html_text"])
+        links.extend(get_links_list("\n".join(mail_fields["html_urls"])))
+        mail_fields["links"] = list(dict.fromkeys(links))
         mail_fields["links"].extend(get_links_list(mail_fields["text"]))
     except Exception as e:
         logging.error("[-] (salmonmailparser.py) - Some issue in parsing 'links' field.")
@@ -0,0 +1,99 @@
+"""salmonminhash module.
+
+This module computes the MinHash signatures of the emails for the minhash
+similarity backend (similarity in salmon.yaml). The signature of an email is
+made of the subject and the body (body_plain, or the visible text of
+body_html without it) split into shingles of three words. The share of the
+same values of two signatures estimates the Jaccard similarity of their
+shingles. The signature is cut into bands for locality-sensitive hashing,
+salmondb stores the bands of every email and looks up the emails sharing at
+least one of them, so a lookup doesn't compare the email with all of them.
+It is installed into the relay salmon lib.
+"""
+
+import hashlib
+import re
+import zlib
+
+import numpy
+
+NUM_PERM = 128
+# 32 bands of 4 values: emails with Jaccard similarity 0.5 share a band with
+# probability 0.87, with 0.7 with 0.9998 and with 0.2 with 0.05
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+SHINGLE_WORDS = 3
+
+# the hash functions must be the same in every process and after every
+# restart, the signatures of the emails in the database were made with them
+_random = numpy.random.RandomState(1)
+_multipliers = _random.randint(0, 2 ** 63, NUM_PERM, dtype=numpy.uint64) * numpy.uint64(2) + numpy.uint64(1)
+_increments = _random.randint(0, 2 ** 63, NUM_PERM, dtype=numpy.uint64)
+_word = re.compile(r"\w+")
+
+
+def get_signature(subject, body_plain, body_html):
+    """Computes the MinHash signature of an email.
+
+    Args:
+        subject (str): Subject of the email.
+        body_plain (str): text/plain of the email.
+        body_html (str): Visible text of text/html of the email, see salmonhtml.
+
+    Returns:
+        numpy.ndarray: NUM_PERM values (uint32), None when the email has no words.
+    """
+    words = _word.findall(" ".join((subject or "", body_plain or body_html or "")).lower())
+    if not words:
+        return None
+    shingles = set(
+        " ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))
+    )
+    hashes = numpy.fromiter(
+        (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=numpy.uint64, count=len(shingles)
+    )
+    # multiply-add-shift hash functions, the products overflow modulo 2^64 on purpose
+    with numpy.errstate(over="ignore"):
+        values = (hashes[:, numpy.newaxis] * _multipliers + _increments) >> numpy.uint64(32)
+    return values.min(axis=0).astype(numpy.uint32)
+
+
+def get_bands(signature):
+    """Returns the LSH bucket of every band of the signature, the emails with
+    the same bucket of the same band are compared.
+
+    Args:
+        signature (numpy.ndarray): Signature from get_signature.
+
+    Returns:
+        list: BANDS signed 64-bit integers.
+    """
+    data = signature.tobytes()
+    size = ROWS * signature.itemsize
+    return [
+        int.from_bytes(hashlib.blake2b(data[i:i + size], digest_size=8).digest(), "big", signed=True)
+        for i in range(0, len(data), size)
+    ]
+
+
+def similarity(signature, other):
+    """Estimates the Jaccard similarity of the shingles of two emails.
+
+    Args:
+        signature (numpy.ndarray): Signature from get_signature.
+        other (numpy.ndarray): Another one.
+
+    Returns:
+        float: Share of the same values, from 0 to 1.
+    """
+    return float(numpy.count_nonzero(signature == other)) / NUM_PERM
+
+
+def to_bytes(signature):
+    """Returns the signature as stored in the database."""
+    return signature.tobytes()
+
+
+def from_bytes(data):
+    """Returns the signature stored in the database."""
+    return numpy.frombuffer(data, dtype=numpy.uint32)
@@ -0,0 +1,101 @@
+"""salmonnlp module.
+
+This module runs the NLP model of analyze_text. The relay needs only the
+part-of-speech tags and the named entities of a body (see
+salmonspam.get_text_features) and the document vectors (see salmonvectors),
+so the components of the model which compute nothing of these, the parser
+and the lemmatizer of en_core_web_sm, aren't loaded. The texts are cut to
+nlp_max_chars characters, the time of the model grows with the length of
+the text and a few huge bodies would hold up the relay. The pipeline (see
+salmonpipeline) passes the emails parsed together to the model at once,
+with nlp.pipe in batches of nlp_batch texts and in nlp_processes processes.
+Neither spaCy nor the model is loaded before the first text, so the relay
+starts right away, salmonstartup.warm_up loads them in the background
+with nlp_warm_up set.
+It is installed into the relay salmon lib.
+"""
+
+import logging
+import os
+import threading
+import time
+
+# components of en_core_web_sm the relay doesn't use
+EXCLUDE = ("parser", "lemmatizer", "senter")
+
+
+def truncate(text, max_chars):
+    """Cuts the text to at most max_chars characters, at a whitespace when
+    there's one in the second half of them.
+
+    Args:
+        text (str): Text of the email.
+        max_chars (int): Number of the characters kept, 0 keeps them all.
+
+    Returns:
+        str: The text, cut when it's longer.
+    """
+    if not max_chars or len(text) <= max_chars:
+        return text
+    end = text.rfind(" ", max_chars // 2, max_chars + 1)
+    return text[:end if end != -1 else max_chars]
+
+
+class NlpService(object):
+    """The NLP model of analyze_text, it's called like the spaCy model.
+
+    Attributes:
+        model (str): Name or path of the spaCy model.
+        exclude (list): Components of the model which aren't loaded.
+        batch_size (int): Number of the texts nlp.pipe processes at once.
+        processes (int): Number of the processes of nlp.pipe.
+        max_chars (int): Number of the characters of a text passed to the model, 0 passes all.
+    """
+
+    def __init__(self, model="en_core_web_sm", exclude=EXCLUDE, batch_size=16, processes=1, max_chars=20000):
+        self.model = model
+        self.exclude = list(exclude)
+        self.batch_size = batch_size
+        self.processes = processes
+        self.max_chars = max_chars
+        self._nlp = None
+        self.lock = threading.Lock()
+        # a process forked while another thread was loading the model loads it itself
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self.lock = threading.Lock()
+
+    @property
+    def nlp(self):
+        """Loaded spaCy model without the excluded components, it's loaded on the first access."""
+        if self._nlp is None:
+            with self.lock:
+                if self._nlp is None:
+                    self._nlp = self.load()
+        return self._nlp
+
+    def load(self):
+        """Loads the model, see the nlp property."""
+        started = time.perf_counter()
+        import spacy
+
+        nlp = spacy.load(self.model, exclude=self.exclude)
+        logging.info(
+            "[+] (salmonnlp.py) - Loaded %s with %s in %.2f s.",
+            self.model, ", ".join(nlp.pipe_names), time.perf_counter() - started,
+        )
+        return nlp
+
+    def warm_up(self):
+        """Loads the model before the first text, salmonstartup.warm_up calls it in the background."""
+        return self.nlp
+
+    def __call__(self, text):
+        return self.nlp(truncate(text, self.max_chars))
+
+    def pipe(self, texts):
+        """Runs the model on the texts in batches, yields their documents in the same order."""
+        return self.nlp.pipe(
+            (truncate(text, self.max_chars) for text in texts), batch_size=self.batch_size, n_process=self.processes
+        )
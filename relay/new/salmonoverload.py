@@ -0,0 +1,85 @@
+"""salmonoverload module.
+
+This module decides when the relay is overloaded, e.g. by a spam campaign.
+The relay gets overloaded when more than depth messages wait in the queue
+or the next message waited longer than age seconds (the high watermarks),
+and it stays overloaded until both fall below LOW_WATERMARK of that. While
+it is overloaded, salmonconclude scores the emails in degraded mode: it
+skips the NLP analysis, the similarity check against the emails in the
+database and the link history and relies on the cheap checks only, so the
+queue is drained fast and the emails are relayed while they are fresh.
+"""
+
+import logging
+import time
+
+# the overload ends when the queue depth and the age of the messages fall below this part of the watermarks
+LOW_WATERMARK = 0.5
+
+
+class Overload(object):
+    """Overload state of the relay.
+
+    Attributes:
+        depth (int): Number of queued messages starting the overload, 0 ignores the queue depth.
+        age (int): Seconds the next message waited starting the overload, 0 ignores the age.
+        report (int): Seconds between two log lines while the relay is overloaded.
+        active (bool): True while the relay is overloaded.
+        degraded (int): Number of messages scored in degraded mode during the current overload.
+        total (int): Number of messages scored in degraded mode since the relay started.
+    """
+
+    def __init__(self, depth=0, age=0, report=60):
+        self.depth = depth
+        self.age = age
+        self.report = report
+        self.active = False
+        self.degraded = 0
+        self.total = 0
+        self.started = None
+        self.reported = None
+
+    def check(self, depth, age):
+        """Updates the state with the current queue depth and the age of the
+        next message.
+
+        Args:
+            depth (int): Number of messages waiting in the queue.
+            age (float): Seconds the next message waited in the queue.
+
+        Returns:
+            bool: True when the next message is scored in degraded mode.
+        """
+        if self.active and not self.over(depth, age, LOW_WATERMARK):
+            self.active = False
+            logging.info(
+                "[+] (salmonoverload.py) - Overload is over after %d s (%d messages queued, the next one "
+                "waited %d s), %d messages were scored in degraded mode (%d since the start).",
+                time.time() - self.started, depth, age, self.degraded, self.total,
+            )
+        elif not self.active and self.over(depth, age, 1):
+            self.active = True
+            self.started = self.reported = time.time()
+            self.degraded = 0
+            logging.warning(
+                "[-] (salmonoverload.py) - Relay is overloaded: %d messages queued (watermark %d), the next one "
+                "waited %d s (watermark %d s), scoring in degraded mode.", depth, self.depth, age, self.age,
+            )
+        if not self.active:
+            return False
+
+        self.degraded += 1
+        self.total += 1
+        if time.time() - self.reported >= self.report:
+            self.reported = time.time()
+            logging.warning(
+                "[-] (salmonoverload.py) - Relay is still overloaded: %d messages queued, the next one waited %d s, "
+                "%d messages scored in degraded mode so far.", depth, age, self.degraded,
+            )
+        return True
+
+    def over(self, depth, age, ratio):
+        """Returns True when the depth or the age is over ratio of its watermark."""
+        if self.depth and depth >= self.depth * ratio:
+            return True
+        return bool(self.age and age >= self.age * ratio)
@@ -0,0 +1,396 @@
+"""salmonpipeline module.
+
+This module processes the messages claimed by the QueueReceiver in stages
+instead of one after another (pipeline: True in salmon.yaml). The emails are
+parsed, and their text is analyzed and their document vectors for the
+similarity checks computed when analyze_text is set, in a pool of
+processes (parse), several messages at once when there's a backlog (see
+salmonnlp). The rating is calculated and written into the database by
+one writer thread in the order in which the messages were claimed (conclude),
+because the similarity checks of an email read what the emails before it
+wrote. The emails are then saved, sent to MQTT and relayed by a pool of
+threads (deliver). The stages are connected by bounded queues, so a slow
+stage stops the ones before it instead of piling up messages in memory, and
+the throughput of every stage is logged regularly. Database writes of the
+delivery stage are passed to the writer thread with persist().
+"""
+
+import concurrent.futures
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+
+from salmon import salmonconclude
+from salmon import salmonmailparser
+from salmon import salmonrelay
+from salmon import salmonstartup
+from salmon import utils
+
+# the running pipeline of this process, see persist
+_pipeline = None
+
+
+def persist(function, *args):
+    """Calls function, which writes into the database, in the writer thread
+    of the running pipeline. Without a pipeline, or in the writer thread
+    itself, it is called right away.
+
+    Args:
+        function (callable): Function writing into the database.
+        args: Its arguments.
+    """
+    pipeline = _pipeline
+    if pipeline is None or threading.current_thread() is pipeline.writer:
+        function(*args)
+        return
+    pipeline.writes.put((function, args))
+
+
+def parse(messages):
+    """Parse stage, it runs in a process of the pool. With analyze_text the
+    texts of all the messages are analyzed at once, see salmonconclude.analyze_texts.
+
+    Args:
+        messages (list): Name of the message in the queue (str), raw email
+            (bytes) and whether it is scored in degraded mode, without the
+            text analysis (bool), for every message.
+
+    Returns:
+        list: Email fields parsed into a dictionary (None if the email can't
+            be parsed) and the seconds it took, for every message.
+    """
+    results = []
+    for key, data, degraded in messages:
+        started = time.time()
+        results.append([salmonmailparser.parse_email(key, data), time.time() - started])
+    if utils.settings.data["relay"]["analyze_text"]:
+        analyzed = [
+            result for result, (key, data, degraded) in zip(results, messages)
+            if result[0] is not None and not degraded
+        ]
+        if analyzed:
+            started = time.time()
+            try:
+                salmonconclude.analyze_texts([mail_fields for mail_fields, busy in analyzed])
+            except Exception:
+                logging.exception("[-] (salmonpipeline.py) - Analyzing a batch of texts failed, analyzing them one by one.")
+                for mail_fields, busy in analyzed:
+                    try:
+                        salmonconclude.analyze_texts([mail_fields])
+                    except Exception:
+                        # the conclude stage analyzes it again and fails only this message
+                        pass
+            # every message gets its share of the time of the batch
+            for result in analyzed:
+                result[1] += (time.time() - started) / len(analyzed)
+    return [tuple(result) for result in results]
+
+
+def _init_process(parent):
+    # the processes are forked from the relay, they leave the signals to it
+    # and exit with it even when it is killed
+    for signum in (signal.SIGHUP, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    threading.Thread(target=_watch_parent, args=(parent,), daemon=True).start()
+    salmonstartup.warm_up()
+
+
+def _watch_parent(parent):
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+
+class Stage(object):
+    """Counters of a pipeline stage since the last report.
+
+    Attributes:
+        name (str): Name of the stage in the log.
+        workers (int): Number of processes or threads of the stage.
+        queue (queue.Queue): Bounded queue in front of the stage, None when the stage has none.
+        processed (int): Number of messages done.
+        failed (int): Number of messages the stage failed on.
+        busy (float): Seconds the workers spent on the messages.
+        blocked (float): Seconds the stage before waited for room in the queue (backpressure).
+    """
+
+    def __init__(self, name, workers, size=0):
+        self.name = name
+        self.workers = workers
+        self.queue = queue.Queue(size) if size else None
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+
+    def put(self, item):
+        """Puts the item into the queue, blocks while it is full."""
+        started = time.time()
+        self.queue.put(item)
+        with self.lock:
+            self.blocked += time.time() - started
+
+    def count(self, busy, failed=False):
+        with self.lock:
+            self.processed += 1
+            self.failed += failed
+            self.busy += busy
+
+    def report(self, elapsed):
+        """Returns the counters as a log line and resets them."""
+        with self.lock:
+            line = "%s: %d messages (%.1f/s), %d failed, busy %d%%" % (
+                self.name, self.processed, self.processed / elapsed, self.failed,
+                100 * self.busy / (elapsed * self.workers),
+            )
+            if self.queue is not None:
+                line += ", queue %d/%d, waited %.1f s for room" % (
+                    self.queue.qsize(), self.queue.maxsize, self.blocked
+                )
+            self.processed = 0
+            self.failed = 0
+            self.busy = 0.0
+            self.blocked = 0.0
+        return line
+
+
+class RelayPipeline(object):
+    """Parse, conclude and deliver stages of the relay.
+
+    Attributes:
+        parse (Stage): Pool of parse_workers processes.
+        conclude (Stage): The writer thread, its queue holds the messages being
+            parsed and parsed in the order they were submitted.
+        deliver (Stage): Pool of delivery_threads threads.
+        writes (queue.Queue): Database writes waiting for the writer thread, see persist.
+        report (int): Seconds between two logged reports, 0 turns them off.
+        batch_size (int): Number of messages parsed in one task of the pool, see parse.
+        batch (list): Submitted messages waiting for a full batch, see flush.
+    """
+
+    def __init__(self, parse_workers=2, delivery_threads=4, queue_size=100, report=60, batch_size=1):
+        self.parse = Stage("parse", parse_workers)
+        self.conclude = Stage("conclude", 1, queue_size)
+        self.deliver = Stage("deliver", delivery_threads, queue_size)
+        self.writes = queue.Queue()
+        self.report = report
+        self.batch_size = batch_size
+        self.batch = []
+        self.reported = None
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.writer = None
+        self.threads = []
+        self.done = None
+        self.failed = None
+        self.pending = 0
+        self.idle = threading.Condition()
+
+    def start(self, done, failed=None):
+        """Starts the processes and the threads of the pipeline.
+
+        Args:
+            done (callable): Called with the key of every delivered message,
+                from one of the delivery threads.
+            failed (callable): Called with the key and the MailRequest of every
+                message a stage failed on, from the writer or a delivery thread.
+        """
+        global _pipeline
+        self.done = done
+        self.failed = failed
+        # the processes are forked before the threads of the pipeline exist
+        self.pool = self._new_pool()
+        self.writer = threading.Thread(target=self._write, name="pipeline-conclude", daemon=True)
+        self.threads = [self.writer]
+        for i in range(self.deliver.workers):
+            self.threads.append(
+                threading.Thread(target=self._deliver, name="pipeline-deliver-%d" % i, daemon=True)
+            )
+        self.reported = time.time()
+        _pipeline = self
+        for thread in self.threads:
+            thread.start()
+        logging.info(
+            "[+] (salmonpipeline.py) - Pipeline started with %d parse processes, %d delivery threads "
+            "and queues for %d messages.", self.parse.workers, self.deliver.workers, self.conclude.queue.maxsize
+        )
+
+    def submit(self, key, mail_request, degraded=False):
+        """Puts a claimed message into the pipeline, it blocks while the
+        pipeline is full. The messages are parsed in batches of batch_size,
+        the one who submits them calls flush when no other one is waiting.
+
+        Args:
+            key (str): Name of the message in the queue.
+            mail_request (MailRequest): Instance of the MailRequest class with eml data.
+            degraded (bool): Score the email in degraded mode, see salmonoverload.
+        """
+        with self.idle:
+            self.pending += 1
+        self.batch.append((key, mail_request, degraded))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Passes the submitted messages to the parse stage without waiting for a full batch."""
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        pool = self.pool
+        try:
+            future = pool.submit(parse, [(key, mail_request.Data, degraded) for key, mail_request, degraded in batch])
+        except concurrent.futures.process.BrokenProcessPool:
+            future = None
+        for index, (key, mail_request, degraded) in enumerate(batch):
+            self.conclude.put((key, mail_request, degraded, pool, future, index))
+
+    def drain(self):
+        """Waits until all submitted messages and database writes are done."""
+        self.flush()
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+        self.writes.join()
+
+    def stop(self):
+        """Stops the pipeline after the submitted messages are done."""
+        global _pipeline
+        self.drain()
+        self.conclude.put(None)
+        for i in range(self.deliver.workers):
+            self.deliver.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.pool.shutdown()
+        _pipeline = None
+
+    def _new_pool(self):
+        pool = concurrent.futures.ProcessPoolExecutor(
+            self.parse.workers, initializer=_init_process, initargs=(os.getpid(),)
+        )
+        # the first task starts all the processes
+        pool.submit(time.time).result()
+        return pool
+
+    def _parsed(self, key, mail_request, degraded, pool, future, index):
+        try:
+            if future is not None:
+                return future.result()[index]
+        except concurrent.futures.process.BrokenProcessPool:
+            pass
+        with self.pool_lock:
+            if self.pool is pool:
+                logging.error("[-] (salmonpipeline.py) - A parse process died, starting new ones.")
+                pool.shutdown(wait=False)
+                self.pool = self._new_pool()
+            pool = self.pool
+        return pool.submit(parse, [(key, mail_request.Data, degraded)]).result()[0]
+
+    def _write(self):
+        while True:
+            self._run_writes()
+            self._report()
+            try:
+                item = self.conclude.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is None:
+                self._run_writes()
+                return
+            key, mail_request, degraded, pool, future, index = item
+            try:
+                mail_fields, busy = self._parsed(key, mail_request, degraded, pool, future, index)
+            except Exception:
+                logging.exception("[-] (salmonpipeline.py) - Parsing %s failed.", key)
+                self.parse.count(0, failed=True)
+                self._fail(key, mail_request)
+                continue
+            self.parse.count(busy)
+
+            started = time.time()
+            try:
+                if mail_fields is None:
+                    salmonmailparser.move_to_undeliverable(key, mail_request)
+                    final_rating = None
+                else:
+                    final_rating = salmonconclude.conclude(
+                        mail_fields, key, mail_request, deliver=False, degraded=degraded
+                    )
+            except Exception:
+                logging.exception("[-] (salmonpipeline.py) - Rating %s failed.", key)
+                self.conclude.count(time.time() - started, failed=True)
+                self._fail(key, mail_request)
+                continue
+            self.conclude.count(time.time() - started)
+            if mail_fields is None:
+                self._complete(key)
+            else:
+                self.deliver.put((key, mail_request, mail_fields, final_rating))
+
+    def _run_writes(self):
+        while True:
+            try:
+                function, args = self.writes.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                function(*args)
+            except Exception:
+                logging.exception("[-] (salmonpipeline.py) - Database write %s failed.", function.__name__)
+            finally:
+                self.writes.task_done()
+
+    def _deliver(self):
+        while True:
+            item = self.deliver.queue.get()
+            if item is None:
+                return
+            key, mail_request, mail_fields, final_rating = item
+            started = time.time()
+            try:
+                salmonrelay.relay(mail_fields, key, mail_request, final_rating)
+            except Exception:
+                logging.exception("[-] (salmonpipeline.py) - Delivery of %s failed.", key)
+                self.deliver.count(time.time() - started, failed=True)
+                self._fail(key, mail_request)
+                continue
+            self.deliver.count(time.time() - started)
+            self._complete(key)
+
+    def _complete(self, key):
+        try:
+            self.done(key)
+        except Exception:
+            logging.exception("[-] (salmonpipeline.py) - Completing %s failed.", key)
+        finally:
+            self._finished()
+
+    def _fail(self, key, mail_request):
+        try:
+            if self.failed is not None:
+                self.failed(key, mail_request)
+        except Exception:
+            logging.exception("[-] (salmonpipeline.py) - Handling the failure of %s failed.", key)
+        finally:
+            self._finished()
+
+    def _finished(self):
+        with self.idle:
+            self.pending -= 1
+            if not self.pending:
+                self.idle.notify_all()
+
+    def _report(self):
+        now = time.time()
+        if not self.report or now - self.reported < self.report:
+            return
+        elapsed = now - self.reported
+        self.reported = now
+        for stage in (self.parse, self.conclude, self.deliver):
+            logging.info("[+] (salmonpipeline.py) - %s", stage.report(elapsed))
@@ -0,0 +1,200 @@
+"""salmonqueueindex module.
+
+This module contains the sharded layout of the Maildir queue and the index
+of the messages waiting in it. In the sharded layout new/ (and meta/ with the
+metadata sidecars) has up to 256 subdirectories and every message goes into
+the one its key hashes to, so no directory holds hundreds of thousands of
+files after a relay outage. QueueIndex keeps the pending keys ordered by
+arrival time, so the oldest message is popped first without listing and
+stat-ing the whole queue for every pop.
+The layout of a queue is stored in its directory (LAYOUT_FILE), so every
+process opening the queue agrees on it.
+It is installed into both the receiver and the relay salmon lib.
+"""
+
+import heapq
+import logging
+import os
+import re
+import time
+import zlib
+
+LAYOUT_FILE = "shards"
+MAX_SHARDS = 256
+META_DIR = "meta"
+
+# Maildir keys start with the arrival time, e.g. 1592900000.M123456P42Q1...
+KEY_TIME = re.compile(r"^(\d+)\.M(\d+)")
+
+
+def shard_of(key, shards):
+    """Returns the name of the subdirectory the key belongs to."""
+    return "%02x" % (zlib.crc32(key.encode("utf-8")) % shards)
+
+
+def shard_names(shards):
+    return ["%02x" % i for i in range(shards)]
+
+
+def new_dirs(queue_dir, shards=0):
+    """Returns the directories with the new messages of the queue."""
+    if shards:
+        return [os.path.join(queue_dir, "new", name) for name in shard_names(shards)]
+    return [os.path.join(queue_dir, "new")]
+
+
+def message_path(queue_dir, key, shards=0):
+    """Returns the path of a new message of the queue."""
+    if shards:
+        return os.path.join(queue_dir, "new", shard_of(key, shards), key)
+    return os.path.join(queue_dir, "new", key)
+
+
+def metadata_path(queue_dir, key, shards=0):
+    """Returns the path of the metadata sidecar of a message of the queue."""
+    if shards:
+        return os.path.join(queue_dir, META_DIR, shard_of(key, shards), key + ".json")
+    return os.path.join(queue_dir, META_DIR, key + ".json")
+
+
+def read_layout(queue_dir):
+    """Returns the number of shards of the queue, 0 for the plain Maildir."""
+    try:
+        with open(os.path.join(queue_dir, LAYOUT_FILE)) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def setup_layout(queue_dir, shards=None):
+    """Returns the number of shards of the queue and creates the directories.
+
+    Args:
+        queue_dir (str): Maildir of the queue, it has to exist.
+        shards (int): Wanted number of shards, None keeps what the queue has.
+            A queue which already has a layout keeps it, the messages in it
+            would not be found otherwise. Messages of a plain Maildir queue
+            are moved into their shards when it gets sharded.
+
+    Returns:
+        int: Number of shards, 0 for the plain Maildir layout.
+    """
+    current = read_layout(queue_dir)
+    if shards is None or shards == current:
+        shards = current
+    elif current:
+        logging.warning(
+            "[+] (salmonqueueindex.py) - Queue %s has %d shards, %d ignored.", queue_dir, current, shards
+        )
+        shards = current
+    if not shards:
+        return 0
+    if not 0 < shards <= MAX_SHARDS:
+        raise ValueError("number of queue shards must be between 1 and %d" % MAX_SHARDS)
+    for sub in ("new", META_DIR):
+        for name in shard_names(shards):
+            os.makedirs(os.path.join(queue_dir, sub, name), exist_ok=True)
+    if not current:
+        shard_flat_files(queue_dir, shards)
+        path = os.path.join(queue_dir, LAYOUT_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write("%d\n" % shards)
+        os.rename(path + ".tmp", path)
+    return shards
+
+
+def shard_flat_files(queue_dir, shards):
+    """Moves messages and sidecars of a plain Maildir queue into their shards."""
+    moved = 0
+    for sub, suffix in ((META_DIR, ".json"), ("new", "")):
+        directory = os.path.join(queue_dir, sub)
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith(suffix) and not entry.name.startswith("."):
+                key = entry.name[:len(entry.name) - len(suffix)].split(":")[0]
+                os.rename(entry.path, os.path.join(directory, shard_of(key, shards), entry.name))
+                moved += 1
+    if moved:
+        logging.info("[+] (salmonqueueindex.py) - Moved %d files of %s into shards.", moved, queue_dir)
+
+
+def arrival(key):
+    """Returns a sortable arrival time of the key."""
+    match = KEY_TIME.match(key)
+    if match is None:
+        return (0, 0, key)
+    return (int(match.group(1)), int(match.group(2)), key)
+
+
+def age(key, now=None):
+    """Returns how many seconds ago the message with the key arrived, 0
+    when the key doesn't start with the arrival time."""
+    match = KEY_TIME.match(key)
+    if match is None:
+        return 0
+    return max((now or time.time()) - int(match.group(1)), 0)
+
+
+def scan(new_dirs):
+    """Yields the keys of all messages in the given directories."""
+    for directory in new_dirs:
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if not entry.name.startswith(".") and entry.is_file():
+                    yield entry.name.split(":")[0]
+
+
+def backlog(new_dirs, now=None):
+    """Returns the number of messages in the given directories and how many
+    seconds the oldest of them waits."""
+    depth = 0
+    oldest = None
+    for key in scan(new_dirs):
+        depth += 1
+        if KEY_TIME.match(key) and (oldest is None or arrival(key) < arrival(oldest)):
+            oldest = key
+    return depth, age(oldest, now) if oldest is not None else 0
+
+
+class QueueIndex(object):
+    """In-memory index of the keys waiting in a queue, oldest first.
+
+    Removed keys are only forgotten and dropped from the heap when they
+    get to its top, so add, discard and pop are all O(log n).
+    """
+
+    def __init__(self, keys=()):
+        self.heap = [arrival(key) for key in keys]
+        heapq.heapify(self.heap)
+        self.pending = set(item[2] for item in self.heap)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, key):
+        return key in self.pending
+
+    def add(self, key):
+        if key not in self.pending:
+            self.pending.add(key)
+            heapq.heappush(self.heap, arrival(key))
+
+    def discard(self, key):
+        self.pending.discard(key)
+
+    def pop(self, n=1):
+        """Removes and returns up to n oldest keys."""
+        keys = []
+        while self.heap and len(keys) < n:
+            key = heapq.heappop(self.heap)[2]
+            if key in self.pending:
+                self.pending.discard(key)
+                keys.append(key)
+        return keys
+
+    def keys(self):
+        """Returns the pending keys, oldest first."""
+        return [item[2] for item in sorted(self.heap) if item[2] in self.pending]
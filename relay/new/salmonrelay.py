@@ -2,8 +2,8 @@
 
 This module gets an email from the salmonconclude module and saves the eml
 and attachment if it is enabled. It sends the eml content to the MQTT topics, if enabled.
-Depending on the final rating of the current email and the last checkpoint, it calls the
-process_message function, which takes care of sending the email to the recipient. 
+Depending on the final rating of the current email and the last checkpoint, it submits
+the email to the salmondelivery.DeliveryService, which sends it to the recipient.
 If enabled, this module destroys the attachment, links, and reply-to.
 Author: Silvie Chlupová
 Date    Created: 09/17/2019
@@ -20,9 +20,12 @@ import iottl
 import random
 import string
 import base64
+import html
 from re import search as regex_search
 from salmon import server
 from salmon import utils
+from salmon import salmonpipeline
+from salmon import salmonqueueindex
 from salmon.salmonspam import update_statistics
 
 
@@ -46,13 +49,39 @@ def get_file_content(filename):
     return content
 
 
+def raw_email(mail_request):
+    """Function returns the email as it was queued.
+
+    Args:
+        mail_request (MailRequest): Instance of the MailRequest class with eml data.
+
+    Returns:
+        bytes: Raw email.
+    """
+    data = mail_request.Data
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return data
+
+
+def save_raw_email(mail_request, destination):
+    """Function writes the email as it was queued into a file.
+
+    Args:
+        mail_request (MailRequest): Instance of the MailRequest class with eml data.
+        destination (str): Path of the file.
+    """
+    with open(destination, "wb") as f:
+        f.write(raw_email(mail_request))
+
+
 def relay(mail_fields, key, mail_request, final_rating):
     """If the relay is enabled, this function does the relaying.
 
     First, it destroys the attachment if it is enabled, then it sends the email on
     the MQTT topic, saves the email, and if relaying is enabled,
-    it does the last check and the email is sent to the process_message method,
-    which takes care of sending the email to the recipient.
+    it does the last check and the email is submitted to the delivery service,
+    which sends it to the recipient. Only delivered emails count as relayed.
 
     Args:
         mail_fields (dict): Email parsed into a dictionary.
@@ -63,8 +92,11 @@ def relay(mail_fields, key, mail_request, final_rating):
     queuePath = utils.settings.data["directory"]["queuepath"]
     relay_enabled = utils.settings.data["relay"]["relay_enabled"]
 
-    source = queuePath + "/new/" + key
+    source = salmonqueueindex.message_path(queuePath, key, salmonqueueindex.read_layout(queuePath))
     destination = utils.settings.data["directory"]["rawspampath"] + "/" + key
+    if not os.path.isfile(source):
+        # claimed messages are in processing/<worker>/ or in SQLite, see Queue.claim
+        source = None
 
     if (
         len(mail_fields["attachmentFile"]) > 0
@@ -76,13 +108,17 @@ def relay(mail_fields, key, mail_request, final_rating):
         utils.settings.data["relay"]["mqtt"]
         and mail_fields["text"] != "this is testing email from salmon"
     ):
-        useMQTT(source, key)
+        content = None if source else raw_email(mail_request).decode("utf-8", "replace")
+        useMQTT(source, key, getattr(mail_request, "metadata", None), content)
 
     if (
         utils.settings.data["relay"]["save_eml"]
         and mail_fields["text"] != "this is testing email from salmon"
     ):
-        shutil.copy2(source, destination)
+        if source:
+            shutil.copy2(source, destination)
+        else:
+            save_raw_email(mail_request, destination)
 
     if relay_enabled:
         relaycounter = utils.settings.data["relay"]["globalcounter"]
@@ -96,10 +132,11 @@ def relay(mail_fields, key, mail_request, final_rating):
                 mail_request = destroy_link(mail_fields, mail_request)
                 mail_request = destroy_attachment(mail_fields, mail_request)
                 mail_request = destroy_reply_to(mail_fields, mail_request)
+                if not utils.settings.delivery.submit(mail_request):
+                    return
                 if utils.settings.data["relay"]["save_statistics"]:
-                    update_statistics(5)
-                processMessage = server.QueueReceiver(queuePath)
-                processMessage.process_message(mail_request)
+                    # relay runs in the delivery threads of the pipeline
+                    salmonpipeline.persist(update_statistics, 5)
                 server.QueueReceiver.totalRelay += 1
 
 
@@ -119,24 +156,31 @@ def save_attachment(mail_fields):
             f.write(mail_fields["attachmentFile"][i])
 
 
-def useMQTT(file_path, filename):
+def useMQTT(file_path, filename, metadata=None, content=None):
     """Function prepares the eml message and the global message
     and sends the message to the MQTT using the iottl library.
 
     Args:
         file_path (str): Full path to the eml file in the queue/new directory.
         filename (str): Name of the file with eml.
+        metadata (dict): Metadata of the SMTP session stored by the receiver, if any.
+        content (str): The eml itself, file_path is not read then.
     """
-    content = get_file_content(file_path)
+    if content is None:
+        content = get_file_content(file_path)
     stamp = int(time.time())
     eml_msg = {"timestamp": stamp, "filename": filename, "contents": content}
 
     try:
-        ip = regex_search("(?:[0-9]{1,3}\.){3}[0-9]{1,3}", filename)
-        if ip is None:
-            ip = ""
+        if metadata and metadata.get("peer"):
+            ip = metadata["peer"]
         else:
-            ip = ip.group()
+            # older receivers only put the peer IP into the file name
+            ip = regex_search("(?:[0-9]{1,3}\.){3}[0-9]{1,3}", filename)
+            if ip is None:
+                ip = ""
+            else:
+                ip = ip.group()
 
         global_msg = {
             "timestamp": stamp,
@@ -181,6 +225,7 @@ def destroy_attachment(mail_fields, mail_request):
     ):
         return mail_request
 
+    replacements = {}
     for attachment in mail_fields["undecodeAttachmentFile"]:
         l = list(attachment[20 : len(attachment) - 20])
         random.shuffle(l)
@@ -191,13 +236,8 @@ def destroy_attachment(mail_fields, mail_request):
             + bytes(attachment[len(attachment) - 20 :], encoding="utf-8")
         )
         logging.debug("[+] (salmonrelay.py) - Destroying attachment!")
-        index = mail_request.Data.find(bytes(attachment, encoding="utf-8"))
-        if index >= 0:
-            before_attachment = mail_request.Data[:index]
-            after_attachment = mail_request.Data[index + len(destroyed_attachment) :]
-            mail_request.Data = (
-                before_attachment + destroyed_attachment + after_attachment
-            )
+        replacements[bytes(attachment, encoding="utf-8")] = destroyed_attachment
+    mail_request.rewrite(replacements)
     return mail_request
 
 
@@ -214,6 +254,7 @@ def destroy_link(mail_fields, mail_request):
     if not mail_fields["links"] or not utils.settings.data["relay"]["destroy_link"]:
         return mail_request
 
+    replacements = {}
     for link in mail_fields["links"]:
         letters = string.ascii_lowercase
         last = None
@@ -226,17 +267,17 @@ def destroy_link(mail_fields, mail_request):
             link[: -(len(link) - last + 1)] + random.choice(letters) + link[last:]
         )
         try:
-            found_link = mail_request.Data.decode().find(link)
+            replacements[bytes(link, "utf-8")] = bytes(destroyed_link, "utf-8")
+            # the links of text/html are unescaped (see salmonhtml), & is &amp; in the eml
+            escaped_link = html.escape(link, quote=False)
+            if escaped_link != link:
+                escaped_destroyed_link = html.escape(destroyed_link, quote=False)
+                replacements[bytes(escaped_link, "utf-8")] = bytes(escaped_destroyed_link, "utf-8")
+            logging.debug("[+] (salmonrelay.py) - Destroying link %s to %s" % (link, destroyed_link))
         except Exception as error:
             logging.error("[-] (salmonrelay.py) - It wasn't possible to destroy the link!")
-        else:
-            try:
-                mail_request.Data = mail_request.Data.replace(
-                    bytes(link, "utf-8"), bytes(destroyed_link, "utf-8")
-                )
-                logging.debug("[+] (salmonrelay.py) - Destroying link %s to %s" % (link, destroyed_link))
-            except Exception as error:
-                logging.error("[-] (salmonrelay.py) - It wasn't possible to destroy the link!")
+    # all the links are replaced in one pass over the email
+    mail_request.rewrite(replacements)
     return mail_request
 
 
@@ -273,9 +314,7 @@ def destroy_reply_to(mail_fields, mail_request):
         "[+] (salmonrelay.py) - Destroying reply-to field from %s to %s" % 
         (mail_fields["reply-to"], destroyed_reply_to)
     )
-    mail_request.Data = mail_request.Data.replace(
-        bytes(reply_to, "utf-8"), bytes(destroyed_reply_to, "utf-8")
-    )
+    mail_request.rewrite({bytes(reply_to, "utf-8"): bytes(destroyed_reply_to, "utf-8")})
     return mail_request
 
 
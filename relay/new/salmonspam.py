@@ -9,13 +9,14 @@ Date    Created: 04/26/2020
 
 import logging
 import ssdeep
-import spacy
 import warnings
 warnings.filterwarnings("ignore")
 import re
 import os
 import collections
 from datetime import datetime
+from salmon import salmonhtml
+from salmon import salmonvectors
 from salmon import utils
 from salmon.salmondb import Recipient
 from salmon.salmondb import Statistics
@@ -30,7 +31,12 @@ from salmon.salmondb import get_passwords
 from salmon.salmondb import update_statistics_counter
 from salmon.salmondb import update_link_counter
 from salmon.salmondb import get_recipient_by_email
-from salmon.salmondb import get_mail_fields
+from salmon.salmondb import get_similar_mail_fields
+from salmon.salmondb import get_doc_vectors
+from salmon.salmondb import push_doc_vectors
+
+# what the rating needs from the NLP analysis of the body, see get_text_features
+TextFeatures = collections.namedtuple("TextFeatures", ("real_world_words", "entities"))
 
 
 class Spam:
@@ -104,42 +110,55 @@ class Spam:
                 return True
         return False
 
-    def get_records_if_similar(self, spam_id, nlp):
-        mail_fields_from_db = get_mail_fields_by_id(spam_id)
-        similar = 0
+    def get_records_if_similar(self, spam_ids, vectors, nlp):
+        """Returns the test and maybe test emails of the email fields with
+        at least one of body_plain, body_html and subject similar to this
+        email's. The document vectors of all of them are compared at once,
+        see salmonvectors.
+
+        Args:
+            spam_ids (list): Ids of the email fields from the similarity check.
+            vectors (numpy.ndarray): Document vectors of this email, see salmonvectors.get_doc_vectors.
+            nlp (Language): Loaded spaCy model for the email fields stored without the vectors.
+
+        Returns:
+            list: The similar records.
+        """
         mail_list = []
-        if len(mail_fields_from_db.body_plain) > 0 and len(self.body_plain) > 0:
-            tokens_db = nlp(mail_fields_from_db.body_plain)
-            tokens = nlp(self.body_plain)
-            if tokens.similarity(tokens_db) > 0.75:
-                logging.info(
-                    "[+] (salmonspam.py) - Email with a similar body_plain already in the database."
-                )
-                similar += 1
-        if len(mail_fields_from_db.body_html) > 0 and len(self.body_html) > 0:
-            tokens_db = nlp(mail_fields_from_db.body_html)
-            tokens = nlp(self.body_html)
-            if tokens.similarity(tokens_db) > 0.75:
-                logging.info(
-                    "[+] (salmonspam.py) - Email with a similar body_html already in the database."
-                )
-                similar += 1
-        if len(mail_fields_from_db.subject) > 0 and len(self.subject) > 0:
-            tokens_db = nlp(mail_fields_from_db.subject)
-            tokens = nlp(self.subject)
-            if tokens.similarity(tokens_db) > 0.75:
-                logging.info(
-                    "[+] (salmonspam.py) - Email with a similar subject already in the database."
-                )
-                similar += 1
-        if similar >= 1:
-            # at least one from [body_plain, body_html, subject] should be similar
-            test_mail = get_testmail_by_mailfield_id(mail_fields_from_db.id)
-            if test_mail:
-                mail_list.append(test_mail)
-            maybe_test_mail = get_maybetestmail_by_mailfield_id(mail_fields_from_db.id)
-            if maybe_test_mail:
-                mail_list.append(maybe_test_mail)
+        if vectors is None or not spam_ids:
+            return mail_list
+        ids, matrix = get_doc_vectors(spam_ids)
+        missing = [spam_id for spam_id in spam_ids if spam_id not in ids]
+        for spam_id in missing:
+            # stored before the vectors were, they are computed only once
+            mail_fields_from_db = get_mail_fields_by_id(spam_id)
+            vectors_db = salmonvectors.get_doc_vectors(
+                nlp,
+                mail_fields_from_db.subject,
+                mail_fields_from_db.body_plain,
+                salmonhtml.visible_text(mail_fields_from_db.body_html),
+            )
+            if vectors_db is not None:
+                push_doc_vectors(spam_id, vectors_db)
+        if missing:
+            ids, matrix = get_doc_vectors(spam_ids)
+        if not ids:
+            return mail_list
+        similar_fields = salmonvectors.get_similarities(vectors, matrix) > salmonvectors.THRESHOLD
+        for spam_id, similar in zip(ids, similar_fields):
+            for field, is_similar in zip(salmonvectors.FIELDS, similar):
+                if is_similar:
+                    logging.info(
+                        "[+] (salmonspam.py) - Email with a similar %s already in the database." % field
+                    )
+            if similar.any():
+                # at least one from [body_plain, body_html, subject] should be similar
+                test_mail = get_testmail_by_mailfield_id(spam_id)
+                if test_mail:
+                    mail_list.append(test_mail)
+                maybe_test_mail = get_maybetestmail_by_mailfield_id(spam_id)
+                if maybe_test_mail:
+                    mail_list.append(maybe_test_mail)
         return mail_list
 
     def get_field(self, mail_field):
@@ -185,7 +204,8 @@ class Spam:
             logging.error("Rule %s not formatted correctly" % str(rule))
 
     def get_ids_for_similarity_check(self):
-        mail_fields_from_db = get_mail_fields()
+        # only the candidates from the ssdeep index, ssdeep.compare gives 0 to the other ones
+        mail_fields_from_db = get_similar_mail_fields(self.ssdeep)
         ids_for_similarity_check = []
         for mail_fields in mail_fields_from_db:
             ratio = ssdeep.compare(self.ssdeep, mail_fields.ssdeep)
@@ -442,19 +462,8 @@ class Spam:
             if utils.settings.data["relay"]["save_statistics"]:
                 update_statistics(20)
 
-    def analyze_text_in_body(self, nlp, text, url_regex_pattern, mail_fields):
-        if text == "plain":
-            text = re.sub(url_regex_pattern, "", self.body_plain)
-        else:
-            text = re.sub(url_regex_pattern, "", self.body_html)
-        tokens = nlp(text)
-        real_world_words = []
-        for token in tokens:
-            if len(str(token)) > 2 and (
-                token.pos_ == "NOUN" or token.pos_ == "PROPN" or token.pos_ == "VERB"
-            ):
-                real_world_words.append(token)
-        if len(real_world_words) >= 10:
+    def analyze_text_in_body(self, features, mail_fields):
+        if features.real_world_words >= 10:
             # it's very unlikely that testing emails can contain so many real-world words
             self.rating -= 15
             logging.info(
@@ -463,7 +472,7 @@ class Spam:
             if utils.settings.data["relay"]["save_statistics"]:
                 update_statistics(21)
         elif (
-            len(real_world_words) < 3
+            features.real_world_words < 3
             and len(mail_fields["links"]) == 0
             and len(mail_fields["attachmentFileName"]) == 0
         ):
@@ -473,19 +482,22 @@ class Spam:
             )
             if utils.settings.data["relay"]["save_statistics"]:
                 update_statistics(22)
-        self.analyze_email_main_topic(tokens)
+        self.analyze_email_main_topic(features.entities)
+
+    def analyze_email_main_topic(self, entities):
+        # spaCy is imported with the model, not with the relay, see salmonnlp
+        import spacy
 
-    def analyze_email_main_topic(self, tokens):
         email_labels = {}
         email_favorite_topics = {}
-        for ent in tokens.ents:
-            if ent.label_ not in ["PERCENT", "CARDINAL", "DATE"]:
-                if ent.label_ not in email_labels.keys():
-                    email_labels[ent.label_] = 1
-                    email_favorite_topics[ent.label_] = [ent.text.strip()]
+        for label, text in entities:
+            if label not in ["PERCENT", "CARDINAL", "DATE"]:
+                if label not in email_labels.keys():
+                    email_labels[label] = 1
+                    email_favorite_topics[label] = [text]
                 else:
-                    email_labels[ent.label_] += 1
-                    email_favorite_topics[ent.label_].append(ent.text.strip())
+                    email_labels[label] += 1
+                    email_favorite_topics[label].append(text)
         most_common_label = 0
         for key, value in email_labels.items():
             if value > most_common_label:
@@ -513,6 +525,40 @@ class Spam:
         return False
 
 
+def get_text_features(nlp, text):
+    """Function analyzes the text with the NLP model and keeps only what
+    Spam.analyze_text_in_body needs, so it can be done in another process.
+
+    Args:
+        nlp (Language): Loaded spaCy model.
+        text (str): Text from body_plain or body_html without links.
+
+    Returns:
+        TextFeatures: Number of real-world words and the named entities as (label, text) tuples.
+    """
+    return get_doc_features(nlp(text))
+
+
+def get_doc_features(tokens):
+    """Function keeps what Spam.analyze_text_in_body needs from a text
+    analyzed by the NLP model, see get_text_features.
+
+    Args:
+        tokens (Doc): The analyzed text.
+
+    Returns:
+        TextFeatures: Number of real-world words and the named entities as (label, text) tuples.
+    """
+    real_world_words = 0
+    for token in tokens:
+        if len(str(token)) > 2 and (
+            token.pos_ == "NOUN" or token.pos_ == "PROPN" or token.pos_ == "VERB"
+        ):
+            real_world_words += 1
+    entities = [(ent.label_, ent.text.strip()) for ent in tokens.ents]
+    return TextFeatures(real_world_words, entities)
+
+
 def update_statistics(checkpoint_id):
     """Function changes the statistics about a checkpoint that
     changes the rating of the email.
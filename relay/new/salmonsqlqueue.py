@@ -0,0 +1,310 @@
+"""salmonsqlqueue module.
+
+This module stores the messages of a queue in one SQLite database in WAL mode
+(DB_FILE in the queue directory) instead of a Maildir, for the queue_backend
+"sqlite" of salmon.yaml. A small message is then one row instead of a file
+create, a rename, an unlink and an inode. Pushes can be committed together
+(group commit): with commit_interval the rows wait in memory and are inserted
+and committed in one short transaction after commit_interval seconds or
+commit_batch rows, whichever comes first, so the write lock of the database
+is never held between two pushes. Popping selects and deletes the rows in one
+transaction, so two consumers never get the same message. A consumer can
+also claim a message for a while (lease) and delete it only when it is done.
+queue.SQLiteQueue puts the Queue API of the receiver and the relay on top of
+MessageStore. It is installed into both the receiver and the relay salmon lib.
+"""
+
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+DB_FILE = "queue.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    metadata TEXT,
+    data BLOB NOT NULL,
+    worker TEXT,
+    lease REAL
+)
+"""
+
+# columns added after the first release of the schema
+COLUMNS = (("worker", "TEXT"), ("lease", "REAL"))
+
+# stores with pushed messages which may wait for the group commit at exit
+_stores = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_stores():
+    for store in list(_stores):
+        store.flush()
+
+
+def exists(queue_dir):
+    """Returns True when the queue in queue_dir is stored in SQLite."""
+    return os.path.isfile(os.path.join(queue_dir, DB_FILE))
+
+
+class MessageStore(object):
+    """Messages of a queue in an SQLite database.
+
+    Attributes:
+        path (str): Path of the database.
+        commit_interval (float): Seconds a pushed message may wait for the
+            commit, 0 commits every push before it returns.
+        commit_batch (int): Number of pushed messages committed at the latest
+            together.
+    """
+
+    def __init__(self, queue_dir, commit_interval=0, commit_batch=1000):
+        os.makedirs(queue_dir, exist_ok=True)
+        self.path = os.path.join(queue_dir, DB_FILE)
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        # the receiver pushes from the message threads of its server, the
+        # group commit timer commits from another one
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode a commit is not synced, only the checkpoints are
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        columns = set(row[1] for row in self.db.execute("PRAGMA table_info(messages)"))
+        for name, kind in COLUMNS:
+            if name not in columns:
+                self.db.execute("ALTER TABLE messages ADD COLUMN %s %s" % (name, kind))
+        self.lock = threading.RLock()
+        # rows of the pushed messages waiting for the group commit
+        self.buffer = []
+        self.timer = None
+        _stores.add(self)
+
+    def add(self, key, data, metadata=None):
+        """Stores a message, see add_many."""
+        self.add_many([(key, data, metadata)])
+
+    def add_many(self, messages):
+        """Stores (key, data, metadata) tuples, keys already in the store
+        are skipped. Without commit_interval they are committed before it
+        returns, with it a failed commit is logged and tried again later."""
+        rows = []
+        for key, data, metadata in messages:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            rows.append((key, len(data), None if metadata is None else json.dumps(metadata), data))
+        with self.lock:
+            self.buffer.extend(rows)
+            if not self.commit_interval:
+                self.flush()
+            elif len(self.buffer) >= self.commit_batch:
+                self._flush_later()
+            elif self.timer is None:
+                self._start_timer()
+
+    def _start_timer(self):
+        self.timer = threading.Timer(self.commit_interval, self._flush_later)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("[-] (salmonsqlqueue.py) - Group commit failed, it is retried.")
+            with self.lock:
+                if self.buffer and self.timer is None:
+                    self._start_timer()
+
+    def flush(self):
+        """Inserts and commits the pushed messages waiting for the group
+        commit in one transaction."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.buffer:
+                return
+            rows, self.buffer = self.buffer, []
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+                try:
+                    self.db.executemany(
+                        "INSERT OR IGNORE INTO messages (key, size, metadata, data) VALUES (?, ?, ?, ?)", rows
+                    )
+                    self.db.execute("COMMIT")
+                except BaseException:
+                    self.db.execute("ROLLBACK")
+                    raise
+            except BaseException:
+                if self.commit_interval:
+                    # they were accepted already, the next flush writes them
+                    self.buffer = rows + self.buffer
+                raise
+            logging.debug("[+] (salmonsqlqueue.py) - Committed %d messages.", len(rows))
+
+    def get(self, key):
+        """Returns (data, metadata) of the message or None."""
+        with self.lock:
+            self.flush()
+            row = self.db.execute("SELECT data, metadata FROM messages WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0]), _metadata(row[1])
+
+    def get_metadata(self, key):
+        with self.lock:
+            self.flush()
+            row = self.db.execute("SELECT metadata FROM messages WHERE key = ?", (key,)).fetchone()
+        return None if row is None else _metadata(row[0])
+
+    def size(self, key):
+        """Returns the size of the message in bytes or None."""
+        with self.lock:
+            self.flush()
+            row = self.db.execute("SELECT size FROM messages WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def remove(self, key):
+        """Removes the message, returns False when there is none."""
+        with self.lock:
+            self.flush()
+            return self.db.execute("DELETE FROM messages WHERE key = ?", (key,)).rowcount > 0
+
+    def pop(self, n=1, key=None):
+        """Removes and returns up to n oldest messages (or the one with the
+        given key) as (key, data, metadata) tuples in one transaction."""
+        with self.lock:
+            self.flush()
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if key is None:
+                    rows = self.db.execute(
+                        "SELECT id, key, data, metadata FROM messages WHERE worker IS NULL ORDER BY id LIMIT ?",
+                        (n,),
+                    ).fetchall()
+                else:
+                    rows = self.db.execute(
+                        "SELECT id, key, data, metadata FROM messages WHERE key = ? AND worker IS NULL", (key,)
+                    ).fetchall()
+                self.db.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in rows])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return [(row[1], bytes(row[2]), _metadata(row[3])) for row in rows]
+
+    def claim(self, key, worker):
+        """Claims the message for the worker and returns (data, metadata),
+        or None when it is gone or claimed by another worker."""
+        with self.lock:
+            self.flush()
+            claimed = self.db.execute(
+                "UPDATE messages SET worker = ?, lease = ? WHERE key = ? AND worker IS NULL",
+                (worker, time.time(), key),
+            ).rowcount
+        if not claimed:
+            return None
+        return self.get(key)
+
+    def complete(self, key, worker):
+        """Removes a message claimed by the worker, returns False when the
+        worker doesn't hold it any more."""
+        with self.lock:
+            self.flush()
+            return self.db.execute(
+                "DELETE FROM messages WHERE key = ? AND worker = ?", (key, worker)
+            ).rowcount > 0
+
+    def reclaim(self, lease, worker=None):
+        """Releases the messages claimed more than lease seconds ago, except
+        the ones of worker, and returns how many, see release."""
+        with self.lock:
+            self.flush()
+            return self._release(
+                "worker IS NOT NULL AND worker IS NOT ? AND lease < ?", (worker, time.time() - lease)
+            )
+
+    def release(self, key, worker):
+        """Puts a message claimed by the worker back after a failed attempt,
+        counted as attempts in its metadata. Returns False when the worker
+        doesn't hold it any more."""
+        with self.lock:
+            self.flush()
+            return self._release("key = ? AND worker = ?", (key, worker)) > 0
+
+    def _release(self, where, parameters):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.db.execute("SELECT id, metadata FROM messages WHERE " + where, parameters).fetchall()
+            self.db.executemany(
+                "UPDATE messages SET worker = NULL, lease = NULL, metadata = ? WHERE id = ?",
+                [(json.dumps(_attempted(_metadata(metadata))), row_id) for row_id, metadata in rows],
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def renew(self, keys, worker):
+        """Starts the leases of messages the worker holds again."""
+        with self.lock:
+            self.flush()
+            now = time.time()
+            self.db.executemany(
+                "UPDATE messages SET lease = ? WHERE key = ? AND worker = ?", [(now, key, worker) for key in keys]
+            )
+
+    def keys(self):
+        """Returns the keys of all messages not claimed by a worker, the
+        oldest first."""
+        with self.lock:
+            self.flush()
+            return [row[0] for row in self.db.execute("SELECT key FROM messages WHERE worker IS NULL ORDER BY id")]
+
+    def backlog(self):
+        """Returns the number of messages not claimed by a worker and the key
+        of the oldest of them (None without any)."""
+        with self.lock:
+            self.flush()
+            depth = self.db.execute("SELECT COUNT(*) FROM messages WHERE worker IS NULL").fetchone()[0]
+            row = self.db.execute("SELECT key FROM messages WHERE worker IS NULL ORDER BY id LIMIT 1").fetchone()
+        return depth, row[0] if row else None
+
+    def __len__(self):
+        with self.lock:
+            self.flush()
+            return self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def clear(self):
+        with self.lock:
+            self.flush()
+            self.db.execute("DELETE FROM messages")
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def _attempted(metadata):
+    metadata = metadata or {}
+    metadata["attempts"] = metadata.get("attempts", 0) + 1
+    return metadata
+
+
+def _metadata(value):
+    if value is None:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
@@ -0,0 +1,141 @@
+"""salmonstartup module.
+
+This module measures the start of the relay. Between start() and stop(),
+which the boot module calls around the boot, it times every module the relay
+modules import, without the time of the relay modules that one imports in
+turn, like python -X importtime does. The modules the salmon command imported
+before the boot (salmon.server and its imports) aren't timed, python -X
+importtime shows them. The steps of the settings are measured with step().
+The boot module logs the slowest imports and the steps before the relay
+starts processing the queue. The resources which take long to load, like the NLP
+model, are loaded on first use instead, or in a background thread with
+warm_up once the processes of the relay are forked (nlp_warm_up in
+salmon.yaml).
+It is installed into the relay salmon lib.
+"""
+
+import builtins
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+
+# the modules whose imports are timed, the others are timed as part of the module which imported them
+RELAY_MODULES = ("salmon", "config", "app")
+# number of the slowest imports in the report
+REPORT_IMPORTS = 10
+
+started = time.time()
+# module -> seconds its import took without the timed imports in it, and the module which imported it
+imports = {}
+# name of a step -> seconds it took
+steps = {}
+_timed = set()
+_original_import = builtins.__import__
+_local = threading.local()
+_warm_ups = []
+_warmed_up = None
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    importer = (globals or {}).get("__name__") or ""
+    if level or importer.split(".")[0] not in RELAY_MODULES:
+        return _original_import(name, globals, locals, fromlist, level)
+    if name in sys.modules:
+        # from salmon import salmondb imports the submodule
+        missing = [name + "." + item for item in fromlist or () if name + "." + item not in sys.modules]
+    else:
+        missing = [name]
+    if not missing:
+        return _original_import(name, globals, locals, fromlist, level)
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(0.0)
+    begin = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - begin
+        nested = stack.pop()
+        # the names from fromlist which aren't modules took no time
+        loaded = [module for module in missing if module in sys.modules and module not in _timed]
+        if loaded:
+            # the submodules from one fromlist are loaded together and share the time
+            imports[" + ".join(loaded)] = (elapsed - nested, importer)
+            _timed.update(loaded)
+            if stack:
+                stack[-1] += elapsed
+
+
+def start():
+    """Starts timing the imports, stop() must follow in a finally block."""
+    global _original_import
+    if builtins.__import__ is not _timed_import:
+        _original_import = builtins.__import__
+        builtins.__import__ = _timed_import
+
+
+def stop():
+    """Stops timing the imports."""
+    if builtins.__import__ is _timed_import:
+        builtins.__import__ = _original_import
+
+
+@contextlib.contextmanager
+def step(name):
+    """Times a step of the start, e.g. with step("credentials"): ..."""
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        steps[name] = steps.get(name, 0.0) + time.perf_counter() - begin
+
+
+def report():
+    """Logs how long the start took."""
+    total = sum(seconds for seconds, importer in imports.values())
+    logging.info(
+        "[+] (salmonstartup.py) - Relay loaded in %.2f s, %.2f s of it importing %d modules.",
+        time.time() - started, total, len(imports),
+    )
+    slowest = sorted(imports.items(), key=lambda item: item[1][0], reverse=True)[:REPORT_IMPORTS]
+    logging.info(
+        "[+] (salmonstartup.py) - Slowest imports: %s.",
+        ", ".join("%s %.3f s (%s)" % (module, seconds, importer) for module, (seconds, importer) in slowest),
+    )
+    if steps:
+        logging.info(
+            "[+] (salmonstartup.py) - Steps: %s.",
+            ", ".join("%s %.3f s" % (name, seconds) for name, seconds in steps.items()),
+        )
+
+
+def add_warm_up(function):
+    """Adds a function loading a resource, warm_up calls it.
+
+    Args:
+        function (callable): Loads the resource, without arguments.
+    """
+    _warm_ups.append(function)
+
+
+def warm_up():
+    """Calls the functions from add_warm_up in a background thread, once in
+    every process. It's called after the processes of the relay are forked,
+    a process isn't forked while a thread imports a module."""
+    global _warmed_up
+    if not _warm_ups or _warmed_up == os.getpid():
+        return
+    _warmed_up = os.getpid()
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+
+def _warm_up():
+    for function in _warm_ups:
+        try:
+            function()
+        except Exception:
+            logging.exception("[-] (salmonstartup.py) - Warm-up %s failed.", getattr(function, "__qualname__", function))
@@ -0,0 +1,190 @@
+"""salmonurls module.
+
+This module finds the links in the text/plain and text/html of an email for
+salmonmailparser and removes them from the text salmonconclude analyzes. It
+finds the same links as the URL regular expression the parser used before
+(see tests/test_urls.py), in linear time. The regular
+expression backtracked exponentially on some bodies, so it ran with a
+timeout, and the SIGALRM timeout works only in the main thread. Here the
+prefixes of the links are found with simple regular expressions which can't
+backtrack, and the rest of every link is read once, run by run.
+It is installed into the relay salmon lib.
+"""
+
+import re
+import string
+
+# [a-z] of a case-insensitive pattern also matches these four
+LETTERS = frozenset(string.ascii_letters + "\u0130\u0131\u017f\u212a")
+DOMAIN = LETTERS | frozenset(string.digits + ".-")
+# characters a link doesn't end with, unless it's a closing parenthesis of a group
+TRAILING = frozenset("`!()[]{};:'\".,<>?\xab\xbb\u201c\u201d\u2018\u2019")
+# characters which can't be in a link outside of the parentheses
+BREAKS = frozenset("()<>")
+_trailing = "".join(TRAILING)
+
+# prefixes of the links, the domain names only from the dot on
+_scheme = re.compile(r"(?i)\b(?:https?://|www\d{0,3}[.])")
+_domain = re.compile(r"(?i)[.][a-z]{2,4}/")
+# characters which aren't whitespace or one of ()<>, and a group in parentheses
+_run = re.compile(r"[^\s()<>]*")
+_group = re.compile(r"\((?:[^\s()<>]|\([^\s()<>]+\))*\)")
+
+
+def find_links(text):
+    """Finds the links in the text.
+
+    Args:
+        text (str): text/plain or text/html from the email.
+
+    Returns:
+        list: Every link once, in the order they first appear in the text.
+    """
+    return list(dict.fromkeys(text[start:end] for start, end in _Tokenizer(text).spans()))
+
+
+def remove_links(text):
+    """Removes every link from the text, like re.sub of the URL regular
+    expression with an empty string did.
+
+    Args:
+        text (str): text/plain or text/html from the email.
+
+    Returns:
+        str: The text without the links.
+    """
+    pieces = []
+    pos = 0
+    for start, end in _Tokenizer(text).spans():
+        pieces.append(text[pos:start])
+        pos = end
+    pieces.append(text[pos:])
+    return "".join(pieces)
+
+
+def _is_word(char):
+    return char.isalnum() or char == "_"
+
+
+class _Tokenizer(object):
+    """Links of one text.
+
+    A link is a prefix (http://, https://, www., www1. ... www999. or a
+    domain name followed by a slash) and at least two units, a unit is a
+    character which isn't whitespace or one of ()<>, or a group in
+    parentheses with at most one level of nested groups. The link ends with
+    the last unit which is a group or a character not in TRAILING. Where
+    links overlap, the one starting first wins.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        # start of a domain name -> end of its slash
+        self.domain_ends = {}
+        # position -> end of the last unit from it a link may end with
+        self.last_ends = {}
+
+    def spans(self):
+        """Yields (start, end) of every link in the text, in order."""
+        pos = 0
+        for start in self.starts():
+            if start < pos:
+                continue
+            end = self.link_end(start)
+            if end is not None:
+                yield start, end
+                pos = end
+
+    def starts(self):
+        """Returns the sorted positions where a link may start."""
+        text = self.text
+        starts = set(match.start() for match in _scheme.finditer(text))
+        for match in _domain.finditer(text):
+            dot = match.start()
+            pos = dot
+            while pos > 0 and text[pos - 1] in DOMAIN:
+                pos -= 1
+            # the first word boundary of the DOMAIN characters, the domain name
+            # prefix from a later one has the same end and the same units after it
+            while pos < dot and not self.boundary(pos):
+                pos += 1
+            if pos < dot:
+                starts.add(pos)
+                self.domain_ends[pos] = match.end()
+        return sorted(starts)
+
+    def boundary(self, pos):
+        text = self.text
+        if pos == 0:
+            return _is_word(text[pos])
+        return _is_word(text[pos - 1]) != _is_word(text[pos])
+
+    def link_end(self, pos):
+        """Returns the end of the link starting at pos, None if no link starts there."""
+        for prefix_end in (self.scheme_end(pos), self.www_end(pos), self.domain_end(pos)):
+            if prefix_end is None:
+                continue
+            end = self.last_end(prefix_end)
+            # the first unit alone isn't a link
+            if end is not None and end != self.unit_end(prefix_end):
+                return end
+        return None
+
+    def scheme_end(self, pos):
+        text = self.text
+        if text[pos:pos + 4].lower() != "http":
+            return None
+        pos += 4
+        if text[pos:pos + 1] in ("s", "S", "\u017f"):
+            pos += 1
+        if text[pos:pos + 3] != "://":
+            return None
+        return pos + 3
+
+    def www_end(self, pos):
+        text = self.text
+        if text[pos:pos + 3].lower() != "www":
+            return None
+        pos += 3
+        for i in range(4):
+            if text[pos:pos + 1] == ".":
+                return pos + 1
+            if i == 3 or not text[pos:pos + 1].isdecimal():
+                return None
+            pos += 1
+
+    def domain_end(self, pos):
+        # starts() found the DOMAIN characters ending with a dot, two to four letters and a slash
+        return self.domain_ends.get(pos)
+
+    def unit_end(self, pos):
+        """Returns the end of the unit at pos, None if there's no unit."""
+        text = self.text
+        if pos >= len(text):
+            return None
+        char = text[pos]
+        if char == "(":
+            group = _group.match(text, pos)
+            return group.end() if group else None
+        if char in BREAKS or char.isspace():
+            return None
+        return pos + 1
+
+    def last_end(self, pos):
+        """Returns the end of the last unit from pos on a link may end with."""
+        if pos in self.last_ends:
+            return self.last_ends[pos]
+        text = self.text
+        start = pos
+        last = None
+        while True:
+            end = _run.match(text, pos).end()
+            good = len(text[pos:end].rstrip(_trailing))
+            if good:
+                last = pos + good
+            group = _group.match(text, end)
+            if group is None:
+                break
+            last = pos = group.end()
+        self.last_ends[start] = last
+        return last
@@ -0,0 +1,143 @@
+"""salmonvectors module.
+
+This module computes the document vectors of the emails for the similarity
+check with analyze_text set. The body_plain, body_html and subject of every
+email are run through the NLP model once, when the email is parsed, and
+salmondb stores their vectors with the email fields. The vectors are
+normalized, so the cosine similarity of the current email and all the
+candidates from the similarity check is one matrix product, the same value
+as Doc.similarity of spaCy. salmondb keeps the vectors it read in a
+VectorCache, one NumPy matrix in memory.
+It is installed into the relay salmon lib.
+"""
+
+import numpy
+
+# the fields compared, in the order of the rows of the vectors of an email
+FIELDS = ("body_plain", "body_html", "subject")
+# a field is similar when the cosine similarity of the vectors is over this
+THRESHOLD = 0.75
+# number of email fields in the cache before it starts over, 100000 are about 115 MB with en_core_web_sm
+CACHE_ROWS = 100000
+
+
+def get_doc_vectors(nlp, subject, body_plain, body_html):
+    """Computes the normalized document vectors of an email.
+
+    Args:
+        nlp (Language): Loaded spaCy model.
+        subject (str): Subject of the email.
+        body_plain (str): text/plain of the email.
+        body_html (str): Visible text of text/html of the email, see salmonhtml.
+
+    Returns:
+        numpy.ndarray: One float32 row per field in FIELDS, zeros for an empty
+            field, None when all of them are empty.
+    """
+    texts = get_texts(subject, body_plain, body_html)
+    docs = iter(nlp.pipe(text for text in texts if text))
+    return get_vectors([next(docs) if text else None for text in texts])
+
+
+def get_texts(subject, body_plain, body_html):
+    """Returns the texts of the fields of an email in the order of FIELDS."""
+    texts = {"body_plain": body_plain, "body_html": body_html, "subject": subject}
+    return [texts[field] for field in FIELDS]
+
+
+def get_vectors(docs):
+    """Returns the normalized vectors of the documents of the fields of an
+    email, see get_doc_vectors.
+
+    Args:
+        docs (list): Doc of every field in the order of FIELDS, None for an empty field.
+
+    Returns:
+        numpy.ndarray: The vectors, None when all of the fields are empty.
+    """
+    width = next((doc.vector.shape[0] for doc in docs if doc is not None), None)
+    if width is None:
+        return None
+    vectors = numpy.zeros((len(FIELDS), width), dtype=numpy.float32)
+    for row, doc in enumerate(docs):
+        if doc is not None:
+            vector = doc.vector
+            norm = numpy.linalg.norm(vector)
+            # a document without a vector isn't similar to anything, like in Doc.similarity
+            if norm > 0:
+                vectors[row] = vector / norm
+    return vectors
+
+
+def get_similarities(vectors, matrix):
+    """Computes the cosine similarity of every field of an email with the
+    same field of the candidates.
+
+    Args:
+        vectors (numpy.ndarray): Vectors of the email from get_doc_vectors.
+        matrix (numpy.ndarray): Vectors of the candidates, shape (candidates, fields, width).
+
+    Returns:
+        numpy.ndarray: Shape (candidates, fields), 0 where a field of either email is empty.
+    """
+    return numpy.einsum("fw,cfw->cf", vectors, matrix)
+
+
+def to_bytes(vectors):
+    """Returns the vectors as stored in the database."""
+    return vectors.tobytes()
+
+
+def from_bytes(data):
+    """Returns the vectors stored in the database."""
+    return numpy.frombuffer(data, dtype=numpy.float32).reshape(len(FIELDS), -1)
+
+
+class VectorCache(object):
+    """Document vectors of email fields in one matrix, the rows are looked up by the id of the email fields.
+
+    Attributes:
+        max_rows (int): Number of rows after which the cache is cleared.
+        rows (dict): Id of email fields -> its row in the matrix.
+        matrix (numpy.ndarray): Vectors, shape (rows, fields, width), None before the first ones.
+        size (int): Number of the used rows, including the discarded ones.
+    """
+
+    def __init__(self, max_rows=CACHE_ROWS):
+        self.max_rows = max_rows
+        self.clear()
+
+    def clear(self):
+        self.rows = {}
+        self.matrix = None
+        self.size = 0
+
+    def get(self, ids):
+        """Returns the ids of the cached email fields (list) and their vectors (numpy.ndarray)."""
+        found = [mail_fields_id for mail_fields_id in ids if mail_fields_id in self.rows]
+        if not found:
+            return found, None
+        return found, self.matrix[[self.rows[mail_fields_id] for mail_fields_id in found]]
+
+    def add(self, mail_fields_id, vectors):
+        """Caches the vectors of email fields, vectors of another width (another model) start it over."""
+        if self.matrix is not None and self.matrix.shape[1:] != vectors.shape:
+            self.clear()
+        if mail_fields_id in self.rows:
+            self.matrix[self.rows[mail_fields_id]] = vectors
+            return
+        if self.size == self.max_rows:
+            self.clear()
+        if self.matrix is None or self.size == len(self.matrix):
+            # the matrix grows twice at a time, so adding a row is a copy only now and then
+            matrix = numpy.zeros((min(max(self.size * 2, 1024), self.max_rows),) + vectors.shape, dtype=numpy.float32)
+            if self.matrix is not None:
+                matrix[:self.size] = self.matrix[:self.size]
+            self.matrix = matrix
+        self.matrix[self.size] = vectors
+        self.rows[mail_fields_id] = self.size
+        self.size += 1
+
+    def discard(self, mail_fields_id):
+        """Forgets the vectors of email fields, SQLite may give their id to other ones."""
+        self.rows.pop(mail_fields_id, None)
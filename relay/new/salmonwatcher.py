@@ -0,0 +1,102 @@
+"""salmonwatcher module.
+
+This module tells the queue consumers which messages arrived in new/ of a
+Maildir queue. It waits for inotify events instead of listing the directory
+over and over, so a message is picked up milliseconds after the receiver
+renamed it into new/ and an idle sensor does no directory scans. The whole
+queue is still listed after `rescan` seconds without any event and after an
+inotify queue overflow, so no message is missed. Without the inotify package
+it falls back to sleeping and listing the queue. An SQLite queue (see
+salmonsqlqueue) is listed whenever a commit wrote into its database.
+It is installed into both the receiver and the relay salmon lib.
+"""
+
+import logging
+import os
+import time
+
+try:
+    import inotify.adapters
+    import inotify.constants
+except ImportError:
+    inotify = None
+
+
+class QueueWatcher(object):
+    """Waits for new messages in a salmon queue.Queue.
+
+    Attributes:
+        queue (Queue): Watched queue, its keys() is used for the rescans.
+        rescan (float): Seconds without any event after which the whole queue
+            is listed again.
+        sleep (float): Seconds between the listings without inotify.
+    """
+
+    def __init__(self, queue, rescan=60, sleep=2):
+        self.queue = queue
+        self.rescan = rescan
+        self.sleep = sleep
+        # new/ or all its shards, see salmonqueueindex
+        self.new_dirs = queue.new_dirs()
+        store = getattr(queue, "store", None)
+        self.database = None if store is None else os.path.basename(store.path)
+        self._inotify = None
+        self._events = None
+        self._recheck = False
+        if inotify is None:
+            logging.info("[+] (salmonwatcher.py) - inotify is not installed, polling %s.", queue.dir)
+            return
+        self._inotify = inotify.adapters.Inotify(block_duration_s=1)
+        if self.database is not None:
+            # commits are written into the WAL file next to the database
+            self._inotify.add_watch(queue.dir, mask=inotify.constants.IN_MODIFY)
+        else:
+            # Maildir writers rename into new/, anything else closes the file there
+            for new_dir in self.new_dirs:
+                self._inotify.add_watch(
+                    new_dir, mask=inotify.constants.IN_MOVED_TO | inotify.constants.IN_CLOSE_WRITE
+                )
+        self._events = self._inotify.event_gen(yield_nones=True)
+
+    def keys(self):
+        """Blocks until there is something to process.
+
+        Returns:
+            list: Keys of the messages which arrived since the last call, or
+                all keys of the queue after a rescan.
+        """
+        if self._inotify is None:
+            time.sleep(self.sleep)
+            return self.queue.keys()
+
+        if self._recheck:
+            self._recheck = False
+            time.sleep(0.01)
+            return self.queue.keys()
+
+        deadline = time.time() + self.rescan
+        keys = []
+        changed = False
+        while True:
+            try:
+                event = next(self._events)
+            except inotify.adapters.TerminalEventException as error:
+                logging.warning("[+] (salmonwatcher.py) - %s on %s, listing the queue.", error, self.queue.dir)
+                self._events = self._inotify.event_gen(yield_nones=True)
+                return self.queue.keys()
+            if event is not None:
+                if self.database is None:
+                    # Maildir keys are the file names without the :2,<flags> info
+                    keys.append(event[3].split(":")[0])
+                elif event[3].startswith(self.database):
+                    changed = True
+            elif changed:
+                # the commit may still be finishing when its WAL write is
+                # reported, the queue is listed once more on the next call
+                self._recheck = True
+                return self.queue.keys()
+            elif keys:
+                # one poll of the inotify descriptor is done
+                return list(dict.fromkeys(keys))
+            elif time.time() >= deadline:
+                return self.queue.keys()
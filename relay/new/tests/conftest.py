@@ -0,0 +1,4 @@
+from salmon import salmondb
+
+# the relay creates the tables at its start (settings.py), the tests in their in-memory database
+salmondb.init()
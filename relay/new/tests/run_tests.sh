@@ -3,5 +3,19 @@ export SALMON_SETTINGS_MODULE="tests.testing_settings"
 pytest test_models.py -v --disable-pytest-warnings
 pytest test_mailparser.py -v --disable-pytest-warnings
 pytest test_conclude.py -v --disable-pytest-warnings
+pytest test_headers.py -v --disable-pytest-warnings
+pytest test_queueindex.py -v --disable-pytest-warnings
+pytest test_sqlqueue.py -v --disable-pytest-warnings
+pytest test_pipeline.py -v --disable-pytest-warnings
+pytest test_overload.py -v --disable-pytest-warnings
+pytest test_delivery.py -v --disable-pytest-warnings
+pytest test_fastpath.py -v --disable-pytest-warnings
+pytest test_urls.py -v --disable-pytest-warnings
+pytest test_html.py -v --disable-pytest-warnings
+pytest test_ssdeepindex.py -v --disable-pytest-warnings
+pytest test_minhash.py -v --disable-pytest-warnings
+pytest test_vectors.py -v --disable-pytest-warnings
+pytest test_nlp.py -v --disable-pytest-warnings
+pytest test_startup.py -v --disable-pytest-warnings
 unset SALMON_SETTINGS_MODULE
 deactivate
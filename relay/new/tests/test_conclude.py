@@ -118,6 +118,34 @@ class TestSalmonConclude(SalmonTestCase):
         )
         assert rating == 55
 
+    def test_rating_55_html(self):
+        """Test email with the username in the text of body_html, the raw html is stored"""
+        push_into_db(Settings(username="gamarfo", password="changeme"))
+        html = "<p>Dear g<b>amarfo</b>,</p>"
+        self.mail_fields_dict5 = {
+            "text": "",
+            "html": html,
+            "html_text": "Dear gamarfo,",
+            "subject": "Invoice",
+            "from": "susan@example.com",
+            "from_name": "",
+            "to": [("john@example.com", "")],
+            "date": 1587298372.484211,
+            "attachmentFileName": [],
+            "links": [],
+        }
+        self.mail_fields_dict5["len"] = (
+            len(self.mail_fields_dict5["html"])
+            + len(self.mail_fields_dict5["subject"])
+            + len(self.mail_fields_dict5["text"])
+        )
+        self.mail_fields_dict5["ssdeep"] = get_fuzzy_hash(self.mail_fields_dict5)
+        rating = conclude(
+            self.mail_fields_dict5, self.fake_eml_file, self.fake_mail_request
+        )
+        assert rating == 55
+        assert [row.body_html for row in db.session.query(MailFields)] == [html]
+
     def test_rating_30(self, f_settings, f_mail_fields_dict):
         """Test email with the username in body_plain, body_plain is very long"""
         push_into_db(self.settings1)
@@ -0,0 +1,80 @@
+import smtplib
+
+from salmon import queue, salmondelivery
+from salmon.mail import MailRequest
+from salmon.routing import Router
+from salmon.salmondelivery import DeliveryService
+from salmon.server import Relay
+
+
+class FakeConnection(object):
+    def __init__(self, replies):
+        self.replies = replies
+        self.sent = []
+        self.closed = False
+
+    def sendmail(self, sender, recipients, data):
+        if self.replies:
+            reply = self.replies.pop(0)
+            if reply is not None:
+                raise reply
+        self.sent.append((sender, recipients))
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRelay(Relay):
+    def __init__(self, *replies):
+        Relay.__init__(self, host="127.0.0.1", port=2500)
+        self.replies = list(replies)
+        self.connections = []
+
+    def configure_relay(self, hostname):
+        self.connections.append(FakeConnection(self.replies))
+        return self.connections[-1]
+
+
+def message():
+    return MailRequest("peer", "from@example.com", "to@example.com", "Subject: delivery\n\nx")
+
+
+class TestSalmonDelivery(object):
+    def test_connection_reused(self):
+        relay = FakeRelay()
+        delivery = DeliveryService(relay)
+        assert delivery.submit(message())
+        assert delivery.submit(message())
+        assert len(relay.connections) == 1
+        assert relay.connections[0].sent == [("from@example.com", ["to@example.com"])] * 2
+        delivery.close()
+        assert relay.connections[0].closed
+        assert delivery.delivered == 2
+
+    def test_retry(self):
+        relay = FakeRelay(smtplib.SMTPServerDisconnected("gone"), smtplib.SMTPDataError(451, b"later"))
+        delivery = DeliveryService(relay, retries=2, retry_delay=0)
+        assert delivery.submit(message())
+        # every failure drops the connection
+        assert len(relay.connections) == 3
+        assert delivery.retried == 2
+        assert delivery.delivered == 1
+
+    def test_failed(self, tmp_path, monkeypatch):
+        undeliverable = queue.Queue(str(tmp_path / "undeliverable"))
+        monkeypatch.setattr(Router, "UNDELIVERABLE_QUEUE", undeliverable)
+        relay = FakeRelay(smtplib.SMTPDataError(550, b"no"))
+        delivery = DeliveryService(relay, retries=2, retry_delay=0)
+        assert not delivery.submit(message())
+        assert delivery.retried == 0
+        assert delivery.failed == 1
+        assert len(undeliverable) == 1
+
+    def test_transient(self):
+        assert salmondelivery.transient(ConnectionRefusedError())
+        assert salmondelivery.transient(smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"busy")}))
+        assert not salmondelivery.transient(smtplib.SMTPRecipientsRefused({"a@example.com": (550, b"no")}))
+        assert not salmondelivery.transient(smtplib.SMTPNotSupportedError())
@@ -0,0 +1,52 @@
+from salmon import salmonfastpath
+from salmon.mail import MailRequest
+from salmon.salmonfastpath import FastPath
+from salmon.queue import SQLiteQueue
+
+
+def message(subject):
+    msg = MailRequest("peer", "from@example.com", "to@example.com", "Subject: %s\n\nx" % subject)
+    msg.metadata = {"peer": "1.2.3.4", "recipients": ["to@example.com"]}
+    return msg
+
+
+class TestSalmonFastPath(object):
+    def test_accept(self, tmp_path):
+        fastpath = FastPath(journal_dir=str(tmp_path), queue_size=2)
+        fastpath.journal = SQLiteQueue(str(tmp_path))
+        assert fastpath.accept(message("one")) is None
+        assert fastpath.accept(message("two")) is None
+        # the relay is behind, the sender tries again later
+        assert fastpath.accept(message("three")) == salmonfastpath.FULL_REPLY
+        assert fastpath.deferred == 1
+        assert len(fastpath.journal) == 2
+
+        key, msg = fastpath.handoff.get_nowait()
+        assert msg["subject"] == "one"
+        assert fastpath.journal.get(key).metadata == {"peer": "1.2.3.4", "recipients": ["to@example.com"]}
+        fastpath.complete(key)
+        assert len(fastpath.journal) == 1
+
+    def test_without_journal(self):
+        fastpath = FastPath(queue_size=2)
+        assert fastpath.accept(message("one")) is None
+        assert fastpath.accept(message("two")) is None
+        first, second = fastpath.handoff.get_nowait()[0], fastpath.handoff.get_nowait()[0]
+        assert first != second
+        fastpath.complete(first)
+
+    def test_fail(self, tmp_path, monkeypatch):
+        moved = []
+        monkeypatch.setattr(salmonfastpath.salmonmailparser, "move_to_undeliverable", lambda key, msg: moved.append(key))
+        monkeypatch.setattr(salmonfastpath, "RETRY_DELAY", 0)
+        processed = []
+        fastpath = FastPath(journal_dir=str(tmp_path), attempts=2)
+        fastpath.journal = SQLiteQueue(str(tmp_path))
+        monkeypatch.setattr(fastpath, "process", lambda key, msg: processed.append(key))
+        key = fastpath.journal.push(message("one"))
+        fastpath.fail(key, message("one"))
+        fastpath.retry()
+        assert processed == [key] and not moved
+        # the second failure is the last one
+        fastpath.fail(key, message("one"))
+        assert moved == [key] and len(fastpath.journal) == 0 and not fastpath.failures
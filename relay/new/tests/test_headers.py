@@ -0,0 +1,82 @@
+from salmon import salmonheaders
+from salmon.salmonheaders import HeaderIndex
+from salmon.mail import MailRequest
+
+
+class TestSalmonHeaders(object):
+    eml = (
+        b"Received: from a\n"
+        b"    by b\n"
+        b"To: Victim <victim@example.com>, other@example.com\n"
+        b"Subject: hello\n"
+        b"\n"
+        b"To: not-a-header@example.com\n"
+    )
+
+    def test_index(self):
+        index = HeaderIndex(self.eml)
+        assert sorted(index.headers) == ["received", "subject", "to"]
+        assert index.get("received") == b"from a by b"
+        assert index.get("TO") == b"Victim <victim@example.com>, other@example.com"
+        assert index.get_all("to") == [index.get("to")]
+        assert self.eml[index.end:] == b"\nTo: not-a-header@example.com\n"
+        assert "date" not in index
+
+    def test_set_header(self):
+        data = HeaderIndex(self.eml).set_header("Bcc", "a@example.com,b@example.com")
+        assert data.endswith(b"Subject: hello\nBcc: a@example.com,b@example.com\n\nTo: not-a-header@example.com\n")
+        data = HeaderIndex(data).set_header("Bcc", "b@example.com")
+        assert data.count(b"Bcc:") == 1
+        assert b"Bcc: b@example.com\n\n" in data
+
+    def test_set_header_crlf(self):
+        data = HeaderIndex(b"To: a@example.com\r\n\r\nbody").set_header("Bcc", "b@example.com")
+        assert data == b"To: a@example.com\r\nBcc: b@example.com\r\n\r\nbody"
+
+    def test_investigate_bcc(self):
+        data = salmonheaders.investigate_bcc(["VICTIM@example.com", "hidden@example.com"], self.eml)
+        assert b"Subject: hello\nBcc: hidden@example.com\n\n" in data
+        assert salmonheaders.investigate_bcc(["other@example.com"], self.eml) == self.eml
+
+    def test_get_bcc_without_date(self):
+        mail_request = MailRequest("", None, None, b"To: a@example.com\nBcc: b@example.com, c@example.com\n\nbody")
+        assert mail_request.get_bcc() == ["b@example.com", "c@example.com"]
+        mail_request.Data = b"To: a@example.com\n\nbody"
+        assert mail_request.get_bcc() == []
+
+    def test_remove_header(self):
+        data = b"To: a@example.com\nBcc: b@example.com,\n    c@example.com\nSubject: x\nBcc: d@example.com\n\nBcc: body"
+        assert HeaderIndex(data).remove_header("BCC") == b"To: a@example.com\nSubject: x\n\nBcc: body"
+        assert HeaderIndex(self.eml).remove_header("Bcc") == self.eml
+
+    def test_get_header_recipients(self):
+        mail_request = MailRequest(
+            "", None, None, b"To: Victim <Victim@Example.com>, b@example.com\nCc: c@example.com\n\nbody"
+        )
+        assert mail_request.get_header_recipients() == ["victim@example.com", "b@example.com", "c@example.com"]
+
+    def test_message_parsed_once(self):
+        mail_request = MailRequest("", None, None, self.eml)
+        assert mail_request._message is None
+        assert mail_request.To == "Victim <victim@example.com>, other@example.com"
+        assert mail_request.From is None
+        message = mail_request.message
+        assert message["subject"] == "hello"
+        assert mail_request.message is message
+        mail_request.Data = self.eml.replace(b"hello", b"bye")
+        assert mail_request.message["subject"] == "bye"
+
+    def test_base_adds_envelope(self):
+        mail_request = MailRequest("", "from@example.com", None, self.eml)
+        assert mail_request.base["from"] == "from@example.com"
+        assert mail_request["to"] == "Victim <victim@example.com>, other@example.com"
+        assert "from" not in mail_request.message
+
+    def test_rewrite(self):
+        mail_request = MailRequest("", None, None, self.eml)
+        assert mail_request.message["subject"] == "hello"
+        mail_request.rewrite({b"example.com": b"exbmple.com", b"other@example.com": b"x@y.com", b"": b"!"})
+        assert mail_request.Data.count(b"exbmple.com") == 2
+        assert b"x@y.com" in mail_request.Data
+        assert mail_request.message["to"] == "Victim <victim@exbmple.com>, x@y.com"
+        assert mail_request.header_index.get("to") == b"Victim <victim@exbmple.com>, x@y.com"
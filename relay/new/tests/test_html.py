@@ -0,0 +1,40 @@
+from salmon.salmonhtml import HtmlExtractor, extract, visible_text
+
+
+class TestSalmonHtml(object):
+    def test_text(self):
+        text, urls = extract(
+            "<html><head><title>Invoice</title><style>p {color: red}</style></head>"
+            "<body><div>&nbsp; Dear&nbsp;customer,</div><p>your <b>Pay</b>Pal\n  account</p>"
+            "<script>var p = '<p>hidden</p>';</script><!-- comment --><br>Thanks</body></html>"
+        )
+        assert text == "Dear customer,\nyour PayPal account\nThanks"
+        assert urls == []
+
+    def test_urls(self):
+        text, urls = extract(
+            '<a href="http://a.com/?x=1&amp;y=2">click</a> <img src=" https://b.com/i.png ">'
+            '<a href>empty</a> <a name="top">top</a>'
+        )
+        assert text == "click empty top"
+        assert urls == ["http://a.com/?x=1&y=2", "https://b.com/i.png"]
+
+    def test_unclosed_head(self):
+        text, urls = extract("<html><head><title>Title<body><p>Hello</p>")
+        assert text == "Hello"
+
+    def test_streaming(self):
+        body = '<p>Hello <a href="http://a.com/x">wor</a>ld</p><ul><li>one<li>two</ul>'
+        for size in (1, 3, 7):
+            extractor = HtmlExtractor()
+            for i in range(0, len(body), size):
+                extractor.feed(body[i:i + size])
+            extractor.close()
+            assert (extractor.text(), extractor.urls) == extract(body)
+        assert extract(body) == ("Hello world\none\ntwo", ["http://a.com/x"])
+
+    def test_visible_text(self):
+        assert visible_text('<p>Hello <a href="http://a.com/x">world</a></p>') == "Hello world"
+        assert visible_text('<img src="http://a.com/i.png">') == ""
+        assert visible_text("") == ""
+        assert visible_text(None) is None
@@ -116,6 +116,21 @@ class TestSalmonMailParser(SalmonTestCase):
         assert len(mail_fields["links"]) > 0
         assert mail_fields["links"][0] == "www.test.cz"
 
+    def test_html_text_in_eml(self):
+        mail_request = MailRequest(
+            self.eml_file3, None, None, self.eml_content(self.eml_file3)
+        )
+        mail_fields = process_email(self.eml_file3, mail_request)
+        assert mail_fields["html_text"] == "Gamarfo\nwww.test.cz\nSusan"
+        assert mail_fields["html"].startswith("<html><head>")
+
+    def test_fuzzy_hash_of_image_only_html(self):
+        fields = {"subject": "Offer", "from": "a@example.com", "text": ""}
+        first = dict(fields, html='<html><body><img src="http://a.example.com/1.png"></body></html>', html_text="")
+        second = dict(fields, html='<html><body><img src="http://b.example.com/2.gif"></body></html>', html_text="")
+        # hashed from the markup, not from the subject alone
+        assert get_fuzzy_hash(first) != get_fuzzy_hash(second)
+
     def test_eml_with_inline(self):
         mail_request = MailRequest(
             self.eml_file4, None, None, self.eml_content(self.eml_file4)
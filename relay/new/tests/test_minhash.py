@@ -0,0 +1,101 @@
+import random
+
+import numpy
+
+from salmon.salmonconclude import Spam
+from salmon.salmonconclude import get_similar_emails_ids
+from salmon.salmonconclude import similarity_counts
+from salmon import salmondb
+from salmon import salmonminhash
+from salmon import utils
+from salmon.salmondb import MailFields
+from salmon.salmondb import MinHashBand
+from salmon.salmondb import MinHashSignature
+from salmon.salmondb import get_similar_by_minhash
+from salmon.salmondb import index_minhash_signatures
+from salmon.salmondb import push_into_db
+
+WORDS = ["word%d" % i for i in range(1000)]
+
+
+def shingles(text):
+    words = text.lower().split()
+    return set(" ".join(words[i:i + 3]) for i in range(len(words) - 2))
+
+
+def jaccard(text, other):
+    return len(shingles(text) & shingles(other)) / len(shingles(text) | shingles(other))
+
+
+def change(generator, text, share):
+    words = text.split()
+    for i in range(int(len(words) * share)):
+        words[generator.randrange(len(words))] = generator.choice(WORDS)
+    return " ".join(words)
+
+
+class TestSalmonMinHash(object):
+    @classmethod
+    def setup_class(cls):
+        utils.import_settings(True, boot_module="tests.testing_boot")
+        generator = random.Random(22)
+        cls.texts = []
+        for i in range(40):
+            template = " ".join(generator.choice(WORDS) for j in range(generator.randint(50, 300)))
+            cls.texts.append(template)
+            cls.texts.append(change(generator, template, 0.02))
+        cls.ids = []
+        for text in cls.texts:
+            mail_fields = MailFields("0", "3:abc:def", 0, False, body_plain=text)
+            mail_fields.minhash = salmonminhash.get_signature("", text, "")
+            push_into_db(mail_fields)
+            cls.ids.append(mail_fields.id)
+
+    def test_signature(self):
+        signature = salmonminhash.get_signature("Hello", "Your account, your password!", "")
+        assert signature.dtype == numpy.uint32 and len(signature) == salmonminhash.NUM_PERM
+        assert numpy.array_equal(signature, salmonminhash.get_signature("HELLO", "", "your account your password"))
+        assert numpy.array_equal(salmonminhash.from_bytes(salmonminhash.to_bytes(signature)), signature)
+        assert salmonminhash.get_signature("", "", "<>") is None
+        assert len(salmonminhash.get_bands(signature)) == salmonminhash.BANDS
+
+    def test_similarity(self):
+        generator = random.Random(1)
+        for i in range(20):
+            text = " ".join(generator.choice(WORDS) for j in range(300))
+            other = change(generator, text, generator.random() / 3)
+            estimate = salmonminhash.similarity(
+                salmonminhash.get_signature("", text, ""), salmonminhash.get_signature("", other, "")
+            )
+            assert abs(estimate - jaccard(text, other)) < 0.15
+
+    def test_lookup(self):
+        for i, text in enumerate(self.texts):
+            found = get_similar_by_minhash(salmonminhash.get_signature("", text, ""), 0.5)
+            # the email itself and its near duplicate, not the other templates
+            assert sorted(found) == sorted(self.ids[i - i % 2:i - i % 2 + 2])
+        assert get_similar_by_minhash(None, 0.5) == []
+
+    def test_index_minhash_signatures(self):
+        salmondb.session.query(MinHashBand).delete()
+        salmondb.session.query(MinHashSignature).delete()
+        salmondb.session.commit()
+        assert get_similar_by_minhash(salmonminhash.get_signature("", self.texts[0], ""), 0.5) == []
+        index_minhash_signatures()
+        assert salmondb.session.query(MinHashSignature).count() == len(self.texts)
+        assert sorted(get_similar_by_minhash(salmonminhash.get_signature("", self.texts[0], ""), 0.5)) == self.ids[:2]
+
+    def test_backends(self):
+        spam = Spam(subject="", email_date="0", ssdeep="3:abc:def", length=0, attachment=False)
+        signature = salmonminhash.get_signature("", self.texts[2], "")
+        relay_config = utils.settings.data["relay"]
+        try:
+            relay_config["similarity"] = "minhash"
+            assert sorted(get_similar_emails_ids(spam, signature)) == self.ids[2:4]
+            relay_config["similarity"] = "both"
+            similarity_counts.clear()
+            ssdeep_ids = get_similar_emails_ids(spam, signature)
+            assert ssdeep_ids == spam.get_ids_for_similarity_check()
+            assert similarity_counts == {"ssdeep": len(ssdeep_ids), "minhash": 2, "both": 2}
+        finally:
+            relay_config.pop("similarity")
@@ -0,0 +1,92 @@
+import concurrent.futures
+import os
+
+import numpy
+import spacy
+
+from salmon import salmonconclude
+from salmon import salmonmailparser
+from salmon import salmonnlp
+from salmon import salmonpipeline
+from salmon import utils
+from salmon.salmonnlp import NlpService
+from salmon.salmonpipeline import RelayPipeline
+
+
+class Message(object):
+    def __init__(self, data):
+        self.Data = data
+
+
+class TestSalmonNlp(object):
+    @classmethod
+    def setup_class(cls):
+        utils.import_settings(True, boot_module="tests.testing_boot")
+        cls.names = sorted(os.listdir("./rawspams"))[:8]
+        cls.data = []
+        for name in cls.names:
+            with open("./rawspams/{}".format(name), "rb") as f:
+                cls.data.append(f.read())
+
+    def get_service(self, tmp_path, **kwargs):
+        # a model with a tok2vec layer and a parser like en_core_web_sm, without downloading one
+        nlp = spacy.blank("en")
+        nlp.add_pipe("tok2vec")
+        nlp.add_pipe("parser")
+        nlp.initialize()
+        nlp.to_disk(tmp_path / "model")
+        return NlpService(str(tmp_path / "model"), **kwargs)
+
+    def test_truncate(self):
+        assert salmonnlp.truncate("short text", 20) == "short text"
+        assert salmonnlp.truncate("some words and more words", 17) == "some words and"
+        assert salmonnlp.truncate("x" * 30, 10) == "x" * 10
+        assert salmonnlp.truncate("x" * 30, 0) == "x" * 30
+
+    def test_service(self, tmp_path):
+        service = self.get_service(tmp_path, max_chars=10)
+        assert service.nlp.pipe_names == ["tok2vec"]
+        assert service("some words and more words").text == "some words"
+        assert [doc.text for doc in service.pipe(["a b", "c " * 20])] == ["a b", "c c c c c"]
+
+    def test_analyze_texts(self, tmp_path):
+        service = self.get_service(tmp_path)
+        mail_fields_list = [salmonmailparser.parse_email(name, data) for name, data in zip(self.names, self.data)]
+        nlp = utils.settings.nlp if hasattr(utils.settings, "nlp") else None
+        utils.settings.nlp = service
+        try:
+            salmonconclude.analyze_texts(mail_fields_list)
+            # the same as one email and one text at a time
+            for mail_fields in mail_fields_list:
+                assert mail_fields["text_features"] == salmonconclude.get_text_features(mail_fields)
+                vectors = salmonconclude.get_doc_vectors(mail_fields)
+                assert numpy.allclose(mail_fields["doc_vectors"], vectors, atol=1e-5)
+        finally:
+            utils.settings.nlp = nlp
+
+    def test_batches(self):
+        pipeline = RelayPipeline(batch_size=3)
+        pipeline.pool = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            for name, data in zip(self.names[:2], self.data):
+                pipeline.submit(name, Message(data))
+            # waiting for a full batch
+            assert pipeline.conclude.queue.qsize() == 0 and pipeline.pending == 2
+            pipeline.submit(self.names[2], Message(self.data[2]))
+            pipeline.submit(self.names[3], Message(self.data[3]))
+            pipeline.flush()
+            items = [pipeline.conclude.queue.get_nowait() for i in range(4)]
+            assert [item[0] for item in items] == self.names[:4]
+            assert items[0][4] is items[2][4] and items[3][4] is not items[2][4]
+            for key, mail_request, degraded, pool, future, index in items:
+                mail_fields, busy = pipeline._parsed(key, mail_request, degraded, pool, future, index)
+                assert mail_fields["ssdeep"] == salmonmailparser.parse_email(key, mail_request.Data)["ssdeep"]
+        finally:
+            pipeline.pool.shutdown()
+
+    def test_parse(self):
+        messages = [(name, data, False) for name, data in zip(self.names, self.data)]
+        results = salmonpipeline.parse(messages)
+        assert len(results) == len(messages)
+        for (mail_fields, busy), (name, data, degraded) in zip(results, messages):
+            assert mail_fields["ssdeep"] == salmonmailparser.parse_email(name, data)["ssdeep"] and busy >= 0
@@ -0,0 +1,26 @@
+from salmon import salmonqueueindex
+from salmon.salmonoverload import Overload
+
+
+class TestSalmonOverload(object):
+    def test_watermarks(self):
+        overload = Overload(depth=100, age=600)
+        assert not overload.check(99, 0)
+        assert overload.check(100, 0)
+        # it stays overloaded down to half of the watermarks
+        assert overload.check(50, 299)
+        assert not overload.check(49, 299)
+        assert not overload.check(99, 599)
+        assert overload.check(0, 600)
+        assert not overload.check(0, 0)
+        assert overload.total == 3
+        assert overload.degraded == 1
+
+    def test_disabled(self):
+        overload = Overload()
+        assert not overload.check(10 ** 6, 10 ** 6)
+
+    def test_age(self):
+        assert salmonqueueindex.age("1592900000.M500P1Q2.host", now=1592900090) == 90
+        assert salmonqueueindex.age("1592900000.M500P1Q2.host", now=1592800000) == 0
+        assert salmonqueueindex.age("no-time") == 0
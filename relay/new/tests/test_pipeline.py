@@ -0,0 +1,117 @@
+import os
+import random
+import threading
+import time
+
+from salmon import salmonpipeline
+from salmon import utils
+from salmon.mail import MailRequest
+from salmon.salmonpipeline import RelayPipeline, Stage
+
+
+def request(key):
+    return MailRequest("peer", "from@example.com", "to@example.com", "Subject: %s\n\nx" % key)
+
+
+def parse_email(key, data):
+    # runs in the parse processes, they are forked after the stubs are set
+    if key == "unparsable":
+        return None
+    return {"key": key}
+
+
+class TestSalmonPipeline(object):
+    def test_stage_report(self):
+        stage = Stage("deliver", 2, 4)
+        stage.put("message")
+        stage.count(1.0)
+        stage.count(0.5, failed=True)
+        assert stage.report(1.5) == (
+            "deliver: 2 messages (1.3/s), 1 failed, busy 50%, queue 1/4, waited 0.0 s for room"
+        )
+        assert stage.processed == 0 and stage.busy == 0
+        assert Stage("parse", 2).report(1) == "parse: 0 messages (0.0/s), 0 failed, busy 0%"
+
+    def test_persist_without_pipeline(self):
+        written = []
+        thread = threading.Thread(target=salmonpipeline.persist, args=(written.append, 5))
+        thread.start()
+        thread.join()
+        assert written == [5]
+
+    def stub_stages(self, monkeypatch, parse_email=parse_email):
+        utils.import_settings(True, boot_module="tests.testing_boot")
+        monkeypatch.setitem(utils.settings.data["relay"], "analyze_text", False)
+        monkeypatch.setattr(salmonpipeline.salmonmailparser, "parse_email", parse_email)
+        monkeypatch.setattr(salmonpipeline.salmonmailparser, "move_to_undeliverable", lambda key, msg: None)
+        rated = []
+        writes = []
+
+        def conclude(mail_fields, key, mail_request, deliver=True, degraded=False):
+            assert not deliver and mail_fields == {"key": key}
+            if key == "unratable":
+                raise ValueError(key)
+            rated.append(key)
+            return 50
+
+        def relay(mail_fields, key, mail_request, final_rating):
+            # the delivery threads finish out of order
+            time.sleep(random.random() / 100)
+            if key == "undeliverable":
+                raise ValueError(key)
+            salmonpipeline.persist(lambda: writes.append((key, threading.current_thread().name)))
+
+        monkeypatch.setattr(salmonpipeline.salmonconclude, "conclude", conclude)
+        monkeypatch.setattr(salmonpipeline.salmonrelay, "relay", relay)
+        return rated, writes
+
+    def test_pipeline(self, monkeypatch):
+        rated, writes = self.stub_stages(monkeypatch)
+        keys = ["key%d" % i for i in range(20)]
+        keys[3], keys[8], keys[13] = "unparsable", "unratable", "undeliverable"
+        done = []
+        failed = []
+        pipeline = RelayPipeline(parse_workers=2, delivery_threads=3, queue_size=2, report=0, batch_size=3)
+        pipeline.start(done.append, lambda key, msg: failed.append(key))
+        for key in keys[:10]:
+            pipeline.submit(key, request(key))
+        # the last batch isn't full, drain passes it on
+        pipeline.drain()
+        assert sorted(done + failed) == sorted(keys[:10])
+        for key in keys[10:]:
+            pipeline.submit(key, request(key))
+        pipeline.stop()
+
+        # rated one after another in the order they were submitted
+        assert rated == [key for key in keys if key not in ("unparsable", "unratable")]
+        assert sorted(failed) == ["undeliverable", "unratable"]
+        assert sorted(done) == sorted(set(keys) - set(failed))
+        # the writes of the delivery threads run in the writer thread
+        assert sorted(writes) == sorted((key, "pipeline-conclude") for key in rated if key != "undeliverable")
+        assert not any(thread.is_alive() for thread in pipeline.threads)
+        assert salmonpipeline._pipeline is None
+
+    def test_parse_process_died(self, monkeypatch, tmp_path):
+        crashed = str(tmp_path / "crashed")
+
+        def crash_once(key, data):
+            if key == "key1" and not os.path.exists(crashed):
+                open(crashed, "w").close()
+                os._exit(1)
+            return parse_email(key, data)
+
+        rated, writes = self.stub_stages(monkeypatch, crash_once)
+        keys = ["key%d" % i for i in range(6)]
+        done = []
+        pipeline = RelayPipeline(parse_workers=1, delivery_threads=2, queue_size=10, report=0)
+        pipeline.start(done.append)
+        first_pool = pipeline.pool
+        for key in keys:
+            pipeline.submit(key, request(key))
+        pipeline.stop()
+
+        assert os.path.exists(crashed)
+        assert pipeline.pool is not first_pool
+        # the messages of the dead pool are parsed again by the new processes
+        assert rated == keys
+        assert sorted(done) == keys
@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+from salmon import queue, salmonmailparser, salmonqueueindex, server
+from salmon.mail import MailRequest
+from salmon.salmonqueueindex import QueueIndex
+
+
+class TestSalmonQueueIndex(object):
+    keys = [
+        "1592900001.M500P1Q2.host",
+        "1592900000.M900P1Q1.host",
+        "1592900001.M20P1Q3.host",
+    ]
+
+    def test_index_order(self):
+        index = QueueIndex(self.keys)
+        assert index.keys() == [self.keys[1], self.keys[2], self.keys[0]]
+        index.discard(self.keys[2])
+        index.add("1592899999.M1P1Q9.host")
+        assert len(index) == 3
+        assert self.keys[2] not in index
+        assert index.pop(2) == ["1592899999.M1P1Q9.host", self.keys[1]]
+        assert index.pop(5) == [self.keys[0]]
+        assert index.pop() == []
+
+    def test_setup_layout(self, tmp_path):
+        queue_dir = str(tmp_path)
+        for sub in ("new", "meta"):
+            os.mkdir(os.path.join(queue_dir, sub))
+        for key in self.keys:
+            open(os.path.join(queue_dir, "new", key), "w").close()
+            open(os.path.join(queue_dir, "meta", key + ".json"), "w").close()
+
+        assert salmonqueueindex.setup_layout(queue_dir) == 0
+        assert salmonqueueindex.setup_layout(queue_dir, 16) == 16
+        # the layout stored in the queue wins
+        assert salmonqueueindex.setup_layout(queue_dir, 8) == 16
+        assert salmonqueueindex.setup_layout(queue_dir) == 16
+
+        for key in self.keys:
+            assert os.path.isfile(salmonqueueindex.message_path(queue_dir, key, 16))
+            assert os.path.isfile(salmonqueueindex.metadata_path(queue_dir, key, 16))
+        new_dirs = salmonqueueindex.new_dirs(queue_dir, 16)
+        assert len(new_dirs) == 16
+        assert sorted(salmonqueueindex.scan(new_dirs)) == sorted(self.keys)
+        assert salmonqueueindex.backlog(new_dirs, now=1592900100) == (3, 100)
+        assert salmonqueueindex.backlog([]) == (0, 0)
+
+    def test_claim(self, tmp_path):
+        inq = queue.Queue(str(tmp_path / "queue"), shards=4)
+        key = inq.push(MailRequest("peer", "from@example.com", "to@example.com", "Subject: claim\n\nx"))
+        msg = inq.claim(key, "w1")
+        assert msg["subject"] == "claim"
+        assert inq.claim(key, "w2") is None
+        assert inq.keys() == []
+        with pytest.raises(KeyError):
+            inq.complete(key, "w2")
+        assert inq.reclaim(60) == 0
+        # the claims of the worker itself are renewed, not reclaimed
+        assert inq.reclaim(-1, "w1") == 0
+        assert inq.reclaim(-1) == 1
+        assert inq.keys() == [key]
+        msg = inq.claim(key, "w2")
+        assert msg.metadata["attempts"] == 1
+        with pytest.raises(KeyError):
+            inq.complete(key, "w1")
+        inq.release(key, "w2")
+        assert inq.claim(key, "w2").metadata["attempts"] == 2
+        inq.complete(key, "w2")
+        assert len(inq) == 0
+
+    def test_claim_during_reclaim(self, tmp_path, monkeypatch):
+        inq = queue.Queue(str(tmp_path / "queue"))
+        other = queue.Queue(str(tmp_path / "queue"))
+        keys = [inq.push(MailRequest("peer", "from@example.com", "to@example.com", "Subject: old\n\nx"))
+                for i in range(2)]
+        for key in keys:
+            # arrived longer than the lease ago
+            os.utime(inq.new_path(key), (0, 0))
+        rename = os.rename
+        reclaimed = []
+
+        def rename_and_reclaim(source, target, lease):
+            rename(source, target)
+            if "processing" in target:
+                reclaimed.append(other.reclaim(lease, "w2"))
+
+        monkeypatch.setattr(queue.os, "rename", lambda source, target: rename_and_reclaim(source, target, 60))
+        # the lease started before the rename
+        assert inq.claim(keys[0], "w1")["subject"] == "old"
+        inq.complete(keys[0], "w1")
+        monkeypatch.setattr(queue.os, "rename", lambda source, target: rename_and_reclaim(source, target, -1))
+        # the claim is lost, not an error
+        assert inq.claim(keys[1], "w1") is None
+        monkeypatch.undo()
+        assert reclaimed == [0, 1]
+        assert inq.keys() == [keys[1]]
+
+    def test_renew(self, tmp_path):
+        inq = queue.Queue(str(tmp_path / "queue"))
+        key = inq.push(MailRequest("peer", "from@example.com", "to@example.com", "Subject: renew\n\nx"))
+        inq.claim(key, "w1")
+        os.utime(inq.processing_path(key, "w1"), (0, 0))
+        inq.renew([key, "gone"], "w1")
+        assert inq.reclaim(60) == 0
+        with pytest.raises(KeyError):
+            inq.release("gone", "w1")
+
+    def test_attempts(self, tmp_path, monkeypatch):
+        moved = []
+        monkeypatch.setattr(salmonmailparser, "move_to_undeliverable", lambda key, msg: moved.append(key))
+        inq = queue.Queue(str(tmp_path / "queue"))
+        key = inq.push(MailRequest("peer", "from@example.com", "to@example.com", "Subject: fail\n\nx"))
+        receiver = server.QueueReceiver(str(tmp_path / "queue"), attempts=2)
+        receiver.fail(inq, key, "w1", inq.claim(key, "w1"))
+        assert inq.keys() == [key] and not moved
+        # the second failure is the last one
+        receiver.fail(inq, key, "w1", inq.claim(key, "w1"))
+        assert moved == [key] and len(inq) == 0 and not receiver.claimed
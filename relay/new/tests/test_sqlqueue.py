@@ -0,0 +1,68 @@
+from salmon import salmonsqlqueue
+from salmon.salmonsqlqueue import MessageStore
+
+
+class TestSalmonSQLQueue(object):
+    def test_store(self, tmp_path):
+        queue_dir = str(tmp_path)
+        store = MessageStore(queue_dir)
+        assert salmonsqlqueue.exists(queue_dir)
+        store.add("1.M1P1Q1", "Subject: one\n\nx", {"peer": "1.2.3.4"})
+        store.add_many([("1.M1P1Q2", b"Subject: two\n\nx", None), ("1.M1P1Q1", b"duplicate", None)])
+        assert store.keys() == ["1.M1P1Q1", "1.M1P1Q2"]
+        assert store.get("1.M1P1Q1") == (b"Subject: one\n\nx", {"peer": "1.2.3.4"})
+        assert store.size("1.M1P1Q2") == len(b"Subject: two\n\nx")
+        assert store.get("missing") is None
+
+        # a second connection only gets what the first one popped
+        other = MessageStore(queue_dir)
+        assert other.pop(1) == [("1.M1P1Q1", b"Subject: one\n\nx", {"peer": "1.2.3.4"})]
+        assert store.pop(5) == [("1.M1P1Q2", b"Subject: two\n\nx", None)]
+        assert len(store) == 0
+        assert not store.remove("1.M1P1Q2")
+
+    def test_group_commit(self, tmp_path):
+        queue_dir = str(tmp_path)
+        store = MessageStore(queue_dir, commit_interval=60, commit_batch=3)
+        other = MessageStore(queue_dir)
+        store.add("1.M1P1Q1", b"one")
+        store.add("1.M1P1Q2", b"two")
+        assert len(other) == 0
+        # no transaction is open while the pushes wait, others can write
+        other.db.execute("BEGIN IMMEDIATE")
+        other.db.execute("ROLLBACK")
+        store.add("1.M1P1Q3", b"three")
+        assert len(other) == 3
+        store.add("1.M1P1Q4", b"four", {"recipients": ["a@example.com"]})
+        store.flush()
+        assert other.pop(key="1.M1P1Q4") == [("1.M1P1Q4", b"four", {"recipients": ["a@example.com"]})]
+        assert len(other) == 3
+
+    def test_claim(self, tmp_path):
+        queue_dir = str(tmp_path)
+        store = MessageStore(queue_dir)
+        other = MessageStore(queue_dir)
+        store.add_many([("1.M1P1Q1", b"one", None), ("1.M1P1Q2", b"two", None)])
+        assert store.claim("1.M1P1Q1", "w1") == (b"one", None)
+        assert other.claim("1.M1P1Q1", "w2") is None
+        assert other.keys() == ["1.M1P1Q2"]
+        assert other.pop(5) == [("1.M1P1Q2", b"two", None)]
+        assert not other.complete("1.M1P1Q1", "w2")
+        assert other.reclaim(60) == 0
+        assert other.reclaim(-1, "w1") == 0
+        store.renew(["1.M1P1Q1"], "w1")
+        assert other.reclaim(-1) == 1
+        assert other.claim("1.M1P1Q1", "w2") == (b"one", {"attempts": 1})
+        assert not store.complete("1.M1P1Q1", "w1")
+        assert not store.release("1.M1P1Q1", "w1")
+        assert other.release("1.M1P1Q1", "w2")
+        assert other.claim("1.M1P1Q1", "w2") == (b"one", {"attempts": 2})
+        assert other.complete("1.M1P1Q1", "w2")
+        assert len(store) == 0
+
+    def test_backlog(self, tmp_path):
+        store = MessageStore(str(tmp_path))
+        assert store.backlog() == (0, None)
+        store.add_many([("1.M1P1Q1", b"one", None), ("2.M1P1Q2", b"two", None)])
+        store.claim("1.M1P1Q1", "w1")
+        assert store.backlog() == (1, "2.M1P1Q2")
@@ -0,0 +1,84 @@
+import random
+
+import ssdeep
+
+from salmon.salmonconclude import Spam
+from salmon import salmondb
+from salmon.salmondb import MailFields
+from salmon.salmondb import SsdeepIndex
+from salmon.salmondb import SsdeepNgram
+from salmon.salmondb import get_mail_fields
+from salmon.salmondb import get_similar_mail_fields
+from salmon.salmondb import index_mail_fields
+from salmon.salmondb import push_into_db
+from salmon.salmondb import split_ssdeep
+
+WORDS = "account password bank verify login click here update your details invoice payment".split()
+
+
+def make_texts(generator, count):
+    """Texts in groups of similar ones, every one a few words away from its template."""
+    texts = []
+    for i in range(count // 5):
+        template = [generator.choice(WORDS) for j in range(generator.randint(20, 400))]
+        for j in range(5):
+            text = list(template)
+            for k in range(generator.randint(0, len(text) // 4)):
+                text[generator.randrange(len(text))] = generator.choice(WORDS)
+            texts.append(" ".join(text))
+    return texts
+
+
+class TestSsdeepIndex(object):
+    @classmethod
+    def setup_class(cls):
+        generator = random.Random(21)
+        cls.hashes = [ssdeep.hash(text) for text in make_texts(generator, 300)]
+        cls.hashes.extend(["3:aaaaaaaab:c", "3:aaab:c", "not a hash"])
+        for ssdeep_hash in cls.hashes:
+            push_into_db(MailFields("0", ssdeep_hash, 0, False))
+
+    def test_split(self):
+        assert split_ssdeep("12:abbbbbbc:dddd") == (12, "abbbc", "ddd")
+        assert split_ssdeep("not a hash") == (0, "", "")
+
+    def test_candidates(self):
+        stored = get_mail_fields()
+        for ssdeep_hash in self.hashes[:-1] + [ssdeep.hash("account " * 50)]:
+            expected = set(
+                mail_fields.id for mail_fields in stored
+                if split_ssdeep(mail_fields.ssdeep)[0] and ssdeep.compare(ssdeep_hash, mail_fields.ssdeep) > 0
+            )
+            candidates = set(mail_fields.id for mail_fields in get_similar_mail_fields(ssdeep_hash))
+            assert expected <= candidates, ssdeep_hash
+            # the index has to narrow the comparisons down
+            assert len(candidates) < len(stored) / 2
+
+    def test_short_chunks(self):
+        # chunks shorter than an n-gram are found only when they're the same
+        candidates = get_similar_mail_fields("3:aaaaab:c")
+        assert [mail_fields.ssdeep for mail_fields in candidates] == ["3:aaaaaaaab:c", "3:aaab:c"]
+        assert get_similar_mail_fields("not a hash") == []
+
+    def test_index_mail_fields(self):
+        salmondb.session.query(SsdeepNgram).delete()
+        salmondb.session.query(SsdeepIndex).delete()
+        salmondb.session.commit()
+        assert get_similar_mail_fields(self.hashes[0]) == []
+        # the relay indexed a new email before the backfill got to the old ones
+        newest = get_mail_fields()[-1]
+        index_row, ngram_rows = salmondb.get_ssdeep_index_rows(newest.id, newest.ssdeep)
+        salmondb.insert_ssdeep_index(salmondb.session.connection(), [index_row], ngram_rows)
+        salmondb.session.commit()
+        index_mail_fields(batch_size=7)
+        assert salmondb.session.query(SsdeepIndex).count() == len(get_mail_fields())
+        assert self.hashes[0] in [mail_fields.ssdeep for mail_fields in get_similar_mail_fields(self.hashes[0])]
+
+    def test_similarity_check(self):
+        spam = Spam(subject="", email_date="0", ssdeep=self.hashes[0], length=0, attachment=False)
+        expected = [
+            mail_fields.id for mail_fields in get_mail_fields()
+            if split_ssdeep(mail_fields.ssdeep)[0] and ssdeep.compare(self.hashes[0], mail_fields.ssdeep) >= 50
+        ]
+        assert sorted(spam.get_ids_for_similarity_check()) == expected
+        assert len(expected) > 1
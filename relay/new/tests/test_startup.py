@@ -0,0 +1,73 @@
+import builtins
+import logging
+import sys
+import threading
+
+import spacy
+
+from salmon import salmonnlp
+from salmon import salmonstartup
+
+
+class TestSalmonStartup(object):
+    def test_imports(self, tmp_path, monkeypatch):
+        (tmp_path / "startup_outer.py").write_text("import time\ntime.sleep(0.2)\nimport startup_inner\n")
+        (tmp_path / "startup_inner.py").write_text("import time\ntime.sleep(0.1)\n")
+        monkeypatch.syspath_prepend(str(tmp_path))
+        monkeypatch.setattr(salmonstartup, "RELAY_MODULES", ("salmon", "startup_outer"))
+        # importing salmonstartup doesn't time anything yet
+        assert builtins.__import__ is not salmonstartup._timed_import
+        original = builtins.__import__
+        salmonstartup.start()
+        try:
+            assert builtins.__import__ is salmonstartup._timed_import
+            exec("import startup_outer", {"__name__": "salmon.fake"})
+        finally:
+            salmonstartup.stop()
+            sys.modules.pop("startup_outer", None)
+            sys.modules.pop("startup_inner", None)
+        assert builtins.__import__ is original
+        # without the time of the timed import in it
+        seconds, importer = salmonstartup.imports.pop("startup_outer")
+        assert 0.2 <= seconds < 0.3 and importer == "salmon.fake"
+        seconds, importer = salmonstartup.imports.pop("startup_inner")
+        assert 0.1 <= seconds < 0.2 and importer == "startup_outer"
+
+    def test_report(self, caplog, monkeypatch):
+        monkeypatch.setattr(salmonstartup, "steps", {})
+        with salmonstartup.step("credentials"):
+            pass
+        with salmonstartup.step("credentials"):
+            pass
+        assert list(salmonstartup.steps) == ["credentials"]
+        with caplog.at_level(logging.INFO):
+            salmonstartup.report()
+        assert "Relay loaded in" in caplog.text and "Steps: credentials" in caplog.text
+
+    def test_warm_up(self, monkeypatch):
+        loaded = threading.Event()
+        calls = []
+
+        def load():
+            calls.append(threading.current_thread().name)
+            loaded.set()
+
+        monkeypatch.setattr(salmonstartup, "_warm_ups", [])
+        monkeypatch.setattr(salmonstartup, "_warmed_up", None)
+        salmonstartup.add_warm_up(load)
+        salmonstartup.warm_up()
+        assert loaded.wait(5)
+        # once in a process
+        salmonstartup.warm_up()
+        assert calls == ["warm-up"]
+
+    def test_lazy_model(self, tmp_path):
+        nlp = spacy.blank("en")
+        nlp.add_pipe("tok2vec")
+        nlp.initialize()
+        nlp.to_disk(tmp_path / "model")
+        service = salmonnlp.NlpService(str(tmp_path / "model"))
+        assert service._nlp is None
+        service.warm_up()
+        assert service._nlp.pipe_names == ["tok2vec"]
+        assert service("some words").text == "some words"
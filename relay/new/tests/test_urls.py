@@ -0,0 +1,53 @@
+import os
+import random
+import re
+
+from salmon.salmonurls import find_links, remove_links
+
+# the regular expression salmonmailparser found the links with before salmonurls
+LINK_PATTERN = re.compile(
+    r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)"
+    r"(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+"
+    r"|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?\xab\xbb\u201c\u201d\u2018\u2019]))"
+)
+
+
+def regex_links(text):
+    return set(match[0] for match in LINK_PATTERN.findall(text))
+
+
+class TestSalmonUrls(object):
+    def test_corpus(self):
+        with open("./url_corpus.txt", encoding="utf-8") as f:
+            for line in f:
+                assert set(find_links(line)) == regex_links(line), line
+
+    def test_rawspams(self):
+        for name in sorted(os.listdir("./rawspams")):
+            with open("./rawspams/{}".format(name), "rb") as f:
+                text = f.read().decode("utf-8", "replace")
+            assert set(find_links(text)) == regex_links(text), name
+
+    def test_random(self):
+        pieces = [
+            "http://", "https://", "www.", "www12.", "www1234.", "x.com/", ".org/", "a", "b", "-", "_", "1",
+            "(", ")", " ", ".", ",", "!", "'", "<", ">", ":", "[", "\u017f", "\u212a", "\u201d", "\xe9",
+        ]
+        generator = random.Random(19)
+        for i in range(3000):
+            text = "".join(generator.choice(pieces) for j in range(generator.randint(1, 6)))
+            assert set(find_links(text)) == regex_links(text), text
+
+    def test_order(self):
+        text = "www.b.com/x http://a.com/y www.b.com/x (https://c.com/z)."
+        assert find_links(text) == ["www.b.com/x", "http://a.com/y", "https://c.com/z"]
+
+    def test_pathological(self):
+        # the regular expression needs about half a minute for 14 repetitions
+        assert find_links("www." + ".," * 100000) == []
+        text = "http://" + "a!" * 100000 + " http://(a)((b))" + "(" * 1000
+        assert find_links(text) == ["http://" + "a!" * 99999 + "a", "http://(a)((b))"]
+
+    def test_remove_links(self):
+        for text in ("see www.a.com/x, (http://b.org/(y)) and www.a.com/x!", "no links", "www." + ".," * 10):
+            assert remove_links(text) == LINK_PATTERN.sub("", text)
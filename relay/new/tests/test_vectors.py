@@ -0,0 +1,95 @@
+import numpy
+import spacy
+
+from salmon.salmonconclude import Spam
+from salmon import salmondb
+from salmon import salmonvectors
+from salmon.salmondb import DocVectors
+from salmon.salmondb import MailFields
+from salmon.salmondb import TestMail
+from salmon.salmondb import get_doc_vectors
+from salmon.salmondb import push_into_db
+
+TEXTS = [
+    ("Your account", "Please verify your account at the bank today", ""),
+    ("Invoice", "", "The invoice for your last order is attached"),
+    ("", "Click the link below to claim your prize", "Click the link below to claim your prize"),
+]
+
+
+def get_nlp():
+    # a model with a tok2vec layer like en_core_web_sm, without downloading one
+    nlp = spacy.blank("en")
+    nlp.add_pipe("tok2vec")
+    nlp.initialize()
+    return nlp
+
+
+class TestSalmonVectors(object):
+    @classmethod
+    def setup_class(cls):
+        cls.nlp = get_nlp()
+        cls.ids = []
+        for subject, body_plain, body_html in TEXTS:
+            mail_fields = MailFields("0", "3:abc:def", 0, False, body_plain, body_html, subject)
+            mail_fields.doc_vectors = salmonvectors.get_doc_vectors(cls.nlp, subject, body_plain, body_html)
+            push_into_db(mail_fields)
+            push_into_db(TestMail(mail_fields))
+            cls.ids.append(mail_fields.id)
+
+    def test_doc_vectors(self):
+        subject, body_plain, body_html = TEXTS[0]
+        vectors = salmonvectors.get_doc_vectors(self.nlp, subject, body_plain, body_html)
+        assert vectors.dtype == numpy.float32 and vectors.shape[0] == len(salmonvectors.FIELDS)
+        assert not vectors[salmonvectors.FIELDS.index("body_html")].any()
+        assert numpy.array_equal(salmonvectors.from_bytes(salmonvectors.to_bytes(vectors)), vectors)
+        assert salmonvectors.get_doc_vectors(self.nlp, "", "", "") is None
+
+    def test_similarities(self):
+        vectors = [salmonvectors.get_doc_vectors(self.nlp, *texts) for texts in TEXTS]
+        similarities = salmonvectors.get_similarities(vectors[0], numpy.stack(vectors))
+        assert similarities.shape == (len(TEXTS), len(salmonvectors.FIELDS))
+        # the same values as spaCy, 0 where either field is empty
+        fields = [dict(zip(("subject", "body_plain", "body_html"), texts)) for texts in TEXTS]
+        for row in range(len(TEXTS)):
+            for column, field in enumerate(salmonvectors.FIELDS):
+                text, other = fields[0][field], fields[row][field]
+                expected = self.nlp(text).similarity(self.nlp(other)) if text and other else 0
+                assert abs(similarities[row, column] - expected) < 1e-5
+
+    def test_cache(self):
+        cache = salmonvectors.VectorCache(max_rows=3)
+        vectors = numpy.ones((len(salmonvectors.FIELDS), 4), dtype=numpy.float32)
+        for i in range(3):
+            cache.add(i, vectors * i)
+        ids, matrix = cache.get([2, 7, 0])
+        assert ids == [2, 0] and numpy.array_equal(matrix, numpy.stack([vectors * 2, vectors * 0]))
+        cache.discard(2)
+        assert cache.get([2])[0] == []
+        # full, it starts over
+        cache.add(3, vectors)
+        assert list(cache.rows) == [3]
+        # another model
+        cache.add(4, numpy.ones((len(salmonvectors.FIELDS), 5), dtype=numpy.float32))
+        assert list(cache.rows) == [4]
+
+    def test_records_if_similar(self):
+        spam = Spam(subject=TEXTS[0][0], email_date="0", ssdeep="3:abc:def", length=0, attachment=False,
+                    body_plain=TEXTS[0][1], body_html=TEXTS[0][2])
+        vectors = salmonvectors.get_doc_vectors(self.nlp, TEXTS[0][0], TEXTS[0][1], TEXTS[0][2])
+        records = spam.get_records_if_similar(self.ids, vectors, self.nlp)
+        assert self.ids[0] in [record.mail_fields_id for record in records]
+        assert spam.get_records_if_similar(self.ids, None, self.nlp) == []
+
+    def test_missing_vectors(self):
+        salmondb.session.query(DocVectors).filter(DocVectors.mail_fields_id == self.ids[1]).delete()
+        salmondb.session.commit()
+        salmondb.doc_vectors_cache.clear()
+        assert get_doc_vectors(self.ids)[0] == [self.ids[0], self.ids[2]]
+        # computed once and stored
+        spam = Spam(subject=TEXTS[1][0], email_date="0", ssdeep="3:abc:def", length=0, attachment=False,
+                    body_plain=TEXTS[1][1], body_html=TEXTS[1][2])
+        vectors = salmonvectors.get_doc_vectors(self.nlp, TEXTS[1][0], TEXTS[1][1], TEXTS[1][2])
+        records = spam.get_records_if_similar(self.ids, vectors, self.nlp)
+        assert self.ids[1] in [record.mail_fields_id for record in records]
+        assert salmondb.session.query(DocVectors).filter(DocVectors.mail_fields_id == self.ids[1]).count() == 1
@@ -8,9 +8,9 @@ import yaml
 import iottl
 import logging
 import json
-import spacy
 import warnings
 warnings.filterwarnings("ignore")
+from salmon import salmondb
 from salmon.salmonconclude import push_into_db
 from salmon.salmondb import Settings
 from salmon.salmondb import are_credentials_in_db
@@ -24,3 +24,5 @@ relay_config = {'host': data['relay']['relayhost'], 'port': data['relay']['relay
 receiver_config = {'maildir': data['directory']['queuepath']}
 handlers = data['global']['handlers']
 router_defaults = data['global']['router_defaults']
+
+salmondb.init()